@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+"""
+余额管理系统的异步运行方式
+在一个asyncio事件循环中用aiohttp提供与BalanceManagerServer相同路径的REST接口，
+定时余额检查和Excel文件监控作为同一循环中的任务运行；查询走aiosqlite连接池，
+余额检查、导入和调整仍使用BalanceManager的同步实现，交给单个写线程按顺序执行
+"""
+import os
+import time
+import json
+import asyncio
+import argparse
+import functools
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+import prometheus_client as prom
+
+import balance_manager
+from balance_manager import (
+    BalanceManager, logger, next_tick_slot, TIME_POINTS, LEDGER_MEAL, BATCH_LOOKUP_LIMIT,
+    READ_POOL_SIZE, EXCEL_DIR, BATCH_SIZE, LOW_BALANCE_DAYS
+)
+from db_pool import AiosqlitePool
+from file_ingest import hash_and_validate, is_excel_event_path
+
+SCHEDULER_MAX_SLEEP = 60  # 调度任务每次最多休眠的秒数，系统时间被调整后能及时重新计算
+FILE_POLL_INTERVAL = 2.0  # 轮询Excel目录的间隔（秒）
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """与flask_cors默认配置一致：允许任意来源"""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        requested = request.headers.get('Access-Control-Request-Headers')
+        if requested:
+            response.headers['Access-Control-Allow-Headers'] = requested
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+def query_arg(request, name, type=str):
+    """读取查询参数，无法转换时返回None（与Flask的request.args.get(type=...)一致）"""
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        return type(value)
+    except ValueError:
+        return None
+
+
+class AsyncBalanceServer:
+    """在单个事件循环中运行余额API、定时余额检查和文件监控"""
+
+    def __init__(self, balance_manager, host='0.0.0.0', port=5555, pool_size=READ_POOL_SIZE,
+                 poll_interval=FILE_POLL_INTERVAL):
+        """
+        balance_manager: BalanceManager实例，不需要调用其start_file_monitoring/start_scheduler
+        pool_size: aiosqlite连接池大小
+        poll_interval: 轮询Excel目录的间隔（秒）
+        """
+        self.balance_manager = balance_manager
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.poll_interval = poll_interval
+        # 所有写操作都在这一个线程中按顺序执行，不会争抢SQLite写锁
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='balance-writer')
+        self.db_pool = None
+        self.background_tasks = set()
+        self.app = self.create_app()
+
+    def create_app(self):
+        """创建aiohttp应用，路径与BalanceManagerServer一致"""
+        app = web.Application(middlewares=[cors_middleware])
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/api/import', self.import_excel)
+        app.router.add_get('/api/check-balance', self.check_balance)
+        app.router.add_get('/api/balance', self.get_balance)
+        app.router.add_post('/api/balance/batch', self.get_balance_batch)
+        app.router.add_post('/api/balance/adjust', self.adjust_balance)
+        app.router.add_get('/api/ledger/summary', self.ledger_summary)
+        app.router.add_get('/api/ticks', self.tick_runs)
+        app.router.add_get('/api/balance/low', self.low_balance)
+        app.router.add_get('/metrics', self.metrics)
+        app.router.add_get('/api/sync-zero', self.sync_zero)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    async def on_startup(self, app):
+        """创建连接池并启动调度和文件监控任务"""
+        self.db_pool = AiosqlitePool(balance_manager.DB_PATH, max_size=self.pool_size)
+        self.spawn(self.startup_tasks())
+        self.spawn(self.run_scheduler())
+        self.spawn(self.watch_excel_folder())
+
+    async def on_cleanup(self, app):
+        """取消后台任务，关闭连接池和写线程"""
+        tasks = list(self.background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.db_pool is not None:
+            await self.db_pool.close()
+            self.db_pool = None
+        self.writer.shutdown(wait=True)
+
+    def spawn(self, coro):
+        """在事件循环中创建后台任务并保留引用，结束时记录未处理的异常"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"执行后台任务时出错: {str(task.exception())}")
+
+    async def run_write(self, func, *args, **kwargs):
+        """在写线程中执行BalanceManager的同步写操作"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.writer, functools.partial(func, *args, **kwargs))
+
+    async def fetchall(self, sql, params=()):
+        """在连接池的连接上执行查询"""
+        async with self.db_pool.acquire() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+
+    async def lookup_balances(self, keys):
+        """与BalanceManager.lookup_balances相同，未命中缓存的键在连接池上查询"""
+        manager = self.balance_manager
+        version = manager._data_version
+        results, missing_pairs, missing_users = manager.split_cached_balances(keys, version)
+        if missing_pairs or missing_users:
+            fetched = [
+                (by_user, await self.fetchall(sql, params))
+                for by_user, sql, params in manager.balance_lookup_queries(missing_pairs, missing_users)
+            ]
+            manager.store_balance_lookups(results, missing_pairs, missing_users, fetched, version)
+        return results
+
+    # 后台任务
+
+    async def startup_tasks(self):
+        """启动时导入已有Excel，按顺序补跑错过的余额检查，再计算一次余额预测"""
+        await self.run_write(self.balance_manager.check_new_excel)
+        await self.run_write(self.balance_manager.replay_missed_ticks)
+        await self.run_write(self.balance_manager.refresh_balance_forecast)
+
+    async def run_scheduler(self):
+        """休眠到下一个时间点后执行余额检查，代替schedule的轮询线程"""
+        logger.info(f"异步调度已启动，时间点: {TIME_POINTS}")
+        while True:
+            now = datetime.now()
+            run_date, time_point, slot = next_tick_slot(now)
+            await asyncio.sleep(min((slot - now).total_seconds(), SCHEDULER_MAX_SLEEP))
+            if datetime.now() < slot:
+                continue
+            logger.info(f"触发时间点 {time_point} 的余额检查")
+            try:
+                await self.run_write(
+                    self.balance_manager.process_balance_check, time_point, run_date=run_date, source='schedule',
+                    slot_time=slot
+                )
+            except Exception as e:
+                logger.error(f"定时余额检查出错: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def scan_excel_folder(self):
+        """返回Excel目录中每个文件的 (大小, 修改时间)"""
+        stats = {}
+        with os.scandir(self.balance_manager.excel_folder) as entries:
+            for entry in entries:
+                if entry.is_file() and is_excel_event_path(entry.path):
+                    st = entry.stat()
+                    stats[entry.path] = (st.st_size, st.st_mtime_ns)
+        return stats
+
+    async def watch_excel_folder(self):
+        """轮询Excel目录，文件大小和修改时间稳定settle_seconds后交给写线程导入，代替watchdog和去抖动线程"""
+        settle_seconds = self.balance_manager.settle_seconds
+        # 启动时已有的文件由startup_tasks处理
+        handled = self.scan_excel_folder()
+        pending = {}
+        logger.info(f"异步文件监控已启动，监控文件夹: {self.balance_manager.excel_folder}")
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                now = time.monotonic()
+                stats = self.scan_excel_folder()
+                for file_path, stat in stats.items():
+                    if handled.get(file_path) == stat:
+                        continue
+                    seen = pending.get(file_path)
+                    if seen is None or seen[0] != stat:
+                        pending[file_path] = (stat, now)
+                    elif now - seen[1] >= settle_seconds:
+                        del pending[file_path]
+                        handled[file_path] = stat
+                        await self.run_write(self.ingest_file, file_path)
+                for file_path in set(pending) - set(stats):
+                    del pending[file_path]
+            except Exception as e:
+                logger.error(f"轮询Excel目录时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def ingest_file(self, file_path):
+        """（写线程）校验已稳定的文件并导入"""
+        file_hash = hash_and_validate(file_path, 'balance', logger)
+        if file_hash is not None:
+            logger.info(f"文件已稳定并通过校验，交付导入: {file_path}")
+            self.balance_manager.on_excel_settled(file_path, file_hash)
+
+    # REST接口
+
+    def not_modified(self, etag):
+        """返回304响应"""
+        response = web.Response(status=304)
+        response.etag = etag
+        return response
+
+    def etag_matches(self, request, etag):
+        return any(tag.value in (etag, '*') for tag in request.if_none_match or ())
+
+    def error_response(self, message, e):
+        logger.error(f"API{message}时出错: {str(e)}")
+        logger.error(traceback.format_exc())
+        return web.json_response({
+            "success": False,
+            "message": f"{message}失败: {str(e)}",
+            "error": str(e)
+        }, status=500)
+
+    async def health(self, request):
+        return web.json_response(self.balance_manager.health_status)
+
+    async def import_excel(self, request):
+        try:
+            await self.run_write(self.balance_manager.check_new_excel)
+            return web.json_response({
+                "success": True,
+                "message": "导入操作已触发，请检查日志获取详细信息",
+                "latest_excel": self.balance_manager.latest_excel
+            })
+        except Exception as e:
+            return self.error_response("导入Excel", e)
+
+    async def check_balance(self, request):
+        try:
+            time_point = request.query.get('time_point')
+            if not time_point:
+                time_point = self.balance_manager.get_time_point_by_now()
+            if time_point not in TIME_POINTS:
+                return web.json_response({
+                    "success": False,
+                    "message": f"未知的时间点: {time_point}"
+                }, status=400)
+
+            # 同一天同一时间点已执行过时不会重复扣减
+            self.spawn(self.run_write(
+                self.balance_manager.process_balance_check, time_point,
+                run_date=request.query.get('date'), source='manual'
+            ))
+            return web.json_response({
+                "success": True,
+                "message": f"时间点 {time_point} 的余额检查已触发",
+                "time_point": time_point
+            })
+        except Exception as e:
+            return self.error_response("触发余额检查", e)
+
+    async def get_balance(self, request):
+        try:
+            user = request.query.get('user')
+            department = request.query.get('department')
+
+            if not user:
+                return web.json_response({
+                    "success": False,
+                    "message": "请提供user参数"
+                }, status=400)
+
+            etag = self.balance_manager.balance_etag('balance', user, department)
+            if self.etag_matches(request, etag):
+                return self.not_modified(etag)
+
+            key = (user, department or None)
+            result = (await self.lookup_balances([key]))[key]
+
+            if result is None or result == []:
+                return web.json_response({
+                    "success": False,
+                    "message": "未找到记录"
+                }, status=404)
+
+            if department:
+                response = web.json_response({
+                    "success": True,
+                    "user": user,
+                    "department": department,
+                    "balance": result
+                })
+            else:
+                response = web.json_response({
+                    "success": True,
+                    "user": user,
+                    "balances": [{"department": row[0], "balance": row[1]} for row in result]
+                })
+            response.etag = etag
+            return response
+        except Exception as e:
+            return self.error_response("查询余额", e)
+
+    async def get_balance_batch(self, request):
+        try:
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+            data = data if isinstance(data, dict) else {}
+            # 支持 {"items": [{"user": ..., "department": ...}]} 或 {"users": [...]}
+            items = data.get('items')
+            if items is None:
+                items = [{"user": user} for user in data.get('users', [])]
+
+            if not isinstance(items, list) or not items:
+                return web.json_response({
+                    "success": False,
+                    "message": "请提供items或users参数"
+                }, status=400)
+            if len(items) > BATCH_LOOKUP_LIMIT:
+                return web.json_response({
+                    "success": False,
+                    "message": f"单次最多查询{BATCH_LOOKUP_LIMIT}个用户"
+                }, status=400)
+
+            keys = []
+            for item in items:
+                if not isinstance(item, dict) or not item.get('user'):
+                    return web.json_response({
+                        "success": False,
+                        "message": "每一项都需要提供user"
+                    }, status=400)
+                keys.append((str(item['user']), str(item['department']) if item.get('department') else None))
+
+            etag = self.balance_manager.balance_etag('batch', json.dumps(keys, ensure_ascii=False))
+            if self.etag_matches(request, etag):
+                return self.not_modified(etag)
+
+            found = await self.lookup_balances(keys)
+            results = []
+            for user, department in keys:
+                result = found[(user, department)]
+                if department:
+                    results.append({
+                        "user": user,
+                        "department": department,
+                        "found": result is not None,
+                        "balance": result
+                    })
+                else:
+                    results.append({
+                        "user": user,
+                        "found": bool(result),
+                        "balances": [{"department": row[0], "balance": row[1]} for row in result]
+                    })
+
+            response = web.json_response({
+                "success": True,
+                "results": results
+            })
+            response.etag = etag
+            return response
+        except Exception as e:
+            return self.error_response("批量查询余额", e)
+
+    async def adjust_balance(self, request):
+        try:
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+            data = data if isinstance(data, dict) else {}
+            user = data.get('user')
+            department = data.get('department')
+            amount = data.get('amount')
+
+            if not user or not department or not isinstance(amount, int) or isinstance(amount, bool):
+                return web.json_response({
+                    "success": False,
+                    "message": "请提供user、department和整数amount参数"
+                }, status=400)
+
+            balance = await self.run_write(
+                self.balance_manager.adjust_balance, user, department, amount, data.get('reason')
+            )
+            return web.json_response({
+                "success": True,
+                "user": user,
+                "department": department,
+                "balance": balance
+            })
+        except ValueError as e:
+            return web.json_response({
+                "success": False,
+                "message": str(e)
+            }, status=400)
+        except Exception as e:
+            return self.error_response("调整余额", e)
+
+    async def ledger_summary(self, request):
+        try:
+            department = request.query.get('department')
+            start = request.query.get('start')
+            end = request.query.get('end')
+
+            if not department or not start or not end:
+                return web.json_response({
+                    "success": False,
+                    "message": "请提供department、start和end参数"
+                }, status=400)
+
+            entry_type = request.query.get('type', LEDGER_MEAL)
+            user = request.query.get('user')
+            sql, params = self.balance_manager.ledger_summary_query(department, start, end, entry_type, user)
+            count, amount = (await self.fetchall(sql, params))[0]
+            return web.json_response({
+                "success": True, "department": department, "entry_type": entry_type, "start": start,
+                "end": end, "user": user, "count": count, "amount": amount
+            })
+        except Exception as e:
+            return self.error_response("统计流水", e)
+
+    async def tick_runs(self, request):
+        try:
+            sql, params = self.balance_manager.tick_runs_query(
+                start=request.query.get('start'),
+                end=request.query.get('end'),
+                time_point=request.query.get('time_point')
+            )
+            runs = self.balance_manager.format_tick_runs(await self.fetchall(sql, params))
+            return web.json_response({
+                "success": True,
+                "count": len(runs),
+                "runs": runs
+            })
+        except Exception as e:
+            return self.error_response("查询余额检查执行记录", e)
+
+    async def low_balance(self, request):
+        try:
+            days = query_arg(request, 'days', float)
+            sql, params = self.balance_manager.low_balance_query(
+                days=days,
+                department=request.query.get('department'),
+                limit=query_arg(request, 'limit', int)
+            )
+            users = self.balance_manager.format_low_balance(await self.fetchall(sql, params))
+            return web.json_response({
+                "success": True,
+                "days": self.balance_manager.low_balance_days if days is None else days,
+                "count": len(users),
+                "users": users
+            })
+        except Exception as e:
+            return self.error_response("查询余额不足用户", e)
+
+    async def metrics(self, request):
+        response = web.Response(body=prom.generate_latest())
+        response.headers['Content-Type'] = prom.CONTENT_TYPE_LATEST
+        return response
+
+    async def sync_zero(self, request):
+        try:
+            await self.run_write(self.balance_manager.sync_zero_balance_users)
+            return web.json_response({
+                "success": True,
+                "message": "余额为0的用户状态同步已完成"
+            })
+        except Exception as e:
+            return self.error_response("同步余额为0的用户", e)
+
+    def start(self):
+        """在当前线程运行事件循环，直到收到中断信号"""
+        logger.info(f"异步API服务器启动在 {self.host}:{self.port}")
+        web.run_app(self.app, host=self.host, port=self.port, print=None)
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='余额管理系统（异步运行方式）')
+    parser.add_argument('-p', '--port', type=int, default=5555, help='API服务器端口 (默认: 5555)')
+    parser.add_argument('-e', '--excel-dir', type=str, default=EXCEL_DIR, help=f'Excel文件目录 (默认: {EXCEL_DIR})')
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help=f'批处理大小 (默认: {BATCH_SIZE})')
+    parser.add_argument('--delete-missing', action='store_true', help='导入时删除新表格中已不存在的余额记录')
+    parser.add_argument('--low-balance-days', type=int, default=LOW_BALANCE_DAYS,
+                        help=f'预计多少天内用完视为余额不足 (默认: {LOW_BALANCE_DAYS})')
+    parser.add_argument('--reject-unknown-users', action='store_true',
+                        help='导入时拒绝kbk_ic_manager中不存在或部门不一致的用户行')
+    parser.add_argument('--pool-size', type=int, default=READ_POOL_SIZE,
+                        help=f'数据库连接池大小 (默认: {READ_POOL_SIZE})')
+    args = parser.parse_args()
+
+    logger.info("余额管理系统（异步运行方式）启动中...")
+    # 写操作都在写线程中执行，不需要BalanceManager自己的线程池
+    manager = BalanceManager(
+        excel_folder=args.excel_dir,
+        batch_size=args.batch_size,
+        max_workers=1,
+        delete_missing=args.delete_missing,
+        low_balance_days=args.low_balance_days,
+        reject_unknown_users=args.reject_unknown_users
+    )
+    try:
+        AsyncBalanceServer(manager, port=args.port, pool_size=args.pool_size).start()
+    except Exception as e:
+        logger.error(f"系统运行时出错: {str(e)}")
+        logger.error(traceback.format_exc())
+    finally:
+        manager.cleanup()
+        logger.info("余额管理系统已关闭")
+
+
+if __name__ == "__main__":
+    main()
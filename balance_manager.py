@@ -9,20 +9,31 @@ import time
 import threading
 import sqlite3
 import logging
+import numpy as np
 import pandas as pd
+import prometheus_client as prom
 import schedule
 import watchdog.observers
 import watchdog.events
-from datetime import datetime
+from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
 import traceback
 import hashlib
+import itertools
 import json
+import uuid
+import socket
+from collections import OrderedDict
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from concurrent.futures import ThreadPoolExecutor
 import argparse
 
+from file_ingest import ExcelIngestDebouncer, is_excel_event_path
+from db_pool import SqliteReadPool
+import wsgi_server
+import swipe_facts
+
 # 配置日志
 def setup_logging():
     """设置日志系统"""
@@ -62,6 +73,25 @@ DB_PATH = './ic_manager.db'
 EXCEL_DIR = './excel_balance'
 BATCH_SIZE = 100
 MAX_WORKERS = 4
+FILE_SETTLE_SECONDS = 2.0  # Excel文件保持不变多少秒后才导入
+BALANCE_CACHE_TTL = 30  # 余额查询缓存的有效秒数
+BALANCE_CACHE_SIZE = 10000  # 余额查询缓存的最大条目数
+READ_POOL_SIZE = 4  # 只读连接池大小
+BATCH_LOOKUP_LIMIT = 1000  # 批量查询单次最多的用户数
+
+FORECAST_WINDOW_DAYS = 14  # 按最近多少天的刷卡次数估算消耗速度
+LOW_BALANCE_DAYS = 3  # 预计多少天内用完视为余额不足
+COUNT_TABLES = ['kbk_ic_en_count', 'kbk_ic_cn_count', 'kbk_ic_nm_count']
+MAX_REPLAY_DAYS = 7  # 启动时最多补跑最近几天内错过的余额检查
+REJECT_FOLDER = 'rejected'  # 导入校验报告存放在Excel目录下的子目录
+
+LOW_BALANCE_USERS = prom.Gauge('balance_low_users', '预计N天内余额用完的用户数', ['days'])
+
+# 余额流水类型
+LEDGER_OPENING = 'opening'  # 启用流水时的期初余额
+LEDGER_TOPUP = 'topup'      # 导入表格带来的余额变化
+LEDGER_MEAL = 'meal'        # 各时间点的用餐扣减
+LEDGER_ADJUST = 'adjust'    # 手工调整（含导入时删除记录）
 
 # 指定的时间点
 TIME_POINTS = {
@@ -70,35 +100,122 @@ TIME_POINTS = {
     "c": "16:55"
 }
 
+def next_tick_slot(now):
+    """返回now之后的下一个余额检查时间点 (run_date, time_point, 时间)"""
+    for offset in (0, 1):
+        day = now.date() + timedelta(days=offset)
+        for point, time_value in sorted(TIME_POINTS.items(), key=lambda item: item[1]):
+            slot = datetime.strptime(f"{day} {time_value}", '%Y-%m-%d %H:%M')
+            if slot > now:
+                return day.strftime('%Y-%m-%d'), point, slot
+
+def normalize_text_column(series):
+    """
+    向量化地统一文本列：整数形式的浮点数去掉".0"，全角转半角（NFKC），
+    去掉首尾空白并合并连续空白，空字符串视为缺失
+    """
+    text = series.astype('string')
+    if pd.api.types.is_float_dtype(series):
+        text = text.str.replace(r'^(-?\d+)\.0$', r'\1', regex=True)
+    text = text.str.normalize('NFKC').str.strip().str.replace(r'\s+', ' ', regex=True)
+    text = text.mask(text.eq('').fillna(False))
+    return text.astype(object).where(text.notna(), None)
+
+class TTLCache:
+    """
+    线程安全的TTL + LRU缓存，超过有效期或容量时淘汰
+    条目可以带数据版本，查询时版本不一致视为未命中（避免在失效之前读到的旧值在失效之后写入缓存）
+    """
+    
+    def __init__(self, maxsize=BALANCE_CACHE_SIZE, ttl=BALANCE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, key, version=None):
+        """返回 (是否命中, 值)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > time.monotonic() and item[2] == version:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, None
+            
+    def set(self, key, value, version=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value, version)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            
+    def __len__(self):
+        return len(self._data)
+
 class ExcelFileHandler(watchdog.events.FileSystemEventHandler):
-    """监控Excel文件变化的处理器"""
+    """监控Excel文件变化的处理器，事件交给去抖动阶段合并"""
     
     def __init__(self, balance_manager):
         self.balance_manager = balance_manager
         super().__init__()
         
     def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith('.xlsx'):
+        if not event.is_directory and is_excel_event_path(event.src_path):
             logger.info(f"检测到新文件: {event.src_path}")
-            self.balance_manager.check_new_excel()
+            self.balance_manager.excel_ingest.submit(event.src_path)
             
     def on_modified(self, event):
-        if not event.is_directory and event.src_path.endswith('.xlsx'):
-            logger.info(f"检测到文件修改: {event.src_path}")
-            if self.balance_manager.latest_excel and event.src_path.endswith(self.balance_manager.latest_excel):
-                logger.info(f"当前使用的文件已修改，重新加载文件: {self.balance_manager.latest_excel}")
-                self.balance_manager.reload_excel()
+        if not event.is_directory and is_excel_event_path(event.src_path):
+            logger.debug(f"检测到文件修改: {event.src_path}")
+            self.balance_manager.excel_ingest.submit(event.src_path)
+            
+    def on_moved(self, event):
+        if not event.is_directory and is_excel_event_path(event.dest_path):
+            logger.info(f"检测到文件移入: {event.dest_path}")
+            self.balance_manager.excel_ingest.submit(event.dest_path)
 
 class BalanceManager:
     """余额管理系统核心类"""
     
-    def __init__(self, excel_folder=EXCEL_DIR, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS):
-        """初始化余额管理系统"""
+    def __init__(self, excel_folder=EXCEL_DIR, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS,
+                 settle_seconds=FILE_SETTLE_SECONDS, delete_missing=False,
+                 forecast_window_days=FORECAST_WINDOW_DAYS, low_balance_days=LOW_BALANCE_DAYS,
+                 reject_unknown_users=False):
+        """
+        初始化余额管理系统
+        delete_missing: 增量导入时是否删除新表格中已不存在的 (user, department) 余额记录
+        forecast_window_days: 估算消耗速度使用的最近天数
+        low_balance_days: 预计在这么多天内用完的用户计入余额不足
+        reject_unknown_users: 导入时是否拒绝kbk_ic_manager中不存在的 (user, department)，否则只在报告中提示
+        """
         self.excel_folder = excel_folder
         self.latest_excel = None
         self.current_file_hash = None
         self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        self.excel_ingest = None
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # kbk_ic_balance上存在 (user, department) 唯一索引时使用UPSERT导入
+        self.upsert_supported = False
+        self.delete_missing = delete_missing
+        self.forecast_window_days = forecast_window_days
+        self.low_balance_days = low_balance_days
+        self.reject_unknown_users = reject_unknown_users
+        # 余额查询缓存和只读连接池；数据版本在导入、余额检查和调整后递增，用于缓存失效和ETag
+        self.balance_cache = TTLCache()
+        self.read_pool = None
+        self._data_version = 0
+        self._boot_id = uuid.uuid4().hex[:8]
         
         # 健康状态
         self.health_status = {
@@ -147,6 +264,99 @@ class BalanceManager:
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_department ON kbk_ic_balance(department)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_user_dept ON kbk_ic_balance(user, department)")
             
+            # 增量导入：上一次导入的表格快照和导入历史
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS kbk_ic_balance_snapshot (
+                    user TEXT NOT NULL,
+                    department TEXT NOT NULL,
+                    balance INTEGER NOT NULL,
+                    PRIMARY KEY (user, department)
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS kbk_ic_balance_import_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_name TEXT NOT NULL,
+                    file_hash TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    total_rows INTEGER NOT NULL DEFAULT 0,
+                    added INTEGER NOT NULL DEFAULT 0,
+                    changed INTEGER NOT NULL DEFAULT 0,
+                    unchanged INTEGER NOT NULL DEFAULT 0,
+                    removed INTEGER NOT NULL DEFAULT 0,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    duration_ms INTEGER NOT NULL DEFAULT 0,
+                    imported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # 只追加的余额流水，kbk_ic_balance.balance为其按 (user, department) 汇总的物化结果
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS kbk_ic_balance_ledger (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user TEXT NOT NULL,
+                    department TEXT NOT NULL,
+                    entry_type TEXT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    time_point TEXT,
+                    source TEXT,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_ledger_dept_type_time ON kbk_ic_balance_ledger(department, entry_type, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_ledger_user_dept_time ON kbk_ic_balance_ledger(user, department, created_at)")
+            # 首次启用流水时，把现有余额记为期初
+            cursor.execute("SELECT 1 FROM kbk_ic_balance_ledger LIMIT 1")
+            if not cursor.fetchone():
+                cursor.execute(
+                    '''INSERT INTO kbk_ic_balance_ledger (user, department, entry_type, amount, source, created_at)
+                       SELECT user, department, ?, balance, 'opening', ? FROM kbk_ic_balance WHERE balance != 0''',
+                    (LEDGER_OPENING, self.get_local_timestamp())
+                )
+            
+            # 余额检查执行记录，(run_date, time_point) 唯一，保证每个时间点每天只扣减一次
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS kbk_ic_balance_tick_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_date TEXT NOT NULL,
+                    time_point TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    runner TEXT,
+                    counts TEXT,
+                    started_at TIMESTAMP NOT NULL,
+                    finished_at TIMESTAMP,
+                    UNIQUE (run_date, time_point)
+                )
+            """)
+            
+            # 余额预测结果，每次余额检查后整体重算
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS kbk_ic_balance_forecast (
+                    user TEXT NOT NULL,
+                    department TEXT NOT NULL,
+                    balance INTEGER NOT NULL,
+                    meals_per_day REAL NOT NULL,
+                    days_left REAL,
+                    exhaust_date TEXT,
+                    computed_at TIMESTAMP NOT NULL,
+                    PRIMARY KEY (user, department)
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_forecast_days_left ON kbk_ic_balance_forecast(days_left)")
+            
+            # UPSERT导入依赖 (user, department) 唯一索引（见V3迁移），存在重复记录时退回逐行导入
+            try:
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_kbk_ic_balance_user_dept ON kbk_ic_balance(user, department)")
+                self.upsert_supported = True
+            except sqlite3.IntegrityError:
+                self.upsert_supported = False
+                logger.warning("kbk_ic_balance存在重复的 (user, department) 记录，无法创建唯一索引，导入将使用逐行方式，请先执行V3迁移")
+            
+            # 余额检查按 (user, department) 关联kbk_ic_manager，需要对应的复合索引
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'kbk_ic_manager'")
+            if cursor.fetchone():
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_kbk_ic_manager_user_dept ON kbk_ic_manager(user, department)")
+            
             conn.commit()
             conn.close()
             logger.info("数据库结构检查/初始化完成")
@@ -157,6 +367,9 @@ class BalanceManager:
     
     def start_file_monitoring(self):
         """启动文件监控"""
+        self.excel_ingest = ExcelIngestDebouncer(
+            self.on_excel_settled, name='balance', settle_seconds=self.settle_seconds, logger=logger
+        )
         self.event_handler = ExcelFileHandler(self)
         self.observer = watchdog.observers.Observer()
         self.observer.schedule(self.event_handler, self.excel_folder, recursive=False)
@@ -184,8 +397,16 @@ class BalanceManager:
         except ValueError:
             return False
     
-    def check_new_excel(self):
-        """检查是否有新的Excel文件"""
+    def on_excel_settled(self, file_path, file_hash):
+        """余额文件稳定并校验通过后的导入回调"""
+        if self.latest_excel and os.path.basename(file_path) == self.latest_excel:
+            logger.info(f"当前使用的文件已修改，重新加载文件: {self.latest_excel}")
+            self.reload_excel(file_hash=file_hash)
+        else:
+            self.check_new_excel(known_hashes={file_path: file_hash})
+    
+    def check_new_excel(self, known_hashes=None):
+        """检查是否有新的Excel文件，known_hashes为已计算过的 {路径: 哈希}"""
         try:
             excel_files = [f for f in os.listdir(self.excel_folder) 
                           if f.endswith('.xlsx') and self._is_date_format(f.split('.')[0])]
@@ -199,8 +420,8 @@ class BalanceManager:
             newest_file = excel_files[0]
             newest_file_path = os.path.join(self.excel_folder, newest_file)
             
-            # 计算文件哈希值
-            new_hash = self.get_file_hash(newest_file_path)
+            # 计算文件哈希值（去抖动阶段已计算过的直接复用）
+            new_hash = (known_hashes or {}).get(newest_file_path) or self.get_file_hash(newest_file_path)
             
             # 如果是新文件或文件内容有变化
             if self.latest_excel != newest_file or self.current_file_hash != new_hash:
@@ -211,7 +432,7 @@ class BalanceManager:
                 
                 # Excel文件已更新，立即触发一次导入
                 logger.info("Excel文件已更新，立即导入到数据库")
-                self.import_excel_to_db(newest_file_path)
+                self.import_excel_to_db(newest_file_path, file_hash=new_hash)
                 
         except Exception as e:
             logger.error(f"检查新Excel文件时出错: {str(e)}")
@@ -223,8 +444,8 @@ class BalanceManager:
             })
             self.health_status["status"] = "warning"
     
-    def reload_excel(self):
-        """重新加载当前Excel文件"""
+    def reload_excel(self, file_hash=None):
+        """重新加载当前Excel文件，file_hash为已计算过的哈希值"""
         if not self.latest_excel:
             return
             
@@ -232,7 +453,7 @@ class BalanceManager:
             file_path = os.path.join(self.excel_folder, self.latest_excel)
             
             # 计算新的哈希值
-            new_hash = self.get_file_hash(file_path)
+            new_hash = file_hash or self.get_file_hash(file_path)
             
             # 如果文件内容有变化，更新
             if self.current_file_hash != new_hash:
@@ -240,18 +461,31 @@ class BalanceManager:
                 self.current_file_hash = new_hash
                 
                 # 执行导入
-                self.import_excel_to_db(file_path)
+                self.import_excel_to_db(file_path, file_hash=new_hash)
                 
         except Exception as e:
             logger.error(f"重新加载Excel文件时出错: {str(e)}")
             logger.error(traceback.format_exc())
     
-    def import_excel_to_db(self, file_path):
-        """导入Excel文件到数据库"""
+    def import_excel_to_db(self, file_path, file_hash=None):
+        """
+        增量导入Excel文件到数据库
+        与上一次导入的表格快照比较，只写入新增和变化的记录（可选删除已移除的记录），
+        文件哈希与快照相同时直接跳过；每次导入的差异摘要记录到kbk_ic_balance_import_history，
+        返回差异摘要
+        """
         try:
             logger.info(f"开始导入Excel文件: {file_path}")
             start_time = time.time()
             
+            file_hash = file_hash or self.get_file_hash(file_path)
+            file_name = os.path.basename(file_path)
+            
+            # 与上一次导入的文件内容相同时无需读取和写入
+            skipped = self.skip_unchanged_import(file_name, file_hash, start_time)
+            if skipped is not None:
+                return skipped
+            
             # 读取Excel文件
             df = pd.read_excel(file_path)
             
@@ -268,16 +502,22 @@ class BalanceManager:
                 })
                 return
             
-            # 清理数据
-            df = df.dropna(subset=['user', 'department'])  # 删除关键字段为空的行
-            df['balance'] = df['balance'].fillna(0).astype(int)  # 余额为空用0填充并转为整型
-            
-            # 按批次处理数据
-            records = df.to_dict('records')
-            batches = [records[i:i+self.batch_size] for i in range(0, len(records), self.batch_size)]
-            
-            total_updated = 0
-            total_inserted = 0
+            # 校验并规范化，问题行隔离到报告文件中，不影响其余行导入
+            sheet_rows = len(df)
+            df, report = self.validate_balance_sheet(df)
+            report_path = self.write_rejection_report(file_name, report) if len(report) else None
+            rejected = report[report['action'] == 'rejected']
+            # 被拒绝的行不代表该用户已从表格中移除，不能按"已移除"删除其余额
+            protected_keys = set(zip(rejected['user'].tolist(), rejected['department'].tolist()))
+            if sheet_rows and not len(df):
+                error_msg = f"Excel文件没有通过校验的行，已跳过导入，详见: {report_path}"
+                logger.error(error_msg)
+                self.health_status["errors"].append({
+                    "time": datetime.now().isoformat(),
+                    "type": "import_validation",
+                    "message": error_msg
+                })
+                return
             
             conn = sqlite3.connect(DB_PATH)
             cursor = conn.cursor()
@@ -286,52 +526,77 @@ class BalanceManager:
                 # 使用事务处理，确保原子性
                 conn.execute('BEGIN TRANSACTION')
                 
-                # 处理每个批次
-                for batch in batches:
-                    for record in batch:
-                        user = record['user']
-                        department = record['department']
-                        balance = record['balance']
-                        
-                        # 检查记录是否已存在
-                        cursor.execute(
-                            'SELECT id FROM kbk_ic_balance WHERE user = ? AND department = ?', 
-                            (user, department)
-                        )
-                        result = cursor.fetchone()
-                        
-                        if result:
-                            # 更新已存在的记录
-                            local_time = self.get_local_timestamp()
-                            cursor.execute(
-                                '''UPDATE kbk_ic_balance 
-                                   SET balance = ?, updated_at = ? 
-                                   WHERE user = ? AND department = ?''', 
-                                (balance, local_time, user, department)
-                            )
-                            total_updated += 1
-                        else:
-                            # 插入新记录
-                            local_time = self.get_local_timestamp()
-                            cursor.execute(
-                                '''INSERT INTO kbk_ic_balance 
-                                   (user, department, balance, created_at, updated_at) 
-                                   VALUES (?, ?, ?, ?, ?)''', 
-                                (user, department, balance, local_time, local_time)
-                            )
-                            total_inserted += 1
+                summary = {
+                    "file_name": file_name,
+                    "file_hash": file_hash,
+                    "mode": "incremental",
+                    "total_rows": len(df),
+                    "added": 0,
+                    "changed": 0,
+                    "unchanged": 0,
+                    "removed": 0,
+                    "deleted": 0,
+                    "rejected": len(rejected),
+                    "warnings": len(report) - len(rejected),
+                    "report": report_path
+                }
+                
+                diff = self.diff_balance_snapshot(cursor, df)
+                summary.update({key: diff[key] for key in ("added", "changed", "unchanged")})
+                
+                if swipe_facts.dimensions_available(conn):
+                    # 余额表中的用户和部门登记到维表，与名单导入共用同一套整数id
+                    swipe_facts.register_dimensions(cursor, df['user'].tolist(), df['department'].tolist())
+                
+                upserts = diff["upserts"]
+                if len(upserts):
+                    # 先按旧余额记录流水，再写入新余额
+                    self.record_import_ledger(cursor, upserts, file_name)
+                    if self.upsert_supported:
+                        self.upsert_balance_rows(cursor, upserts)
+                    else:
+                        self.import_balance_rows(cursor, upserts)
+                
+                removed_keys = [
+                    key for key in zip(diff["removed"]['user'].tolist(), diff["removed"]['department'].tolist())
+                    if key not in protected_keys
+                ]
+                summary["removed"] = len(removed_keys)
+                if removed_keys and self.delete_missing:
+                    cursor.executemany(
+                        '''INSERT INTO kbk_ic_balance_ledger (user, department, entry_type, amount, source, created_at)
+                           SELECT user, department, ?, -balance, ?, ? FROM kbk_ic_balance
+                           WHERE user = ? AND department = ? AND balance != 0''',
+                        [(LEDGER_ADJUST, f"删除:{file_name}", self.get_local_timestamp(), user, department)
+                         for user, department in removed_keys]
+                    )
+                    cursor.executemany(
+                        'DELETE FROM kbk_ic_balance WHERE user = ? AND department = ?', removed_keys
+                    )
+                    summary["deleted"] = len(removed_keys)
+                
+                self.apply_snapshot_diff(cursor, upserts, removed_keys)
+                
+                summary["duration_ms"] = int((time.time() - start_time) * 1000)
+                self.record_import_history(cursor, summary)
                 
                 # 提交事务
                 conn.commit()
                 
                 process_time = time.time() - start_time
-                logger.info(f"Excel导入完成，新增: {total_inserted}条，更新: {total_updated}条，耗时: {process_time:.2f}秒")
+                logger.info(f"Excel导入完成({summary['mode']})，共{summary['total_rows']}行，新增: {summary['added']}条，"
+                          f"变化: {summary['changed']}条，未变: {summary['unchanged']}条，移除: {summary['removed']}条"
+                          f"(删除 {summary['deleted']}条)，拒绝: {summary['rejected']}条，提示: {summary['warnings']}条，"
+                          f"耗时: {process_time:.2f}秒")
+                
+                self.invalidate_balance_cache()
                 
                 # 更新健康状态
                 self.health_status["last_import"] = datetime.now().isoformat()
                 self.health_status["status"] = "healthy"
                 
                 # 移除自动触发余额检查，仅在预定时间点执行
+                return summary
                 
             except Exception as e:
                 conn.rollback()
@@ -357,6 +622,534 @@ class BalanceManager:
             })
             self.health_status["status"] = "error"
     
+    def validate_balance_sheet(self, df):
+        """
+        向量化校验并规范化余额表，返回 (可导入的行, 问题行报告)
+        可导入的行为 user/department/balance 三列；报告每行包含Excel行号、原始值、原因和处理方式
+        (rejected: 隔离不导入，warning: 照常导入仅提示)
+        规则：用户或部门为空、余额不是非负整数、同一 (user, department) 出现多行且余额不一致时整组拒绝，
+        余额一致的重复行只保留第一行；与kbk_ic_manager一次合并，找出不存在的用户和部门不一致的行
+        """
+        sheet = pd.DataFrame({
+            'row': df.index + 2,  # Excel行号（第1行为表头）
+            'user': normalize_text_column(df['user']),
+            'department': normalize_text_column(df['department'])
+        })
+        raw_balance = df['balance']
+        if pd.api.types.is_numeric_dtype(raw_balance):
+            balance_text = raw_balance
+        else:
+            balance_text = normalize_text_column(raw_balance)
+        balance = pd.to_numeric(balance_text, errors='coerce')
+        
+        missing_key = sheet['user'].isna() | sheet['department'].isna()
+        not_number = balance_text.notna() & balance.isna()
+        balance = balance.fillna(0)  # 余额为空视为0
+        not_integer = balance % 1 != 0
+        negative = balance < 0
+        sheet['balance'] = balance
+        
+        keyed = ~missing_key
+        duplicated = keyed & sheet.duplicated(['user', 'department'], keep=False)
+        distinct = sheet[keyed].groupby(['user', 'department'])['balance'].transform('nunique')
+        conflict = duplicated & distinct.reindex(sheet.index, fill_value=1).gt(1)
+        repeated = keyed & ~conflict & sheet.duplicated(['user', 'department'], keep='first')
+        
+        # 与kbk_ic_manager一次合并：同时得到 (user, department) 是否存在、user是否在其他部门存在
+        unknown_user = pd.Series(False, index=sheet.index)
+        wrong_department = pd.Series(False, index=sheet.index)
+        with self.get_read_pool().acquire() as conn:
+            has_managers = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'kbk_ic_manager'"
+            ).fetchone()
+            managers = pd.read_sql_query(
+                'SELECT DISTINCT user, department, 1 AS in_department FROM kbk_ic_manager', conn
+            ) if has_managers else None
+        if managers is not None and len(managers):
+            known_users = managers[['user']].drop_duplicates().assign(in_users=1)
+            matched = sheet[['user', 'department']].merge(
+                managers, on=['user', 'department'], how='left'
+            ).merge(known_users, on='user', how='left')
+            matched.index = sheet.index
+            unknown_user = keyed & matched['in_users'].isna()
+            wrong_department = keyed & matched['in_users'].notna() & matched['in_department'].isna()
+        
+        reasons = np.select(
+            [missing_key, not_number, not_integer, negative, conflict, repeated, wrong_department, unknown_user],
+            ['用户或部门为空', '余额不是数字', '余额不是整数', '余额为负数', '重复的用户行且余额不一致',
+             '重复的用户行', '部门与kbk_ic_manager不一致', 'kbk_ic_manager中不存在该用户'],
+            default=''
+        )
+        flagged = reasons != ''
+        if self.reject_unknown_users:
+            rejected = flagged
+        else:
+            rejected = missing_key | not_number | not_integer | negative | conflict | repeated
+        
+        report = pd.DataFrame({
+            'row': sheet['row'],
+            'user': sheet['user'],
+            'department': sheet['department'],
+            'balance': raw_balance,
+            'reason': reasons,
+            'action': np.where(rejected, 'rejected', 'warning')
+        })[flagged]
+        valid = sheet.loc[~rejected, ['user', 'department', 'balance']].astype({'balance': 'int64'})
+        if len(report):
+            logger.warning(f"余额表校验: 拒绝 {int(rejected.sum())} 行，提示 {int(flagged.sum() - rejected.sum())} 行")
+        return valid.reset_index(drop=True), report.reset_index(drop=True)
+    
+    def write_rejection_report(self, file_name, report):
+        """把校验报告写入Excel目录下的rejected子目录（CSV，带BOM便于Excel打开），返回文件路径"""
+        folder = os.path.join(self.excel_folder, REJECT_FOLDER)
+        os.makedirs(folder, exist_ok=True)
+        report_path = os.path.join(folder, f"{os.path.splitext(file_name)[0]}.rejected.csv")
+        report.to_csv(report_path, index=False, encoding='utf-8-sig')
+        logger.warning(f"余额表校验报告已写入: {report_path}")
+        return report_path
+    
+    def record_import_ledger(self, cursor, upserts, file_name):
+        """按导入前的余额为新增和变化的行追加流水（金额为新旧余额之差），返回流水条数"""
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS temp_balance_import (user TEXT, department TEXT, balance INTEGER)")
+        cursor.execute("DELETE FROM temp_balance_import")
+        cursor.executemany(
+            "INSERT INTO temp_balance_import (user, department, balance) VALUES (?, ?, ?)",
+            zip(upserts['user'].tolist(), upserts['department'].tolist(), upserts['balance'].tolist())
+        )
+        cursor.execute(
+            '''INSERT INTO kbk_ic_balance_ledger (user, department, entry_type, amount, source, created_at)
+               SELECT t.user, t.department, ?, t.balance - COALESCE(b.balance, 0), ?, ?
+               FROM temp_balance_import t
+               LEFT JOIN kbk_ic_balance b ON b.user = t.user AND b.department = t.department
+               WHERE t.balance != COALESCE(b.balance, 0)''',
+            (LEDGER_TOPUP, file_name, self.get_local_timestamp())
+        )
+        return cursor.rowcount
+        
+    def adjust_balance(self, user, department, amount, reason=None):
+        """手工调整余额：追加一条流水并增量更新物化余额，返回调整后的余额"""
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN TRANSACTION')
+            local_time = self.get_local_timestamp()
+            cursor.execute(
+                'SELECT balance FROM kbk_ic_balance WHERE user = ? AND department = ?', (user, department)
+            )
+            row = cursor.fetchone()
+            new_balance = (row[0] if row else 0) + amount
+            if new_balance < 0:
+                raise ValueError(f"调整后余额不能为负数: {user}, {department}, {new_balance}")
+            
+            if row:
+                cursor.execute(
+                    'UPDATE kbk_ic_balance SET balance = ?, updated_at = ? WHERE user = ? AND department = ?',
+                    (new_balance, local_time, user, department)
+                )
+            else:
+                cursor.execute(
+                    '''INSERT INTO kbk_ic_balance (user, department, balance, created_at, updated_at)
+                       VALUES (?, ?, ?, ?, ?)''',
+                    (user, department, new_balance, local_time, local_time)
+                )
+            cursor.execute(
+                '''INSERT INTO kbk_ic_balance_ledger (user, department, entry_type, amount, source, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (user, department, LEDGER_ADJUST, amount, reason or 'manual', local_time)
+            )
+            conn.commit()
+            self.invalidate_balance_cache()
+            logger.info(f"手工调整余额: {user}, {department}, {amount:+d}, 调整后: {new_balance}")
+            return new_balance
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+            
+    def ledger_summary_query(self, department, start, end, entry_type=LEDGER_MEAL, user=None):
+        """
+        统计部门在 [start, end) 时间范围内某类流水的条数和金额合计的 (sql, params)
+        走 (department, entry_type, created_at) 索引，例如本月某部门的用餐次数
+        """
+        sql = '''SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM kbk_ic_balance_ledger
+                 WHERE department = ? AND entry_type = ? AND created_at >= ? AND created_at < ?'''
+        params = [department, entry_type, start, end]
+        if user:
+            sql += ' AND user = ?'
+            params.append(user)
+        return sql, params
+        
+    def ledger_summary(self, department, start, end, entry_type=LEDGER_MEAL, user=None):
+        """统计部门在 [start, end) 时间范围内某类流水的条数和金额合计"""
+        sql, params = self.ledger_summary_query(department, start, end, entry_type, user)
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            count, amount = conn.execute(sql, params).fetchone()
+        finally:
+            conn.close()
+        return {"department": department, "entry_type": entry_type, "start": start, "end": end,
+                "user": user, "count": count, "amount": amount}
+        
+    def check_ledger_consistency(self):
+        """核对物化余额与流水汇总，返回不一致的 (user, department, balance, 流水合计) 列表"""
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            return conn.execute(
+                '''SELECT b.user, b.department, b.balance, COALESCE(l.total, 0)
+                   FROM kbk_ic_balance b
+                   LEFT JOIN (
+                       SELECT user, department, SUM(amount) AS total
+                       FROM kbk_ic_balance_ledger GROUP BY user, department
+                   ) l ON l.user = b.user AND l.department = b.department
+                   WHERE b.balance != COALESCE(l.total, 0)'''
+            ).fetchall()
+        finally:
+            conn.close()
+        
+    def skip_unchanged_import(self, file_name, file_hash, start_time):
+        """文件哈希与快照相同时记录一次跳过的导入并返回摘要，否则返回None"""
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            cursor = conn.cursor()
+            # 最近一次导入的文件即当前快照对应的文件
+            cursor.execute('SELECT file_hash, total_rows FROM kbk_ic_balance_import_history ORDER BY id DESC LIMIT 1')
+            row = cursor.fetchone()
+            if not row or row[0] != file_hash:
+                return None
+            summary = {
+                "file_name": file_name,
+                "file_hash": file_hash,
+                "mode": "skipped",
+                "total_rows": row[1],
+                "added": 0,
+                "changed": 0,
+                "unchanged": row[1],
+                "removed": 0,
+                "deleted": 0,
+                "duration_ms": int((time.time() - start_time) * 1000)
+            }
+            self.record_import_history(cursor, summary)
+            conn.commit()
+        finally:
+            conn.close()
+        logger.info(f"文件内容与上一次导入相同，跳过导入: {file_name}")
+        self.health_status["last_import"] = datetime.now().isoformat()
+        return summary
+        
+    def diff_balance_snapshot(self, cursor, df):
+        """
+        向量化比较新表格与快照
+        返回 upserts(新增和变化的行)、removed(快照中有而新表格中没有的键)以及added/changed/unchanged计数
+        """
+        cursor.execute('SELECT user, department, balance FROM kbk_ic_balance_snapshot')
+        snapshot = pd.DataFrame(cursor.fetchall(), columns=['user', 'department', 'balance'])
+        
+        merged = df.merge(snapshot, on=['user', 'department'], how='outer', suffixes=('', '_old'), indicator=True)
+        added = merged['_merge'] == 'left_only'
+        removed = merged['_merge'] == 'right_only'
+        both = merged['_merge'] == 'both'
+        changed = both & (merged['balance'] != merged['balance_old'])
+        
+        upserts = merged.loc[added | changed, ['user', 'department', 'balance']]
+        upserts = upserts.astype({'balance': 'int64'})
+        return {
+            "upserts": upserts,
+            "removed": merged.loc[removed, ['user', 'department']],
+            "added": int(added.sum()),
+            "changed": int(changed.sum()),
+            "unchanged": int((both & ~changed).sum())
+        }
+        
+    def apply_snapshot_diff(self, cursor, upserts, removed_keys):
+        """把本次差异应用到快照表，使快照与新表格一致"""
+        if len(upserts):
+            cursor.executemany(
+                '''INSERT INTO kbk_ic_balance_snapshot (user, department, balance) VALUES (?, ?, ?)
+                   ON CONFLICT(user, department) DO UPDATE SET balance = excluded.balance''',
+                zip(upserts['user'].tolist(), upserts['department'].tolist(), upserts['balance'].tolist())
+            )
+        if removed_keys:
+            cursor.executemany(
+                'DELETE FROM kbk_ic_balance_snapshot WHERE user = ? AND department = ?', removed_keys
+            )
+            
+    def record_import_history(self, cursor, summary):
+        """记录一次导入的差异摘要"""
+        cursor.execute(
+            '''INSERT INTO kbk_ic_balance_import_history
+               (file_name, file_hash, mode, total_rows, added, changed, unchanged, removed, deleted, duration_ms, imported_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (summary["file_name"], summary["file_hash"], summary["mode"], summary["total_rows"],
+             summary["added"], summary["changed"], summary["unchanged"], summary["removed"],
+             summary["deleted"], summary["duration_ms"], self.get_local_timestamp())
+        )
+    
+    def upsert_balance_rows(self, cursor, df):
+        """
+        使用executemany和 INSERT ... ON CONFLICT(user, department) DO UPDATE 批量导入余额
+        列值直接取自DataFrame的列，整个导入使用同一个时间戳，返回 (新增数, 更新数)
+        """
+        local_time = self.get_local_timestamp()
+        cursor.execute('SELECT COUNT(*) FROM kbk_ic_balance')
+        before_count = cursor.fetchone()[0]
+        
+        rows = zip(
+            df['user'].tolist(),
+            df['department'].tolist(),
+            df['balance'].tolist(),
+            itertools.repeat(local_time),
+            itertools.repeat(local_time)
+        )
+        cursor.executemany(
+            '''INSERT INTO kbk_ic_balance (user, department, balance, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(user, department) DO UPDATE
+               SET balance = excluded.balance, updated_at = excluded.updated_at''',
+            rows
+        )
+        
+        cursor.execute('SELECT COUNT(*) FROM kbk_ic_balance')
+        total_inserted = cursor.fetchone()[0] - before_count
+        return total_inserted, len(df) - total_inserted
+        
+    def import_balance_rows(self, cursor, df):
+        """逐行查询后更新或插入余额（没有唯一索引时使用），返回 (新增数, 更新数)"""
+        total_updated = 0
+        total_inserted = 0
+        
+        # 按批次处理数据
+        records = df.to_dict('records')
+        batches = [records[i:i+self.batch_size] for i in range(0, len(records), self.batch_size)]
+        
+        for batch in batches:
+            for record in batch:
+                user = record['user']
+                department = record['department']
+                balance = record['balance']
+                
+                # 检查记录是否已存在
+                cursor.execute(
+                    'SELECT id FROM kbk_ic_balance WHERE user = ? AND department = ?', 
+                    (user, department)
+                )
+                result = cursor.fetchone()
+                
+                if result:
+                    # 更新已存在的记录
+                    local_time = self.get_local_timestamp()
+                    cursor.execute(
+                        '''UPDATE kbk_ic_balance 
+                           SET balance = ?, updated_at = ? 
+                           WHERE user = ? AND department = ?''', 
+                        (balance, local_time, user, department)
+                    )
+                    total_updated += 1
+                else:
+                    # 插入新记录
+                    local_time = self.get_local_timestamp()
+                    cursor.execute(
+                        '''INSERT INTO kbk_ic_balance 
+                           (user, department, balance, created_at, updated_at) 
+                           VALUES (?, ?, ?, ?, ?)''', 
+                        (user, department, balance, local_time, local_time)
+                    )
+                    total_inserted += 1
+        return total_inserted, total_updated
+    
+    @property
+    def data_version(self):
+        """余额数据版本（带进程启动标识，重启后不会与旧版本混淆）"""
+        return f"{self._boot_id}-{self._data_version}"
+        
+    def balance_etag(self, *parts):
+        """按余额数据版本和请求内容生成ETag，数据未变化时同一请求得到同一ETag"""
+        key = json.dumps([self.data_version, *parts], ensure_ascii=False)
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+        
+    def invalidate_balance_cache(self):
+        """余额数据变化后使缓存和ETag失效"""
+        self._data_version += 1
+        self.balance_cache.clear()
+        
+    def get_read_pool(self):
+        """返回只读连接池，首次使用时创建"""
+        if self.read_pool is None:
+            self.read_pool = SqliteReadPool(DB_PATH, max_size=READ_POOL_SIZE)
+        return self.read_pool
+        
+    def lookup_balances(self, keys):
+        """
+        批量查询余额，keys为 (user, department或None) 列表
+        返回 {key: 结果}：指定部门时结果为余额或None，未指定部门时为 [(department, balance), ...]
+        先查缓存，未命中的键合并成少量SQL在只读连接上查询
+        """
+        # 查询之前读取数据版本，查询期间导入或调整余额后，读到的旧值不会作为新版本缓存
+        version = self._data_version
+        results, missing_pairs, missing_users = self.split_cached_balances(keys, version)
+        if missing_pairs or missing_users:
+            with self.get_read_pool().acquire() as conn:
+                fetched = [
+                    (by_user, conn.execute(sql, params).fetchall())
+                    for by_user, sql, params in self.balance_lookup_queries(missing_pairs, missing_users)
+                ]
+            self.store_balance_lookups(results, missing_pairs, missing_users, fetched, version)
+        return results
+    
+    def split_cached_balances(self, keys, version):
+        """按缓存拆分查询键，返回 (已命中的结果, 未命中的 (user, department), 未命中的只按user查询)"""
+        results = {}
+        missing_pairs = []
+        missing_users = []
+        for key in dict.fromkeys(keys):
+            hit, value = self.balance_cache.get(key, version)
+            if hit:
+                results[key] = value
+            elif key[1] is None:
+                missing_users.append(key[0])
+            else:
+                missing_pairs.append(key)
+        return results, missing_pairs, missing_users
+    
+    def balance_lookup_queries(self, missing_pairs, missing_users):
+        """生成未命中键的分块查询 (是否按user查询, sql, params)，每块的参数数量不超过SQLite的限制"""
+        for i in range(0, len(missing_pairs), 400):
+            chunk = missing_pairs[i:i+400]
+            values = ','.join(['(?, ?)'] * len(chunk))
+            yield False, f'''SELECT user, department, balance FROM kbk_ic_balance
+                             WHERE (user, department) IN (VALUES {values})''', [value for pair in chunk for value in pair]
+        for i in range(0, len(missing_users), 800):
+            chunk = missing_users[i:i+800]
+            placeholders = ','.join(['?'] * len(chunk))
+            yield True, f'SELECT user, department, balance FROM kbk_ic_balance WHERE user IN ({placeholders})', chunk
+    
+    def store_balance_lookups(self, results, missing_pairs, missing_users, fetched, version):
+        """
+        把分块查询的结果 [(是否按user查询, rows)] 填入results并写入缓存
+        version 为查询之前读取的数据版本，缓存条目带上该版本，之后的查询只命中当前版本的条目
+        """
+        pair_rows = {}
+        user_rows = {}
+        for by_user, rows in fetched:
+            for user, department, balance in rows:
+                if by_user:
+                    user_rows.setdefault(user, []).append((department, balance))
+                else:
+                    pair_rows[(user, department)] = balance
+        for key in missing_pairs:
+            results[key] = pair_rows.get(key)
+        for user in missing_users:
+            results[(user, None)] = user_rows.get(user, [])
+        
+        for key in itertools.chain(missing_pairs, ((user, None) for user in missing_users)):
+            self.balance_cache.set(key, results[key], version)
+    
+    def compute_balance_forecast(self, conn, today):
+        """
+        一次性计算所有 (user, department) 的剩余餐数和预计用完日期
+        消耗速度为最近 forecast_window_days 天在各计数表中的刷卡次数 / 天数，没有消耗记录的不预测用完日期
+        """
+        balances = pd.read_sql_query('SELECT user, department, balance FROM kbk_ic_balance', conn)
+        
+        tables = [row[0] for row in conn.execute(
+            f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({','.join(['?'] * len(COUNT_TABLES))})",
+            COUNT_TABLES
+        )]
+        since = (today - timedelta(days=self.forecast_window_days)).strftime('%Y-%m-%d')
+        if swipe_facts.facts_enabled(conn):
+            # 旧计数表已是兼容视图，直接按整数维度在事实表上分组
+            sql, params = swipe_facts.usage_since_query(swipe_facts.local_epoch(since))
+            usage = pd.read_sql_query(sql, conn, params=params)
+        elif tables:
+            # transaction_date直接与日期字符串比较，不包函数，可以走索引
+            union = ' UNION ALL '.join(
+                f'SELECT user, department FROM {table} WHERE transaction_date >= ?' for table in tables
+            )
+            usage = pd.read_sql_query(
+                f'SELECT user, department, COUNT(*) AS meals FROM ({union}) GROUP BY user, department',
+                conn, params=[since] * len(tables)
+            )
+        else:
+            usage = pd.DataFrame({'user': pd.Series(dtype=object), 'department': pd.Series(dtype=object),
+                                  'meals': pd.Series(dtype=float)})
+        
+        df = balances.merge(usage, on=['user', 'department'], how='left')
+        df['meals_per_day'] = df['meals'].fillna(0).astype(float) / self.forecast_window_days
+        rate = df['meals_per_day'].where(df['meals_per_day'] > 0)
+        df['days_left'] = df['balance'].clip(lower=0) / rate
+        # 限制在100年内，避免消耗速度极小时日期溢出
+        days = df['days_left'].clip(upper=36500) // 1
+        df['exhaust_date'] = (pd.Timestamp(today) + pd.to_timedelta(days, unit='D')).dt.strftime('%Y-%m-%d')
+        return df[['user', 'department', 'balance', 'meals_per_day', 'days_left', 'exhaust_date']]
+    
+    def refresh_balance_forecast(self, today=None):
+        """重算余额预测表并更新余额不足用户数的指标，返回 {"total", "low", "days", "computed_at"}"""
+        try:
+            start_time = time.time()
+            today = today or datetime.now().date()
+            conn = sqlite3.connect(DB_PATH)
+            try:
+                df = self.compute_balance_forecast(conn, today)
+                computed_at = self.get_local_timestamp()
+                rows = [
+                    (user, department, int(balance), float(meals_per_day),
+                     None if pd.isna(days_left) else float(days_left),
+                     None if pd.isna(exhaust_date) else exhaust_date, computed_at)
+                    for user, department, balance, meals_per_day, days_left, exhaust_date
+                    in df.itertuples(index=False, name=None)
+                ]
+                conn.execute('BEGIN TRANSACTION')
+                conn.execute('DELETE FROM kbk_ic_balance_forecast')
+                conn.executemany(
+                    '''INSERT INTO kbk_ic_balance_forecast
+                       (user, department, balance, meals_per_day, days_left, exhaust_date, computed_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''', rows
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            
+            low_count = int(((df['balance'] > 0) & (df['days_left'] <= self.low_balance_days)).sum())
+            LOW_BALANCE_USERS.labels(days=str(self.low_balance_days)).set(low_count)
+            logger.info(f"余额预测完成，共 {len(rows)} 条，{self.low_balance_days}天内用完: {low_count} 人，"
+                        f"耗时: {time.time() - start_time:.2f}秒")
+            return {"total": len(rows), "low": low_count, "days": self.low_balance_days, "computed_at": computed_at}
+        except Exception as e:
+            logger.error(f"计算余额预测时出错: {str(e)}")
+            logger.error(traceback.format_exc())
+    
+    def low_balance_query(self, days=None, department=None, limit=None):
+        """查询预计在days天内用完余额（目前仍有余额）的用户的 (sql, params)，按剩余天数升序"""
+        days = self.low_balance_days if days is None else days
+        sql = '''SELECT user, department, balance, meals_per_day, days_left, exhaust_date, computed_at
+                 FROM kbk_ic_balance_forecast WHERE days_left <= ? AND balance > 0'''
+        params = [days]
+        if department:
+            sql += ' AND department = ?'
+            params.append(department)
+        sql += ' ORDER BY days_left, user'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return sql, params
+    
+    def low_balance_users(self, days=None, department=None, limit=None):
+        """查询预计在days天内用完余额（目前仍有余额）的用户，按剩余天数升序"""
+        sql, params = self.low_balance_query(days, department, limit)
+        with self.get_read_pool().acquire() as conn:
+            return self.format_low_balance(conn.execute(sql, params).fetchall())
+    
+    def format_low_balance(self, rows):
+        """把余额预测查询结果转换为API输出"""
+        return [
+            {"user": user, "department": dept, "balance": balance, "meals_per_day": round(meals_per_day, 2),
+             "days_left": round(days_left, 1), "exhaust_date": exhaust_date, "computed_at": computed_at}
+            for user, dept, balance, meals_per_day, days_left, exhaust_date, computed_at in rows
+        ]
+    
     def get_time_point_by_now(self):
         """根据当前时间判断应使用哪个时间点标识（a、b、c）"""
         now = datetime.now().time()
@@ -381,6 +1174,10 @@ class BalanceManager:
             schedule.every().day.at(time_value).do(self.trigger_balance_check_with_point, time_point=point)
             logger.info(f"已设置时间点 {point} ({time_value}) 的定时任务")
         
+        # 启动时先按顺序补跑停机期间错过的余额检查，再计算一次余额预测，之后每次余额检查后重算
+        self.executor.submit(self.replay_missed_ticks)
+        self.executor.submit(self.refresh_balance_forecast)
+        
         # 启动调度线程
         self.scheduler_thread = threading.Thread(target=self._run_scheduler, daemon=True)
         self.scheduler_thread.start()
@@ -396,22 +1193,31 @@ class BalanceManager:
             logger.error(f"调度器运行异常: {str(e)}")
             logger.error(traceback.format_exc())
     
-    def trigger_balance_check_with_point(self, time_point):
-        """使用指定时间点触发余额检查"""
+    def trigger_balance_check_with_point(self, time_point, source='schedule', run_date=None):
+        """使用指定时间点触发余额检查（不能返回schedule.CancelJob，否则每日任务执行一次后就被取消）"""
         logger.info(f"触发时间点 {time_point} 的余额检查")
-        self.executor.submit(self.process_balance_check, time_point)
-        return schedule.CancelJob  # 返回CancelJob是避免schedule库的潜在问题
+        self.executor.submit(self.process_balance_check, time_point, run_date=run_date, source=source)
     
     def trigger_balance_check(self):
         """触发余额检查，自动判断时间点"""
         time_point = self.get_time_point_by_now()
         logger.info(f"手动触发余额检查 (自动时间点: {time_point})")
-        self.executor.submit(self.process_balance_check, time_point)
+        self.executor.submit(self.process_balance_check, time_point, source='manual')
     
-    def process_balance_check(self, time_point):
-        """处理余额检查和状态更新"""
+    def process_balance_check(self, time_point, run_date=None, source='manual', slot_time=None):
+        """
+        处理余额检查和状态更新
+        以少量按 (user, department) 关联的集合语句完成，返回各步骤的精确计数：
+        positive(余额大于0的记录)、matched/missing(在kbk_ic_manager中存在/不存在)、
+        activated(置为1的行)、decremented(递减的余额)、zeroed(余额为0置为0的行)
+        每个 (run_date, time_point) 在执行记录表中只能登记一次，登记与扣减在同一事务中，
+        重复执行时返回 {"skipped": True, ...} 且不做任何修改
+        slot_time: 该时间点应执行的时间（datetime），用作用餐流水的created_at，补跑的扣减记在原时间点上；
+        不传时使用当前时间
+        """
+        run_date = run_date or datetime.now().strftime('%Y-%m-%d')
         try:
-            logger.info(f"开始处理余额检查，时间点: {time_point}")
+            logger.info(f"开始处理余额检查，日期: {run_date}，时间点: {time_point}，来源: {source}")
             start_time = time.time()
             
             conn = sqlite3.connect(DB_PATH)
@@ -423,35 +1229,68 @@ class BalanceManager:
                 # 使用事务确保原子性
                 conn.execute('BEGIN TRANSACTION')
                 
-                # 1. 查询所有余额大于0的记录
-                cursor.execute('SELECT user, department, balance FROM kbk_ic_balance WHERE balance > 0')
-                positive_balance_records = cursor.fetchall()
+                # 0. 登记本次执行，(run_date, time_point) 已存在说明已执行过（或另一台机器正在执行）
+                cursor.execute(
+                    '''INSERT INTO kbk_ic_balance_tick_runs (run_date, time_point, source, runner, started_at)
+                       VALUES (?, ?, ?, ?, ?)
+                       ON CONFLICT (run_date, time_point) DO NOTHING''',
+                    (run_date, time_point, source, f"{socket.gethostname()}:{os.getpid()}", self.get_local_timestamp())
+                )
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    logger.info(f"日期 {run_date} 时间点 {time_point} 的余额检查已执行过，跳过")
+                    return {"skipped": True, "run_date": run_date, "time_point": time_point}
+                
+                # 1. 统计余额大于0的记录，以及其中在kbk_ic_manager中存在的 (user, department)
+                cursor.execute(
+                    '''SELECT COUNT(*), COALESCE(SUM(EXISTS (
+                           SELECT 1 FROM kbk_ic_manager m
+                           WHERE m.user = b.user AND m.department = b.department
+                       )), 0)
+                       FROM kbk_ic_balance b WHERE b.balance > 0'''
+                )
+                positive_count, matched_count = cursor.fetchone()
                 
-                if not positive_balance_records:
+                if not positive_count:
                     logger.info("未找到余额大于0的记录")
+                    counts = {"positive": 0, "matched": 0, "missing": 0, "activated": 0, "decremented": 0, "zeroed": 0}
+                    self.finish_tick_run(cursor, run_date, time_point, counts)
                     conn.commit()
-                    return
-                
-                total_updated = 0
+                    return counts
                 
-                # 2. 更新kbk_ic_manager表中相应用户的status为1
-                local_time = self.get_local_timestamp()
-                for user, department, balance in positive_balance_records:
-                    # 更新status为1
+                missing_count = positive_count - matched_count
+                if missing_count:
                     cursor.execute(
-                        '''UPDATE kbk_ic_manager 
-                           SET status = 1, last_updated = ? 
-                           WHERE user = ? AND department = ?''',
-                        (local_time, user, department)
+                        '''SELECT b.user, b.department FROM kbk_ic_balance b
+                           WHERE b.balance > 0 AND NOT EXISTS (
+                               SELECT 1 FROM kbk_ic_manager m
+                               WHERE m.user = b.user AND m.department = b.department
+                           ) LIMIT 20'''
                     )
-                    if cursor.rowcount > 0:
-                        total_updated += 1
-                    else:
-                        logger.warning(f"用户不存在: {user}, {department}")
+                    samples = ', '.join(f"{user}/{department}" for user, department in cursor.fetchall())
+                    logger.warning(f"有 {missing_count} 个余额大于0的用户在kbk_ic_manager中不存在，例如: {samples}")
                 
-                # 3. 原子性递减kbk_ic_balance表中的balance值
-                # 每个时间点递减1
                 local_time = self.get_local_timestamp()
+                meal_time = slot_time.strftime('%Y-%m-%d %H:%M:%S') if slot_time else local_time
+                
+                # 2. 按 (user, department) 一次性将余额大于0的用户status置为1
+                cursor.execute(
+                    '''UPDATE kbk_ic_manager 
+                       SET status = 1, last_updated = ? 
+                       WHERE (user, department) IN (
+                           SELECT user, department FROM kbk_ic_balance WHERE balance > 0
+                       )''',
+                    (local_time,)
+                )
+                total_updated = cursor.rowcount
+                
+                # 3. 原子性递减kbk_ic_balance表中的balance值
+                # 每个时间点递减1，同一事务中先追加对应的用餐流水
+                cursor.execute(
+                    '''INSERT INTO kbk_ic_balance_ledger (user, department, entry_type, amount, time_point, source, created_at)
+                       SELECT user, department, ?, -1, ?, 'balance_check', ? FROM kbk_ic_balance WHERE balance > 0''',
+                    (LEDGER_MEAL, time_point, meal_time)
+                )
                 cursor.execute(
                     '''UPDATE kbk_ic_balance 
                        SET balance = balance - 1, updated_at = ? 
@@ -460,31 +1299,42 @@ class BalanceManager:
                 )
                 decremented_count = cursor.rowcount
                 
-                # 4. 将余额为0的用户状态设置为0
-                local_time = self.get_local_timestamp()
+                # 4. 将余额为0的 (user, department) 状态设置为0
                 cursor.execute(
                     '''UPDATE kbk_ic_manager 
                        SET status = 0, last_updated = ? 
-                       WHERE user IN (
-                           SELECT user FROM kbk_ic_balance WHERE balance = 0
-                       ) AND department IN (
-                           SELECT department FROM kbk_ic_balance WHERE balance = 0
+                       WHERE (user, department) IN (
+                           SELECT user, department FROM kbk_ic_balance WHERE balance = 0
                        )''',
                     (local_time,)
                 )
                 zero_balance_updated = cursor.rowcount
                 
+                counts = {
+                    "positive": positive_count,
+                    "matched": matched_count,
+                    "missing": missing_count,
+                    "activated": total_updated,
+                    "decremented": decremented_count,
+                    "zeroed": zero_balance_updated
+                }
+                self.finish_tick_run(cursor, run_date, time_point, counts)
+                
                 # 提交事务
                 conn.commit()
+                self.invalidate_balance_cache()
+                self.refresh_balance_forecast()
                 
                 process_time = time.time() - start_time
-                logger.info(f"余额检查完成，用户状态更新: {total_updated}条，余额递减: {decremented_count}条，"
+                logger.info(f"余额检查完成，余额大于0: {positive_count}条(缺失用户 {missing_count}条)，用户状态更新: {total_updated}条，余额递减: {decremented_count}条，"
                           f"余额为0状态更新: {zero_balance_updated}条，耗时: {process_time:.2f}秒")
                 
                 # 更新健康状态
                 self.health_status["last_update"] = datetime.now().isoformat()
                 self.health_status["status"] = "healthy"
                 
+                return counts
+                
             except Exception as e:
                 conn.rollback()
                 logger.error(f"余额检查过程中发生错误: {str(e)}")
@@ -509,6 +1359,102 @@ class BalanceManager:
             })
             self.health_status["status"] = "error"
     
+    def finish_tick_run(self, cursor, run_date, time_point, counts):
+        """在余额检查的事务中补全执行记录的结果和完成时间"""
+        cursor.execute(
+            '''UPDATE kbk_ic_balance_tick_runs SET counts = ?, finished_at = ?
+               WHERE run_date = ? AND time_point = ?''',
+            (json.dumps(counts), self.get_local_timestamp(), run_date, time_point)
+        )
+    
+    def missed_ticks(self, now=None, max_days=MAX_REPLAY_DAYS):
+        """
+        返回最近一次已执行的时间点之后、now之前应执行但没有执行记录的 (run_date, time_point, 时间)，按时间顺序
+        执行记录为空时（首次部署）不补跑；只考虑最近max_days天，更早的缺口需要人工处理
+        """
+        now = now or datetime.now()
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            last_date = conn.execute('SELECT MAX(run_date) FROM kbk_ic_balance_tick_runs').fetchone()[0]
+            if last_date is None:
+                return []
+            last_points = [row[0] for row in conn.execute(
+                'SELECT time_point FROM kbk_ic_balance_tick_runs WHERE run_date = ?', (last_date,)
+            )]
+        finally:
+            conn.close()
+        
+        points = sorted(TIME_POINTS.items(), key=lambda item: item[1])
+        last_slot = datetime.strptime(
+            f"{last_date} {max(TIME_POINTS.get(point, '00:00') for point in last_points)}", '%Y-%m-%d %H:%M'
+        )
+        first_day = max(last_slot.date(), now.date() - timedelta(days=max_days))
+        if first_day > last_slot.date():
+            logger.warning(f"上次余额检查在 {last_slot}，只补跑 {first_day} 之后错过的时间点")
+        
+        missed = []
+        day = first_day
+        while day <= now.date():
+            for point, time_value in points:
+                slot = datetime.strptime(f"{day} {time_value}", '%Y-%m-%d %H:%M')
+                if last_slot < slot <= now:
+                    missed.append((day.strftime('%Y-%m-%d'), point, slot))
+            day += timedelta(days=1)
+        return missed
+    
+    def replay_missed_ticks(self, now=None):
+        """按时间顺序补跑错过的余额检查，某次失败时停止以保持顺序，返回已补跑的 (run_date, time_point) 列表"""
+        replayed = []
+        try:
+            missed = self.missed_ticks(now)
+            if missed:
+                logger.info(f"发现 {len(missed)} 个错过的余额检查，开始按顺序补跑: "
+                            f"{[(run_date, time_point) for run_date, time_point, _ in missed]}")
+            for run_date, time_point, slot in missed:
+                result = self.process_balance_check(time_point, run_date=run_date, source='replay', slot_time=slot)
+                if result is None:
+                    logger.error(f"补跑 {run_date} {time_point} 失败，停止补跑")
+                    break
+                replayed.append((run_date, time_point))
+        except Exception as e:
+            logger.error(f"补跑错过的余额检查时出错: {str(e)}")
+            logger.error(traceback.format_exc())
+        return replayed
+    
+    def tick_runs_query(self, start=None, end=None, time_point=None):
+        """查询 [start, end] 日期范围内的余额检查执行记录的 (sql, params)"""
+        sql = '''SELECT run_date, time_point, source, runner, counts, started_at, finished_at
+                 FROM kbk_ic_balance_tick_runs WHERE 1=1'''
+        params = []
+        if start:
+            sql += ' AND run_date >= ?'
+            params.append(start)
+        if end:
+            sql += ' AND run_date <= ?'
+            params.append(end)
+        if time_point:
+            sql += ' AND time_point = ?'
+            params.append(time_point)
+        sql += ' ORDER BY run_date, time_point'
+        return sql, params
+    
+    def tick_runs(self, start=None, end=None, time_point=None):
+        """查询 [start, end] 日期范围内的余额检查执行记录，用于审计"""
+        sql, params = self.tick_runs_query(start, end, time_point)
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            return self.format_tick_runs(conn.execute(sql, params).fetchall())
+        finally:
+            conn.close()
+    
+    def format_tick_runs(self, rows):
+        """把执行记录查询结果转换为API输出"""
+        return [
+            {"run_date": run_date, "time_point": point, "source": source, "runner": runner,
+             "counts": json.loads(counts) if counts else None, "started_at": started_at, "finished_at": finished_at}
+            for run_date, point, source, runner, counts, started_at, finished_at in rows
+        ]
+    
     def sync_zero_balance_users(self):
         """同步余额为0的用户状态为0"""
         try:
@@ -572,19 +1518,31 @@ class BalanceManager:
             self.observer.stop()
             self.observer.join()
         
+        if self.excel_ingest is not None:
+            self.excel_ingest.stop()
+        
         if hasattr(self, 'executor'):
             self.executor.shutdown(wait=False)
         
+        if self.read_pool is not None:
+            self.read_pool.close()
+            self.read_pool = None
+        
         logger.info("资源已清理")
 
 # API服务器
 class BalanceManagerServer:
     """提供REST API接口的服务器"""
     
-    def __init__(self, balance_manager, port=5555):
+    def __init__(self, balance_manager, port=5555, threads=wsgi_server.DEFAULT_THREADS,
+                 timeout=wsgi_server.DEFAULT_TIMEOUT, keep_alive=wsgi_server.DEFAULT_KEEP_ALIVE, dev_server=False):
         """初始化API服务器"""
         self.balance_manager = balance_manager
         self.port = port
+        self.threads = threads
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.dev_server = dev_server
         self.app = Flask(__name__)
         CORS(self.app)
         
@@ -624,8 +1582,16 @@ class BalanceManagerServer:
                 time_point = request.args.get('time_point')
                 if not time_point:
                     time_point = self.balance_manager.get_time_point_by_now()
+                if time_point not in TIME_POINTS:
+                    return jsonify({
+                        "success": False,
+                        "message": f"未知的时间点: {time_point}"
+                    }), 400
                 
-                self.balance_manager.trigger_balance_check_with_point(time_point)
+                # 同一天同一时间点已执行过时不会重复扣减
+                self.balance_manager.trigger_balance_check_with_point(
+                    time_point, source='manual', run_date=request.args.get('date')
+                )
                 return jsonify({
                     "success": True,
                     "message": f"时间点 {time_point} 的余额检查已触发",
@@ -653,46 +1619,35 @@ class BalanceManagerServer:
                         "message": "请提供user参数"
                     }), 400
                 
-                conn = sqlite3.connect(DB_PATH)
-                # 设置数据库连接以使用本地时区
-                conn.execute("PRAGMA timezone='localtime'")
-                cursor = conn.cursor()
-                
-                if department:
-                    cursor.execute(
-                        'SELECT balance FROM kbk_ic_balance WHERE user = ? AND department = ?',
-                        (user, department)
-                    )
-                else:
-                    cursor.execute(
-                        'SELECT department, balance FROM kbk_ic_balance WHERE user = ?',
-                        (user,)
-                    )
+                etag = self.make_etag('balance', user, department)
+                if etag in request.if_none_match:
+                    return self.not_modified(etag)
                 
-                result = cursor.fetchall()
-                conn.close()
+                key = (user, department or None)
+                result = self.balance_manager.lookup_balances([key])[key]
                 
-                if not result:
+                if result is None or result == []:
                     return jsonify({
                         "success": False,
                         "message": "未找到记录"
                     }), 404
                 
                 if department:
-                    balance = result[0][0]
-                    return jsonify({
+                    response = jsonify({
                         "success": True,
                         "user": user,
                         "department": department,
-                        "balance": balance
+                        "balance": result
                     })
                 else:
                     balances = [{"department": row[0], "balance": row[1]} for row in result]
-                    return jsonify({
+                    response = jsonify({
                         "success": True,
                         "user": user,
                         "balances": balances
                     })
+                response.set_etag(etag)
+                return response
                     
             except Exception as e:
                 logger.error(f"API查询余额时出错: {str(e)}")
@@ -703,6 +1658,192 @@ class BalanceManagerServer:
                     "error": str(e)
                 }), 500
         
+        # 批量查询用户余额
+        @self.app.route('/api/balance/batch', methods=['POST'])
+        def get_balance_batch():
+            try:
+                data = request.get_json(silent=True) or {}
+                # 支持 {"items": [{"user": ..., "department": ...}]} 或 {"users": [...]}
+                items = data.get('items')
+                if items is None:
+                    items = [{"user": user} for user in data.get('users', [])]
+                
+                if not isinstance(items, list) or not items:
+                    return jsonify({
+                        "success": False,
+                        "message": "请提供items或users参数"
+                    }), 400
+                if len(items) > BATCH_LOOKUP_LIMIT:
+                    return jsonify({
+                        "success": False,
+                        "message": f"单次最多查询{BATCH_LOOKUP_LIMIT}个用户"
+                    }), 400
+                
+                keys = []
+                for item in items:
+                    if not isinstance(item, dict) or not item.get('user'):
+                        return jsonify({
+                            "success": False,
+                            "message": "每一项都需要提供user"
+                        }), 400
+                    keys.append((str(item['user']), str(item['department']) if item.get('department') else None))
+                
+                etag = self.make_etag('batch', json.dumps(keys, ensure_ascii=False))
+                if etag in request.if_none_match:
+                    return self.not_modified(etag)
+                
+                found = self.balance_manager.lookup_balances(keys)
+                results = []
+                for user, department in keys:
+                    result = found[(user, department)]
+                    if department:
+                        results.append({
+                            "user": user,
+                            "department": department,
+                            "found": result is not None,
+                            "balance": result
+                        })
+                    else:
+                        results.append({
+                            "user": user,
+                            "found": bool(result),
+                            "balances": [{"department": row[0], "balance": row[1]} for row in result]
+                        })
+                
+                response = jsonify({
+                    "success": True,
+                    "results": results
+                })
+                response.set_etag(etag)
+                return response
+                
+            except Exception as e:
+                logger.error(f"API批量查询余额时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+                return jsonify({
+                    "success": False,
+                    "message": f"批量查询余额失败: {str(e)}",
+                    "error": str(e)
+                }), 500
+        
+        # 手工调整余额
+        @self.app.route('/api/balance/adjust', methods=['POST'])
+        def adjust_balance():
+            try:
+                data = request.get_json(silent=True) or {}
+                user = data.get('user')
+                department = data.get('department')
+                amount = data.get('amount')
+                
+                if not user or not department or not isinstance(amount, int) or isinstance(amount, bool):
+                    return jsonify({
+                        "success": False,
+                        "message": "请提供user、department和整数amount参数"
+                    }), 400
+                
+                balance = self.balance_manager.adjust_balance(user, department, amount, data.get('reason'))
+                return jsonify({
+                    "success": True,
+                    "user": user,
+                    "department": department,
+                    "balance": balance
+                })
+            except ValueError as e:
+                return jsonify({
+                    "success": False,
+                    "message": str(e)
+                }), 400
+            except Exception as e:
+                logger.error(f"API调整余额时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+                return jsonify({
+                    "success": False,
+                    "message": f"调整余额失败: {str(e)}",
+                    "error": str(e)
+                }), 500
+        
+        # 按部门和时间范围统计流水，例如本月用餐次数
+        @self.app.route('/api/ledger/summary', methods=['GET'])
+        def ledger_summary():
+            try:
+                department = request.args.get('department')
+                start = request.args.get('start')
+                end = request.args.get('end')
+                
+                if not department or not start or not end:
+                    return jsonify({
+                        "success": False,
+                        "message": "请提供department、start和end参数"
+                    }), 400
+                
+                summary = self.balance_manager.ledger_summary(
+                    department, start, end,
+                    entry_type=request.args.get('type', LEDGER_MEAL),
+                    user=request.args.get('user')
+                )
+                return jsonify({"success": True, **summary})
+            except Exception as e:
+                logger.error(f"API统计流水时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+                return jsonify({
+                    "success": False,
+                    "message": f"统计流水失败: {str(e)}",
+                    "error": str(e)
+                }), 500
+        
+        # 余额检查执行记录（审计）
+        @self.app.route('/api/ticks', methods=['GET'])
+        def tick_runs():
+            try:
+                runs = self.balance_manager.tick_runs(
+                    start=request.args.get('start'),
+                    end=request.args.get('end'),
+                    time_point=request.args.get('time_point')
+                )
+                return jsonify({
+                    "success": True,
+                    "count": len(runs),
+                    "runs": runs
+                })
+            except Exception as e:
+                logger.error(f"API查询余额检查执行记录时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+                return jsonify({
+                    "success": False,
+                    "message": f"查询执行记录失败: {str(e)}",
+                    "error": str(e)
+                }), 500
+        
+        # 预计即将用完余额的用户
+        @self.app.route('/api/balance/low', methods=['GET'])
+        def low_balance():
+            try:
+                days = request.args.get('days', type=float)
+                users = self.balance_manager.low_balance_users(
+                    days=days,
+                    department=request.args.get('department'),
+                    limit=request.args.get('limit', type=int)
+                )
+                return jsonify({
+                    "success": True,
+                    "days": self.balance_manager.low_balance_days if days is None else days,
+                    "count": len(users),
+                    "users": users
+                })
+            except Exception as e:
+                logger.error(f"API查询余额不足用户时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+                return jsonify({
+                    "success": False,
+                    "message": f"查询余额不足用户失败: {str(e)}",
+                    "error": str(e)
+                }), 500
+        
+        # Prometheus指标
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics():
+            return self.app.response_class(prom.generate_latest(), mimetype=prom.CONTENT_TYPE_LATEST)
+        
         # 同步余额为0的用户
         @self.app.route('/api/sync-zero', methods=['GET'])
         def sync_zero():
@@ -721,9 +1862,24 @@ class BalanceManagerServer:
                     "error": str(e)
                 }), 500
     
+    def make_etag(self, *parts):
+        """按余额数据版本和请求内容生成ETag"""
+        return self.balance_manager.balance_etag(*parts)
+        
+    def not_modified(self, etag):
+        """返回304响应"""
+        response = self.app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
     def start(self):
         """启动API服务器"""
-        self.app.run(host='0.0.0.0', port=self.port, debug=False, threaded=True)
+        if self.dev_server:
+            self.app.run(host='0.0.0.0', port=self.port, debug=False, threaded=True)
+            return
+        # 余额缓存、调度器和文件监控都在本进程内，只能单进程多线程运行
+        wsgi_server.serve(self.app, host='0.0.0.0', port=self.port, threads=self.threads, workers=1,
+                          timeout=self.timeout, keep_alive=self.keep_alive)
 
 def main():
     """主函数"""
@@ -734,6 +1890,18 @@ def main():
         parser.add_argument('-e', '--excel-dir', type=str, default=EXCEL_DIR, help=f'Excel文件目录 (默认: {EXCEL_DIR})')
         parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help=f'批处理大小 (默认: {BATCH_SIZE})')
         parser.add_argument('--no-server', action='store_true', help='不启动API服务器')
+        parser.add_argument('--delete-missing', action='store_true', help='导入时删除新表格中已不存在的余额记录')
+        parser.add_argument('--low-balance-days', type=int, default=LOW_BALANCE_DAYS,
+                            help=f'预计多少天内用完视为余额不足 (默认: {LOW_BALANCE_DAYS})')
+        parser.add_argument('--reject-unknown-users', action='store_true',
+                            help='导入时拒绝kbk_ic_manager中不存在或部门不一致的用户行')
+        parser.add_argument('--threads', type=int, default=wsgi_server.DEFAULT_THREADS,
+                            help=f'API服务器请求线程数 (默认: {wsgi_server.DEFAULT_THREADS})')
+        parser.add_argument('--timeout', type=int, default=wsgi_server.DEFAULT_TIMEOUT,
+                            help=f'请求读超时秒数 (默认: {wsgi_server.DEFAULT_TIMEOUT})')
+        parser.add_argument('--keep-alive', type=int, default=wsgi_server.DEFAULT_KEEP_ALIVE,
+                            help=f'keep-alive秒数，0表示不保持连接 (默认: {wsgi_server.DEFAULT_KEEP_ALIVE})')
+        parser.add_argument('--dev-server', action='store_true', help='使用Flask开发服务器')
         args = parser.parse_args()
         
         logger.info("余额管理系统启动中...")
@@ -741,7 +1909,10 @@ def main():
         # 创建余额管理器
         balance_manager = BalanceManager(
             excel_folder=args.excel_dir,
-            batch_size=args.batch_size
+            batch_size=args.batch_size,
+            delete_missing=args.delete_missing,
+            low_balance_days=args.low_balance_days,
+            reject_unknown_users=args.reject_unknown_users
         )
         
         # 启动文件监控
@@ -752,7 +1923,14 @@ def main():
         
         if not args.no_server:
             # 启动API服务器
-            server = BalanceManagerServer(balance_manager, port=args.port)
+            server = BalanceManagerServer(
+                balance_manager,
+                port=args.port,
+                threads=args.threads,
+                timeout=args.timeout,
+                keep_alive=args.keep_alive,
+                dev_server=args.dev_server
+            )
             logger.info(f"API服务器启动在端口 {args.port}")
             server.start()
         else:
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+余额表导入基准测试
+生成一个50k行的余额Excel，比较逐行导入和UPSERT导入的首次导入与重复导入耗时，
+以及增量导入在相同文件和1%行变化时的耗时
+
+用法: python benchmarks/bench_balance_import.py [-n 50000] [-d 40]
+"""
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import balance_manager
+from balance_manager import BalanceManager
+
+
+def make_sheet(file_path, rows, departments, changed_every=0):
+    """生成余额表，changed_every不为0时每隔这么多行修改一个余额"""
+    pd.DataFrame({
+        "user": [f"user{i:06d}" for i in range(rows)],
+        "department": [f"部门{i % departments}" for i in range(rows)],
+        "balance": [i % 7 + (10 if changed_every and i % changed_every == 0 else 0) for i in range(rows)]
+    }).to_excel(file_path, index=False)
+
+
+def run_import(manager, df, upsert):
+    """在一个事务中导入一次，返回 (耗时, 新增数, 更新数)"""
+    conn = sqlite3.connect(balance_manager.DB_PATH)
+    cursor = conn.cursor()
+    start_time = time.perf_counter()
+    conn.execute('BEGIN TRANSACTION')
+    if upsert:
+        inserted, updated = manager.upsert_balance_rows(cursor, df)
+    else:
+        inserted, updated = manager.import_balance_rows(cursor, df)
+    conn.commit()
+    elapsed = time.perf_counter() - start_time
+    conn.close()
+    return elapsed, inserted, updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='余额表导入基准测试')
+    parser.add_argument('-n', '--rows', type=int, default=50000, help='余额表行数 (默认: 50000)')
+    parser.add_argument('-d', '--departments', type=int, default=40, help='部门数 (默认: 40)')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(temp_dir, "balance.xlsx")
+        make_sheet(file_path, args.rows, args.departments)
+
+        start_time = time.perf_counter()
+        df = pd.read_excel(file_path)
+        df['balance'] = df['balance'].fillna(0).astype(int)
+        print(f"读取Excel: {time.perf_counter() - start_time:.2f}秒, {len(df)}行")
+
+        for name, upsert in (("逐行导入", False), ("UPSERT导入", True)):
+            balance_manager.DB_PATH = os.path.join(temp_dir, f"{'upsert' if upsert else 'legacy'}.db")
+            manager = BalanceManager(excel_folder=os.path.join(temp_dir, "excel_balance"))
+            try:
+                first = run_import(manager, df, upsert)
+                second = run_import(manager, df, upsert)
+            finally:
+                manager.cleanup()
+            print(f"{name}: 首次 {first[0]:.2f}秒 (新增 {first[1]}, 更新 {first[2]}), "
+                  f"重复 {second[0]:.2f}秒 (新增 {second[1]}, 更新 {second[2]})")
+
+        # 增量导入（包含读取Excel的时间）
+        changed_path = os.path.join(temp_dir, "balance_changed.xlsx")
+        make_sheet(changed_path, args.rows, args.departments, changed_every=100)
+        balance_manager.DB_PATH = os.path.join(temp_dir, "incremental.db")
+        manager = BalanceManager(excel_folder=os.path.join(temp_dir, "excel_balance"))
+        try:
+            for label, path in (("首次", file_path), ("相同文件", file_path), ("1%变化", changed_path)):
+                start_time = time.perf_counter()
+                summary = manager.import_excel_to_db(path)
+                print(f"增量导入 {label}: {time.perf_counter() - start_time:.2f}秒 ({summary['mode']}, "
+                      f"新增 {summary['added']}, 变化 {summary['changed']}, 未变 {summary['unchanged']})")
+        finally:
+            manager.cleanup()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
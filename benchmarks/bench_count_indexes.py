@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+统计查询索引基准测试
+在临时数据库中生成合成刷卡记录（三张计数表和失败记录表），分别在建索引前后执行管理界面的统计查询，
+输出每个查询的耗时、建索引和ANALYZE的耗时，以及查询计划检查结果
+
+用法: python benchmarks/bench_count_indexes.py [--rows 1000000] [--days 730] [-r 3]
+      python benchmarks/bench_count_indexes.py --rows 10000000
+"""
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import index_migration
+import swipe_rollup
+
+
+def seed_database(conn, rows, days, users=2000, departments=20):
+    """用递归CTE生成合成数据：每张计数表 rows 行，均匀分布在最近 days 天的就餐时段内外"""
+    conn.execute('''
+    CREATE TABLE kbk_ic_manager (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        card TEXT NOT NULL UNIQUE,
+        department TEXT NOT NULL,
+        status INTEGER NOT NULL DEFAULT 0,
+        last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.execute(f'''
+        INSERT INTO kbk_ic_manager (user, card, department, status)
+        WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < {users})
+        SELECT '用户' || i, 'card' || i, '部门' || (i % {departments}), i % 2 FROM n
+    ''')
+    tables = swipe_rollup.COUNT_TABLES + ['kbk_ic_failure_records']
+    for table in tables:
+        extra = ", failure_type INTEGER NOT NULL DEFAULT 0" if table == 'kbk_ic_failure_records' else ""
+        conn.execute(f'''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            department TEXT NOT NULL,
+            transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP{extra}
+        )''')
+        table_rows = rows if table != 'kbk_ic_failure_records' else max(rows // 20, 1)
+        columns = "user, department, transaction_date" + (", failure_type" if extra else "")
+        conn.execute(f'''
+            INSERT INTO {table} ({columns})
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < {table_rows}),
+            s AS (SELECT i, abs(random()) AS u FROM n)
+            SELECT '用户' || (u % {users}), '部门' || (u % {users} % {departments}),
+                   datetime('2025-06-30', '-' || (i * {days} / {table_rows}) || ' days',
+                            '+' || (u % 86400) || ' seconds')
+                   {", u % 5" if extra else ""}
+            FROM s
+        ''')
+    conn.commit()
+
+
+def time_queries(conn, repeat):
+    """执行每个统计查询 repeat 次，返回 {查询名称: 最短耗时(秒)}"""
+    timings = {}
+    for name, sql, params in index_migration.dashboard_queries(conn, department='部门3', user='用户3'):
+        best = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            elapsed = time.perf_counter() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='统计查询索引基准测试')
+    parser.add_argument('--rows', type=int, default=1000000, help='每张计数表的记录数 (默认: 1000000)')
+    parser.add_argument('--days', type=int, default=730, help='记录分布的天数 (默认: 730)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='每个查询执行次数，取最短耗时 (默认: 3)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(os.path.join(work_dir, 'ic_manager.db'), isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        start_time = time.perf_counter()
+        conn.execute("BEGIN")
+        seed_database(conn, args.rows, args.days)
+        print(f"生成数据: 每张计数表 {args.rows} 行，耗时 {time.perf_counter() - start_time:.1f}秒")
+
+        before = time_queries(conn, args.repeat)
+        start_time = time.perf_counter()
+        index_migration.apply_indexes(conn)
+        print(f"建索引并ANALYZE: {time.perf_counter() - start_time:.1f}秒")
+        after = time_queries(conn, args.repeat)
+
+        print(f"{'查询':<24}{'无索引(毫秒)':>14}{'有索引(毫秒)':>14}{'加速':>10}")
+        for name in before:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            print(f"{name:<24}{before[name] * 1000:>14.2f}{after[name] * 1000:>14.2f}{speedup:>9.1f}x")
+        for name, uses_index, plan in index_migration.verify_query_plans(conn):
+            print(f"{'[OK]' if uses_index else '[全表扫描]'} {name}")
+        conn.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP服务模式基准测试
+在临时目录中准备数据库，分别以Flask开发服务器和内嵌WSGI服务器启动管理界面和余额API，
+用多个keep-alive客户端并发请求 /api/counts 和 /api/balance，比较每秒请求数
+
+用法: python benchmarks/bench_http_serving.py [-c 16] [-r 200] [--threads 8] [--workers 2]
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+
+def seed_database(db_path, rows=2000):
+    """创建计数表和余额表并写入测试数据"""
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+    CREATE TABLE kbk_ic_manager (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        card TEXT NOT NULL UNIQUE,
+        department TEXT NOT NULL,
+        status INTEGER NOT NULL DEFAULT 0,
+        last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )''')
+    for table in ['kbk_ic_en_count', 'kbk_ic_cn_count', 'kbk_ic_nm_count']:
+        conn.execute(f'''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            department TEXT NOT NULL,
+            transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''')
+        conn.executemany(
+            f"INSERT INTO {table} (user, department, transaction_date) VALUES (?, ?, ?)",
+            [(f"user{i % 200}", f"部门{i % 10}", f"2025-05-{i % 28 + 1:02d} {i % 24:02d}:{i % 60:02d}:00")
+             for i in range(rows)]
+        )
+    conn.execute('''
+    CREATE TABLE kbk_ic_balance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        department TEXT NOT NULL,
+        balance INTEGER NOT NULL DEFAULT 0,
+        last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.executemany(
+        "INSERT INTO kbk_ic_balance (user, department, balance) VALUES (?, ?, ?)",
+        [(f"user{i}", f"部门{i % 10}", i % 7) for i in range(200)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def run_clients(port, path, clients, requests_per_client):
+    """并发请求同一路径，返回 (每秒请求数, 失败数)"""
+    errors = []
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        for _ in range(requests_per_client):
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+                if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+                    conn.close()
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(str(e))
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    return clients * requests_per_client / elapsed, len(errors)
+
+
+def bench_server(name, command, work_dir, port, path, args):
+    process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(port):
+            print(f"{name}: 启动失败")
+            return
+        # 预热
+        run_clients(port, path, 1, 5)
+        rps, errors = run_clients(port, path, args.clients, args.requests)
+        print(f"{name}: {rps:.0f} 请求/秒, 失败 {errors}")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP服务模式基准测试')
+    parser.add_argument('-c', '--clients', type=int, default=16, help='并发客户端数 (默认: 16)')
+    parser.add_argument('-r', '--requests', type=int, default=200, help='每个客户端的请求数 (默认: 200)')
+    parser.add_argument('--threads', type=int, default=8, help='内嵌服务器线程数 (默认: 8)')
+    parser.add_argument('--workers', type=int, default=2, help='管理界面工作进程数 (默认: 2)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        seed_database(os.path.join(work_dir, 'ic_manager.db'))
+        counts_path = '/api/counts?area=all&department=%E9%83%A8%E9%97%A83'
+        balance_path = '/api/balance?user=user3&department=%E9%83%A8%E9%97%A83'
+        manager = str(ROOT / 'manager_server.py')
+        balance = str(ROOT / 'balance_manager.py')
+        excel_dir = os.path.join(work_dir, 'excel_balance')
+
+        cases = [
+            ("管理界面 开发服务器", [manager, '--dev'], counts_path),
+            ("管理界面 内嵌服务器", [manager, '--threads', str(args.threads), '--workers', str(args.workers)],
+             counts_path),
+            ("余额API 开发服务器", [balance, '-e', excel_dir, '--dev-server'], balance_path),
+            ("余额API 内嵌服务器", [balance, '-e', excel_dir, '--threads', str(args.threads)], balance_path),
+        ]
+        for name, command, path in cases:
+            port = free_port()
+            bench_server(name, [sys.executable] + command + ['-p', str(port)], work_dir, port, path, args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+数据版本计数器
+写入方在自己的事务中把对应的计数器加一：
+- swipes: 每次成功刷卡（只影响当天的统计）
+- swipes_history: 历史刷卡数据被改写（切换事实表、手工修改或删除历史记录后运行 bump）
+- failures: 每次写入失败记录
+读取方（manager_server 的响应缓存）比较 swipes_history 判断缓存是否失效；swipes 和 failures 在每次写入时都会变化，
+用作缓存版本时包含当天的查询永远无法命中，这些查询改由较短的TTL限制数据延迟
+
+用法: python data_version.py [--db ic_manager.db] {show,bump} [name ...]
+"""
+import sys
+import logging
+import sqlite3
+import argparse
+
+logger = logging.getLogger(__name__)
+
+SWIPES = 'swipes'
+SWIPES_HISTORY = 'swipes_history'
+FAILURES = 'failures'
+VERSION_NAMES = [SWIPES, SWIPES_HISTORY, FAILURES]
+
+VERSION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_data_version (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+'''
+
+
+def ensure_version_table(conn):
+    """创建版本表（已存在时不做任何事），由调用方提交"""
+    conn.execute(VERSION_SCHEMA)
+
+
+def bump(cursor, *names):
+    """在调用方的事务中把计数器加一；数据库还没有版本表时不做任何事，不影响写入"""
+    try:
+        for name in names:
+            cursor.execute(
+                "INSERT INTO kbk_ic_data_version (name, version) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+                (name,)
+            )
+    except sqlite3.OperationalError as e:
+        if 'no such table' not in str(e):
+            raise
+
+
+def versions(conn):
+    """返回 {计数器名称: 版本号}，没有版本表时返回空字典"""
+    try:
+        return dict(conn.execute("SELECT name, version FROM kbk_ic_data_version").fetchall())
+    except sqlite3.OperationalError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据版本计数器')
+    parser.add_argument('--db', default='ic_manager.db', help='数据库路径（默认ic_manager.db）')
+    parser.add_argument('command', choices=['show', 'bump'], help='show: 查看版本号；bump: 版本号加一使缓存失效')
+    parser.add_argument('names', nargs='*', help=f'计数器名称，bump 不指定时为全部（{", ".join(VERSION_NAMES)}）')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(VERSION_NAMES)
+    if unknown:
+        parser.error(f"未知的计数器: {', '.join(sorted(unknown))}")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = sqlite3.connect(args.db, timeout=30.0)
+    try:
+        if args.command == 'bump':
+            ensure_version_table(conn)
+            bump(conn, *(args.names or VERSION_NAMES))
+            conn.commit()
+        for name, version in sorted(versions(conn).items()):
+            logger.info(f"{name}: {version}")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
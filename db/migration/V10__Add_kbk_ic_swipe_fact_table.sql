@@ -0,0 +1,42 @@
+-- Migration script to add the unified swipe fact table and its dimensions
+-- Historical rows are copied in chunks by "python swipe_facts.py backfill"; "python swipe_facts.py cutover"
+-- then renames kbk_ic_*_count to *_legacy and recreates the old names as compatibility views
+
+-- Create dimension tables
+CREATE TABLE IF NOT EXISTS kbk_ic_user (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS kbk_ic_department (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS kbk_ic_device (
+    id INTEGER PRIMARY KEY,
+    dn TEXT NOT NULL UNIQUE
+);
+
+-- Create kbk_ic_swipe table (area = jihao, ts = epoch seconds)
+CREATE TABLE IF NOT EXISTS kbk_ic_swipe (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts INTEGER NOT NULL,
+    area INTEGER NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES kbk_ic_user(id),
+    department_id INTEGER NOT NULL REFERENCES kbk_ic_department(id),
+    device_id INTEGER REFERENCES kbk_ic_device(id)
+);
+
+-- Create indexes for area/time-range and department/user statistics
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_swipe_area_ts ON kbk_ic_swipe(area, ts, department_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_swipe_dept_user_ts ON kbk_ic_swipe(department_id, user_id, ts);
+
+-- Create kbk_ic_swipe_backfill table (per legacy table high-water-mark id)
+CREATE TABLE IF NOT EXISTS kbk_ic_swipe_backfill (
+    source TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    copied INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP
+);
@@ -0,0 +1,15 @@
+-- Migration script to add the integer-keyed failure fact table
+-- Reuses the kbk_ic_user / kbk_ic_department dimensions from V10; "python swipe_facts.py cutover"
+-- renames kbk_ic_failure_records to kbk_ic_failure_records_legacy and recreates it as a compatibility view
+
+-- Create kbk_ic_failure table (user_id / department_id are NULL when the card does not exist)
+CREATE TABLE IF NOT EXISTS kbk_ic_failure (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts INTEGER NOT NULL,
+    failure_type INTEGER NOT NULL,
+    user_id INTEGER REFERENCES kbk_ic_user(id),
+    department_id INTEGER REFERENCES kbk_ic_department(id)
+);
+
+-- Create index for time-range / failure type / department statistics
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_failure_ts_type ON kbk_ic_failure(ts, failure_type, department_id);
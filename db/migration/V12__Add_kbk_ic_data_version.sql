@@ -0,0 +1,13 @@
+-- Migration script to add the data version counters used to invalidate manager_server's response cache
+-- Writers bump a counter in the same transaction as their change:
+--   swipes          every successful swipe (only affects the open day)
+--   swipes_history  historical swipe data rewritten (fact table cutover, manual fixes via "python data_version.py bump")
+--   failures        every failure record
+
+-- Create kbk_ic_data_version table
+CREATE TABLE IF NOT EXISTS kbk_ic_data_version (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO kbk_ic_data_version (name, version) VALUES ('swipes', 0), ('swipes_history', 0), ('failures', 0);
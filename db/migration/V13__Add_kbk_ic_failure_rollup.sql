@@ -0,0 +1,26 @@
+-- Migration script to add the failure rollup
+-- Card / device detail columns are owned by swipe_facts.ensure_failure_columns, which runs at http_reader
+-- startup and in swipe_facts backfill/cutover (ensure_fact_tables) and only adds the columns that are missing:
+--   kbk_ic_failure_records (and *_legacy after cutover): card, dn, jihao (the compatibility view is recreated)
+--   kbk_ic_failure: card, jihao, device_id
+-- SQLite has no ADD COLUMN IF NOT EXISTS, so they are not added here; an unconditional ALTER would fail
+-- with "duplicate column name" whenever those code paths ran first
+-- Failures per (hour, dimension, key, failure type) for dimensions card / user / device,
+-- maintained incrementally past a high-water-mark id and served by /api/failures/top
+
+-- Create kbk_ic_failure_rollup table (bucket is local time 'YYYY-MM-DD HH')
+CREATE TABLE IF NOT EXISTS kbk_ic_failure_rollup (
+    bucket TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    failure_type INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    PRIMARY KEY (dimension, bucket, key, failure_type)
+) WITHOUT ROWID;
+
+-- Create kbk_ic_failure_rollup_state table
+CREATE TABLE IF NOT EXISTS kbk_ic_failure_rollup_state (
+    source TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP
+);
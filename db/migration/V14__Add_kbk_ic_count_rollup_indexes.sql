@@ -0,0 +1,9 @@
+-- Migration script to add covering indexes on the swipe statistics rollup
+-- The primary key leads with day, so department/user filters without a date range scanned the whole rollup
+-- Also created by swipe_rollup.ensure_rollup_tables when the refresh task starts
+
+-- Rollup: department (and user) statistics (covering)
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_count_rollup_dept_user ON kbk_ic_count_rollup(area, department, user, day, slot, swipes);
+
+-- Rollup: user statistics (covering)
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_count_rollup_user ON kbk_ic_count_rollup(area, user, day, slot, swipes);
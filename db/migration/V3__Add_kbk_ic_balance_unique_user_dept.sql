@@ -0,0 +1,11 @@
+-- Migration script to make (user, department) unique in kbk_ic_balance
+-- Required by the balance importer's INSERT ... ON CONFLICT(user, department) DO UPDATE
+
+-- Remove duplicate rows, keeping the most recently inserted one for each (user, department)
+DELETE FROM kbk_ic_balance
+WHERE id NOT IN (
+    SELECT MAX(id) FROM kbk_ic_balance GROUP BY user, department
+);
+
+-- Create unique index on (user, department)
+CREATE UNIQUE INDEX IF NOT EXISTS uq_kbk_ic_balance_user_dept ON kbk_ic_balance(user, department);
@@ -0,0 +1,25 @@
+-- Migration script to add incremental balance import tables
+
+-- Snapshot of the last imported balance sheet, diffed against the next import
+CREATE TABLE IF NOT EXISTS kbk_ic_balance_snapshot (
+    user TEXT NOT NULL,
+    department TEXT NOT NULL,
+    balance INTEGER NOT NULL,
+    PRIMARY KEY (user, department)
+);
+
+-- Create kbk_ic_balance_import_history table
+CREATE TABLE IF NOT EXISTS kbk_ic_balance_import_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_name TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    total_rows INTEGER NOT NULL DEFAULT 0,
+    added INTEGER NOT NULL DEFAULT 0,
+    changed INTEGER NOT NULL DEFAULT 0,
+    unchanged INTEGER NOT NULL DEFAULT 0,
+    removed INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    duration_ms INTEGER NOT NULL DEFAULT 0,
+    imported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
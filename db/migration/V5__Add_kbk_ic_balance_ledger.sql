@@ -0,0 +1,25 @@
+-- Migration script to add the append-only balance ledger
+-- kbk_ic_balance.balance is the materialized SUM(amount) per (user, department)
+
+-- Create kbk_ic_balance_ledger table
+CREATE TABLE IF NOT EXISTS kbk_ic_balance_ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    department TEXT NOT NULL,
+    entry_type TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    time_point TEXT,
+    source TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create indexes for range queries by department / user
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_ledger_dept_type_time ON kbk_ic_balance_ledger(department, entry_type, created_at);
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_ledger_user_dept_time ON kbk_ic_balance_ledger(user, department, created_at);
+
+-- Record existing balances as opening entries
+INSERT INTO kbk_ic_balance_ledger (user, department, entry_type, amount, source, created_at)
+SELECT user, department, 'opening', balance, 'opening', datetime('now', 'localtime')
+FROM kbk_ic_balance
+WHERE balance != 0
+  AND NOT EXISTS (SELECT 1 FROM kbk_ic_balance_ledger);
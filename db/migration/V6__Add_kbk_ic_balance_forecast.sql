@@ -0,0 +1,17 @@
+-- Migration script to add the low-balance forecast table
+-- Rebuilt by balance_manager after every balance check tick
+
+-- Create kbk_ic_balance_forecast table
+CREATE TABLE IF NOT EXISTS kbk_ic_balance_forecast (
+    user TEXT NOT NULL,
+    department TEXT NOT NULL,
+    balance INTEGER NOT NULL,
+    meals_per_day REAL NOT NULL,
+    days_left REAL,
+    exhaust_date TEXT,
+    computed_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user, department)
+);
+
+-- Create index for "running out within N days" queries
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_balance_forecast_days_left ON kbk_ic_balance_forecast(days_left);
@@ -0,0 +1,15 @@
+-- Migration script to add the balance tick run ledger
+-- One row per (run_date, time_point); a second run of the same tick is a no-op
+
+-- Create kbk_ic_balance_tick_runs table
+CREATE TABLE IF NOT EXISTS kbk_ic_balance_tick_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_date TEXT NOT NULL,
+    time_point TEXT NOT NULL,
+    source TEXT NOT NULL,
+    runner TEXT,
+    counts TEXT,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP,
+    UNIQUE (run_date, time_point)
+);
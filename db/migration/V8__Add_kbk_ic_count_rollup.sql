@@ -0,0 +1,20 @@
+-- Migration script to add the swipe statistics rollup
+-- Swipes per (day, meal slot, area, department, user), maintained incrementally past a per-area high-water-mark id
+
+-- Create kbk_ic_count_rollup table
+CREATE TABLE IF NOT EXISTS kbk_ic_count_rollup (
+    day TEXT NOT NULL,
+    slot TEXT NOT NULL,
+    area TEXT NOT NULL,
+    department TEXT NOT NULL,
+    user TEXT NOT NULL,
+    swipes INTEGER NOT NULL,
+    PRIMARY KEY (day, slot, area, department, user)
+) WITHOUT ROWID;
+
+-- Create kbk_ic_count_rollup_state table
+CREATE TABLE IF NOT EXISTS kbk_ic_count_rollup_state (
+    area TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP
+);
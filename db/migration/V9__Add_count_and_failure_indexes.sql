@@ -0,0 +1,19 @@
+-- Migration script to add covering indexes for the dashboard queries
+-- Also applied online, one index per transaction, by index_migration.py
+
+-- Count tables: date-range statistics filtered by department/user (covering)
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_cn_count_date_dept_user ON kbk_ic_cn_count(transaction_date, department, user);
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_en_count_date_dept_user ON kbk_ic_en_count(transaction_date, department, user);
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_nm_count_date_dept_user ON kbk_ic_nm_count(transaction_date, department, user);
+
+-- Count tables: department/user statistics without a date range (covering)
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_cn_count_dept_user_date ON kbk_ic_cn_count(department, user, transaction_date);
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_en_count_dept_user_date ON kbk_ic_en_count(department, user, transaction_date);
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_nm_count_dept_user_date ON kbk_ic_nm_count(department, user, transaction_date);
+
+-- Failure records: date-range statistics by failure type and department (covering)
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_failure_records_date_type_dept ON kbk_ic_failure_records(transaction_date, failure_type, department);
+
+-- kbk_ic_manager: balance checks join on (user, department); per-department status statistics
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_manager_user_dept ON kbk_ic_manager(user, department);
+CREATE INDEX IF NOT EXISTS idx_kbk_ic_manager_dept_status ON kbk_ic_manager(department, status);
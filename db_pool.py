@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite连接池
+AiosqlitePool为异步服务提供有上限、可复用的SQLite连接，写事务在进程内串行化；
+SqliteReadPool为多线程的同步服务提供复用的只读连接
+"""
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class AiosqlitePool:
+    """有上限的aiosqlite连接池
+
+    连接在首次需要时创建，最多 max_size 个，并且都属于创建它们的事件循环。
+    SQLite同一时刻只允许一个写事务，写操作通过 transaction() 获取进程内写锁，
+    避免多个连接争抢数据库锁导致 "database is locked"；读操作可在其余连接上并发进行。
+    """
+
+    def __init__(self, path, max_size=4, busy_timeout=5000):
+        """
+        path: SQLite数据库文件路径
+        max_size: 最大连接数
+        busy_timeout: 每个连接的busy_timeout（毫秒）
+        """
+        if max_size < 1:
+            raise ValueError("连接池大小必须大于0")
+        self.path = path
+        self.max_size = max_size
+        self.busy_timeout = busy_timeout
+        self._idle = asyncio.LifoQueue()
+        self._connections = []
+        self._size = 0
+        self._write_lock = asyncio.Lock()
+        self._closed = False
+
+    @property
+    def size(self):
+        """当前已创建的连接数"""
+        return self._size
+
+    @property
+    def idle(self):
+        """当前空闲的连接数"""
+        return self._idle.qsize()
+
+    async def _connect(self):
+        """创建并配置一个新连接"""
+        conn = await aiosqlite.connect(self.path)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        # WAL模式下读连接不会阻塞写连接
+        await conn.execute("PRAGMA journal_mode=WAL")
+        self._connections.append(conn)
+        logger.debug(f"创建数据库连接 {self._size}/{self.max_size}: {self.path}")
+        return conn
+
+    async def _get(self):
+        """取出一个空闲连接，不足时新建，达到上限后等待归还"""
+        if self._closed:
+            raise RuntimeError("连接池已关闭")
+        try:
+            return self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        if self._size < self.max_size:
+            # 先占用名额再await，避免并发创建超过上限
+            self._size += 1
+            try:
+                return await self._connect()
+            except Exception:
+                self._size -= 1
+                raise
+        return await self._idle.get()
+
+    def _release(self, conn):
+        """归还连接"""
+        if not self._closed:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """借出一个连接，用于只读查询"""
+        conn = await self._get()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @asynccontextmanager
+    async def transaction(self, timings=None):
+        """
+        持有写锁并借出一个连接，正常退出时提交，异常时回滚
+        先获取写锁再借连接：等待写锁的写操作不占用连接，读操作不会因连接都被排队的写操作占着而饿死
+        timings: 传入字典时写入本次事务的耗时（秒）：commit（提交，仅成功提交时）和 write_lock（持有写锁）；
+                 每个事务使用自己的字典，并发的事务之间互不覆盖
+        """
+        if timings is None:
+            timings = {}
+        async with self._write_lock:
+            async with self.acquire() as conn:
+                start_time = time.perf_counter()
+                try:
+                    yield conn
+                    commit_start = time.perf_counter()
+                    await conn.commit()
+                    timings['commit'] = time.perf_counter() - commit_start
+                except BaseException:
+                    await conn.rollback()
+                    raise
+                finally:
+                    timings['write_lock'] = time.perf_counter() - start_time
+
+    async def close(self):
+        """关闭所有连接"""
+        self._closed = True
+        connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error(f"关闭数据库连接失败: {str(e)}")
+        self._size = 0
+        while not self._idle.empty():
+            self._idle.get_nowait()
+
+
+class SqliteReadPool:
+    """线程安全的sqlite3只读连接池
+
+    供多线程的同步服务（如Flask）复用读连接，避免每个请求都重新建立连接和设置PRAGMA。
+    连接以 check_same_thread=False 创建，同一时刻只会借给一个线程。
+    """
+
+    def __init__(self, path, max_size=4, busy_timeout=5000):
+        """
+        path: SQLite数据库文件路径
+        max_size: 最大连接数，连接都被借出时等待归还
+        busy_timeout: 每个连接的busy_timeout（毫秒）
+        """
+        if max_size < 1:
+            raise ValueError("连接池大小必须大于0")
+        self.path = path
+        self.max_size = max_size
+        self.busy_timeout = busy_timeout
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def size(self):
+        """当前已创建的连接数"""
+        return len(self._connections)
+
+    def _connect(self):
+        """创建并配置一个新连接"""
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _get(self):
+        """取出一个空闲连接，不足时新建，达到上限后等待归还"""
+        if self._closed:
+            raise RuntimeError("连接池已关闭")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.max_size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+        return self._idle.get()
+
+    @contextmanager
+    def acquire(self):
+        """借出一个只读连接"""
+        conn = self._get()
+        try:
+            yield conn
+        finally:
+            if not self._closed:
+                self._idle.put(conn)
+
+    def close(self):
+        """关闭所有连接"""
+        self._closed = True
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"关闭数据库连接失败: {str(e)}")
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+失败刷卡汇总
+按 (小时, 维度, 键, 失败类型) 汇总失败记录，维度为卡号(card)、用户(user)和终端(device，设备号，
+没有设备号时为机号)。后台任务从高水位id之后增量累加，查询某个时间窗口内失败最多的卡/用户/终端时
+读汇总表，再加上高水位之后尚未汇总的少量原始记录，结果与直接扫描原始表一致。
+切换到事实表（见 swipe_facts.py）之后，原始记录直接从 kbk_ic_failure 读取。
+
+用法: python failure_stats.py [--db ic_manager.db] {refresh,rebuild}
+"""
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+from datetime import datetime
+
+import swipe_facts
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ['card', 'user', 'device']
+# 失败类型与 http_reader 写入的 failure_type 一致
+FAILURE_TYPES = {1: 'inactive', 2: 'unknown_card', 3: 'off_hours'}
+DEFAULT_BATCH_SIZE = 50000
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+ROLLUP_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_failure_rollup (
+        bucket TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        key TEXT NOT NULL,
+        failure_type INTEGER NOT NULL,
+        failures INTEGER NOT NULL,
+        PRIMARY KEY (dimension, bucket, key, failure_type)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_failure_rollup_state (
+        source TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP
+    )
+    '''
+]
+
+
+class FailureSource:
+    """读取原始失败记录的SQL片段；bucket 为本地时间 "YYYY-MM-DD HH"，按字符串比较即可筛选日期或小时范围"""
+
+    def __init__(self, fact_mode=False):
+        if fact_mode:
+            self.name = 'kbk_ic_failure'
+            self.base = "kbk_ic_failure r"
+            self.joined = ("kbk_ic_failure r LEFT JOIN kbk_ic_user u ON u.id = r.user_id "
+                           "LEFT JOIN kbk_ic_device v ON v.id = r.device_id")
+            self.bucket = "strftime('%Y-%m-%d %H', r.ts, 'unixepoch', 'localtime')"
+            self.keys = {'card': "r.card", 'user': "u.name", 'device': "COALESCE(v.dn, 'jihao:' || r.jihao)"}
+        else:
+            self.name = swipe_facts.FAILURE_TABLE
+            self.base = f"{swipe_facts.FAILURE_TABLE} r"
+            self.joined = self.base
+            self.bucket = "substr(r.transaction_date, 1, 13)"
+            self.keys = {'card': "r.card", 'user': "r.user", 'device': "COALESCE(r.dn, 'jihao:' || r.jihao)"}
+
+    def dimension_rows_sql(self, where):
+        """每条原始记录按维度展开为 (bucket, dimension, key, failure_type)，键为空的维度不计"""
+        return " UNION ALL ".join(
+            f"SELECT {self.bucket} AS bucket, '{dimension}' AS dimension, {key} AS key, r.failure_type AS failure_type "
+            f"FROM {self.joined} WHERE {where} AND {key} IS NOT NULL"
+            for dimension, key in self.keys.items()
+        )
+
+
+def ensure_failure_rollup_tables(conn):
+    """创建汇总表和高水位表（已存在时不做任何事）"""
+    for statement in ROLLUP_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def failure_rollups_available(conn):
+    """数据库中是否已有失败汇总表"""
+    row = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+        "AND name IN ('kbk_ic_failure_rollup', 'kbk_ic_failure_rollup_state')"
+    ).fetchone()
+    return row[0] == 2
+
+
+def current_source(conn):
+    """当前的原始失败记录来源；数据库中还没有失败记录表时返回None"""
+    if swipe_facts.failures_enabled(conn):
+        return FailureSource(fact_mode=True)
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                       (swipe_facts.FAILURE_TABLE,)).fetchone()
+    return FailureSource() if row else None
+
+
+def refresh_failures(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    把高水位id之后的失败记录累加进汇总表，每批在一个写事务中同时推进高水位
+    返回本次汇总的原始记录数
+    """
+    source = current_source(conn)
+    if source is None:
+        return 0
+    consumed = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT last_id FROM kbk_ic_failure_rollup_state WHERE source = ?", (source.name,)
+            ).fetchone()
+            last_id = row[0] if row else 0
+            upper_id, rows = conn.execute(
+                f"SELECT MAX(id), COUNT(*) FROM (SELECT r.id FROM {source.base} WHERE r.id > ? ORDER BY r.id LIMIT ?)",
+                (last_id, batch_size)
+            ).fetchone()
+            if not rows:
+                conn.rollback()
+                return consumed
+            conn.execute(f'''
+                INSERT INTO kbk_ic_failure_rollup (bucket, dimension, key, failure_type, failures)
+                SELECT bucket, dimension, key, failure_type, COUNT(*)
+                FROM ({source.dimension_rows_sql("r.id > ? AND r.id <= ?")})
+                WHERE bucket IS NOT NULL
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (dimension, bucket, key, failure_type) DO UPDATE SET failures = failures + excluded.failures
+            ''', (last_id, upper_id) * len(source.keys))
+            conn.execute('''
+                INSERT INTO kbk_ic_failure_rollup_state (source, last_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id, updated_at = excluded.updated_at
+            ''', (source.name, upper_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        consumed += rows
+        if rows < batch_size:
+            return consumed
+
+
+def rebuild_failures(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """清空汇总表和高水位后从头重新汇总，返回汇总的记录数"""
+    ensure_failure_rollup_tables(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM kbk_ic_failure_rollup")
+        conn.execute("DELETE FROM kbk_ic_failure_rollup_state")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return refresh_failures(conn, batch_size)
+
+
+def window_bounds(hours=None, start_day=None, end_day=None, now=None):
+    """
+    把查询窗口转换为 bucket 的范围 [开始, 结束)
+    hours: 最近N小时（含当前小时）；否则使用 start_day（包含）/ end_day（不包含）
+    """
+    if hours is not None:
+        now = now or datetime.now()
+        start = datetime.fromtimestamp(now.timestamp() - (hours - 1) * 3600)
+        return start.strftime('%Y-%m-%d %H'), None
+    return start_day, end_day
+
+
+def top_failures_query(dimension, start=None, end=None, failure_type=None, limit=DEFAULT_LIMIT, fact_mode=False,
+                       use_rollup=True):
+    """
+    某个窗口内失败次数最多的键，返回 (sql, params)
+    结果每行为 (key, failures, inactive, unknown_card, off_hours)；汇总表之外补上高水位之后的原始记录，
+    use_rollup 为False（数据库中没有汇总表）时直接扫描原始记录
+    """
+    source = FailureSource(fact_mode)
+    rolled_conditions = ["dimension = ?"]
+    rolled_params = [dimension]
+    raw_conditions = ["r.id > COALESCE((SELECT last_id FROM kbk_ic_failure_rollup_state WHERE source = ?), 0)"]
+    raw_params = [source.name]
+    if not use_rollup:
+        raw_conditions, raw_params = ["1 = 1"], []
+    for condition, value in (("bucket >= ?", start), ("bucket < ?", end), ("failure_type = ?", failure_type)):
+        if value is not None:
+            rolled_conditions.append(condition)
+            rolled_params.append(value)
+    key = source.keys[dimension]
+    for condition, value in ((f"{source.bucket} >= ?", start), (f"{source.bucket} < ?", end),
+                             ("r.failure_type = ?", failure_type)):
+        if value is not None:
+            raw_conditions.append(condition)
+            raw_params.append(value)
+    type_columns = ", ".join(
+        f"SUM(CASE WHEN failure_type = {code} THEN failures ELSE 0 END) AS {name}"
+        for code, name in FAILURE_TYPES.items()
+    )
+    rolled = (f"SELECT key, failure_type, failures FROM kbk_ic_failure_rollup "
+              f"WHERE {' AND '.join(rolled_conditions)} UNION ALL ") if use_rollup else ""
+    sql = f'''
+        SELECT key, SUM(failures) AS failures, {type_columns}
+        FROM (
+            {rolled}SELECT {key} AS key, r.failure_type AS failure_type, 1 AS failures FROM {source.joined}
+            WHERE {" AND ".join(raw_conditions)} AND {key} IS NOT NULL
+        )
+        GROUP BY key
+        ORDER BY failures DESC, key
+        LIMIT ?
+    '''
+    return sql, (rolled_params if use_rollup else []) + raw_params + [limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='失败刷卡汇总表维护')
+    parser.add_argument('--db', default='ic_manager.db', help='数据库路径（默认ic_manager.db）')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'每个事务汇总的原始记录数（默认{DEFAULT_BATCH_SIZE}）')
+    parser.add_argument('command', choices=['refresh', 'rebuild'], help='refresh: 增量刷新；rebuild: 清空后重建')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = sqlite3.connect(args.db, timeout=30.0, isolation_level=None)
+    try:
+        start_time = time.perf_counter()
+        if args.command == 'rebuild':
+            consumed = rebuild_failures(conn, args.batch_size)
+        else:
+            ensure_failure_rollup_tables(conn)
+            consumed = refresh_failures(conn, args.batch_size)
+        logger.info(f"{args.command} 完成: {consumed} 条失败记录，耗时 {time.perf_counter() - start_time:.3f}秒")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
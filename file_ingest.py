@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Excel文件落盘去抖动
+合并同一路径的watchdog事件，等待文件大小/修改时间稳定后只计算一次哈希、
+校验工作簿可以打开，然后交付一次导入任务
+"""
+import os
+import time
+import logging
+import hashlib
+import threading
+
+import openpyxl
+import prometheus_client as prom
+
+# 设置Prometheus指标
+SUPPRESSED_EVENTS = prom.Counter('excel_ingest_suppressed_events_total', '被合并抑制的文件事件数', ['watcher'])
+INGESTED_FILES = prom.Counter('excel_ingest_files_total', '去抖动后交付导入的文件数', ['watcher'])
+REJECTED_FILES = prom.Counter('excel_ingest_rejected_total', '稳定后校验失败的文件数', ['watcher'])
+HASH_TIME = prom.Histogram('excel_ingest_hash_seconds', '计算文件哈希的耗时(秒)', ['watcher'])
+
+module_logger = logging.getLogger(__name__)
+
+
+def file_md5(file_path):
+    """获取文件的MD5哈希值"""
+    hasher = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        buf = f.read(65536)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = f.read(65536)
+    return hasher.hexdigest()
+
+
+def validate_workbook(file_path):
+    """确认工作簿可以被完整打开（半写入的xlsx会在这里抛出异常）"""
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def hash_and_validate(file_path, watcher, logger=module_logger):
+    """计算已稳定文件的哈希并校验工作簿，文件已被移除或无法打开时返回None"""
+    try:
+        with HASH_TIME.labels(watcher=watcher).time():
+            file_hash = file_md5(file_path)
+        validate_workbook(file_path)
+    except FileNotFoundError:
+        logger.info(f"文件在校验前被移除，忽略: {file_path}")
+        return None
+    except Exception as e:
+        REJECTED_FILES.labels(watcher=watcher).inc()
+        logger.warning(f"文件已稳定但无法作为工作簿打开，等待下一次修改: {file_path}, 错误: {str(e)}")
+        return None
+    INGESTED_FILES.labels(watcher=watcher).inc()
+    return file_hash
+
+
+def is_excel_event_path(path):
+    """判断事件路径是否为需要处理的Excel文件（忽略Office的~$临时文件）"""
+    return path.endswith('.xlsx') and not os.path.basename(path).startswith('~$')
+
+
+class _PendingFile:
+    """等待稳定的文件状态"""
+
+    __slots__ = ('last_event', 'stat', 'stable_since')
+
+    def __init__(self, now):
+        self.last_event = now
+        self.stat = None
+        self.stable_since = now
+
+
+class ExcelIngestDebouncer:
+    """按路径合并文件事件的去抖动导入阶段
+
+    submit() 可在watchdog线程中频繁调用；同一路径在等待期间的后续事件只会被计数，
+    不会重复处理。后台线程定期检查文件的 (大小, 修改时间)，在 settle_seconds 内
+    既没有新事件也没有变化时，计算一次哈希并校验工作簿，然后调用
+    callback(file_path, file_hash)。
+    """
+
+    def __init__(self, callback, name='excel', settle_seconds=2.0, poll_interval=0.5, logger=None):
+        """
+        callback: 文件稳定且校验通过后调用，参数为 (file_path, file_hash)
+        name: 监控名称，用于线程名和指标标签
+        settle_seconds: 文件需要保持不变的秒数
+        poll_interval: 检查文件状态的间隔秒数
+        logger: 使用的日志记录器，默认使用本模块的logger
+        """
+        self.callback = callback
+        self.name = name
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.logger = logger or module_logger
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=f"ExcelIngest-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, file_path):
+        """登记一次文件事件"""
+        with self._cond:
+            if self._stopped:
+                return
+            pending = self._pending.get(file_path)
+            if pending is not None:
+                pending.last_event = time.monotonic()
+                SUPPRESSED_EVENTS.labels(watcher=self.name).inc()
+                return
+            self._pending[file_path] = _PendingFile(time.monotonic())
+            self._cond.notify()
+        self.logger.info(f"文件事件已登记，等待文件稳定: {file_path}")
+
+    def pending_count(self):
+        """当前等待稳定的文件数"""
+        with self._cond:
+            return len(self._pending)
+
+    def stop(self):
+        """停止后台线程，丢弃尚未稳定的文件"""
+        with self._cond:
+            self._stopped = True
+            self._pending.clear()
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        """后台线程：轮询等待中的文件并交付已稳定的文件"""
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._cond.wait(self.poll_interval)
+                if self._stopped:
+                    return
+                ready = self._collect_ready()
+            for file_path in ready:
+                self._ingest(file_path)
+
+    def _collect_ready(self):
+        """找出已经稳定的文件并从等待表中移除（调用方持有锁）"""
+        now = time.monotonic()
+        ready = []
+        for file_path, pending in list(self._pending.items()):
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
+                self.logger.info(f"文件在稳定前被移除，忽略: {file_path}")
+                del self._pending[file_path]
+                continue
+            stat = (st.st_size, st.st_mtime_ns)
+            if stat != pending.stat:
+                pending.stat = stat
+                pending.stable_since = now
+                continue
+            if now - max(pending.stable_since, pending.last_event) >= self.settle_seconds:
+                ready.append(file_path)
+                del self._pending[file_path]
+        return ready
+
+    def _ingest(self, file_path):
+        """计算哈希、校验工作簿并交付一次导入任务"""
+        file_hash = hash_and_validate(file_path, self.name, self.logger)
+        if file_hash is None:
+            return
+
+        self.logger.info(f"文件已稳定并通过校验，交付导入: {file_path}")
+        try:
+            self.callback(file_path, file_hash)
+        except Exception as e:
+            self.logger.error(f"处理文件 {file_path} 时出错: {str(e)}")
@@ -17,6 +17,10 @@ from logging.handlers import RotatingFileHandler
 import os
 from datetime import time as time_obj
 
+import swipe_facts
+import swipe_events
+import data_version
+
 
 # 定义允许刷卡的时间段
 breakfast = (time_obj(5, 25), time_obj(7, 40))  # 05:25-07:40
@@ -142,9 +146,18 @@ def init_database():
             user TEXT,
             department TEXT,
             transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            failure_type INTEGER NOT NULL
+            failure_type INTEGER NOT NULL,
+            card TEXT,
+            dn TEXT,
+            jihao TEXT
         )
         ''')
+        # 旧数据库补齐卡号、设备号和机号列（已切换为事实表视图时重建视图）
+        swipe_facts.ensure_failure_columns(cursor)
+        
+        # 创建数据版本表，管理界面据此判断统计缓存是否失效
+        logger.info("[DB] 创建表: kbk_ic_data_version")
+        data_version.ensure_version_table(cursor)
         
         conn.commit()
         logger.info("[DB] 数据库初始化完成并已提交更改")
@@ -200,6 +213,18 @@ def get_local_timestamp():
     """获取本地时区的时间戳字符串"""
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+def insert_failure_record(cursor, failure_type, card, jihao, dn=None, user=None, department=None):
+    """写入失败记录（含卡号、设备号和机号）：已切换到事实表时写入整数编码的 kbk_ic_failure，否则写入旧表"""
+    if swipe_facts.failures_enabled(cursor):
+        swipe_facts.record_failure(cursor, failure_type, user, department, card=card, dn=dn, jihao=jihao)
+    else:
+        cursor.execute(
+            'INSERT INTO kbk_ic_failure_records (user, department, failure_type, transaction_date, card, dn, jihao) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (user, department, failure_type, get_local_timestamp(), card, dn, jihao)
+        )
+    data_version.bump(cursor, data_version.FAILURES)
+
 def reset_daily_counts_if_needed():
     """检查并重置每日刷卡计数（凌晨5点开始新周期）"""
     global daily_swipe_counts, last_reset_day
@@ -254,18 +279,13 @@ def process_card(card, jihao, info, dn=None):
             if result:
                 user, department = result
                 logger.info(f"[DB] 插入失败记录: user={user}, department={department}, failure_type=3")
-                cursor.execute(
-                    'INSERT INTO kbk_ic_failure_records (user, department, failure_type, transaction_date) VALUES (?, ?, ?, ?)',
-                    (user, department, 3, get_local_timestamp())  # 时间段错误
-                )
+                insert_failure_record(cursor, 3, card, jihao, dn, user, department)  # 时间段错误
             else:
                 logger.info(f"[DB] 插入失败记录: 卡不存在, failure_type=3")
-                cursor.execute(
-                    'INSERT INTO kbk_ic_failure_records (failure_type, transaction_date) VALUES (?, ?)',
-                    (3, get_local_timestamp())  # 时间段错误，卡不存在
-                )
+                insert_failure_record(cursor, 3, card, jihao, dn)  # 时间段错误，卡不存在
             conn.commit()
             logger.info("[DB] 已提交失败记录（时间段错误）")
+            swipe_events.publish(swipe_events.OUTCOME_OFF_HOURS, jihao, result[1] if result else None)
             logger.warning(f"[BUSINESS] Card swiped outside allowed time periods: {card}")
             # 构造失败响应
             display_text = GetChineseCode("{错误}不在允许的用餐时间")
@@ -291,12 +311,10 @@ def process_card(card, jihao, info, dn=None):
         if not card_info:
             logger.warning(f"[DB] 卡号不存在: {card}")
             # 记录失败信息
-            cursor.execute(
-                'INSERT INTO kbk_ic_failure_records (failure_type, transaction_date) VALUES (?, ?)',
-                (2, get_local_timestamp())  # 卡号不存在
-            )
+            insert_failure_record(cursor, 2, card, jihao, dn)  # 卡号不存在
             conn.commit()
             logger.info("[DB] 已提交失败记录（卡号不存在）")
+            swipe_events.publish(swipe_events.OUTCOME_UNKNOWN_CARD, jihao)
             logger.warning(f"[BUSINESS] Card not found: {card}")
             
             # 构造失败响应
@@ -313,12 +331,10 @@ def process_card(card, jihao, info, dn=None):
         if status != 1:
             logger.warning(f"[DB] 卡片未激活: card={card}, status={status}")
             # 记录失败信息
-            cursor.execute(
-                'INSERT INTO kbk_ic_failure_records (user, department, failure_type, transaction_date) VALUES (?, ?, ?, ?)',
-                (user, department, 1, get_local_timestamp())  # 未激活
-            )
+            insert_failure_record(cursor, 1, card, jihao, dn, user, department)  # 未激活
             conn.commit()
             logger.info("[DB] 已提交失败记录（卡片未激活）")
+            swipe_events.publish(swipe_events.OUTCOME_INACTIVE, jihao, department)
             logger.warning(f"[BUSINESS] Card inactive: {card}, User: {user}")
             
             # 构造失败响应
@@ -341,16 +357,24 @@ def process_card(card, jihao, info, dn=None):
         elif jihao == "3":
             count_table = "kbk_ic_nm_count"
         
-        if count_table:
+        if count_table and swipe_facts.facts_enabled(cursor):
+            # 已切换到统一刷卡事实表，直接写入整数编码的记录（旧表名是兼容视图）
+            logger.info(f"[DB] 插入刷卡事实表: area={jihao}, user={user}, department={department}, dn={dn}")
+            swipe_facts.record_swipe(cursor, swipe_facts.AREA_CODES[count_table], user, department, dn)
+        elif count_table:
             logger.info(f"[DB] 插入计数表: {count_table}, user={user}, department={department}")
             cursor.execute(
                 f'INSERT INTO {count_table} (user, department, transaction_date) VALUES (?, ?, ?)',
                 (user, department, get_local_timestamp())
             )
         
+        if count_table:
+            data_version.bump(cursor, data_version.SWIPES)
+        
         # 提交事务
         conn.commit()
         logger.info("[DB] 刷卡业务处理成功并已提交更改")
+        swipe_events.publish(swipe_events.OUTCOME_SUCCESS, jihao, department)
         
         now = datetime.datetime.now() # Get current time again for count logic
         jihao_specific_count_for_display = 0
@@ -391,6 +415,7 @@ def process_card(card, jihao, info, dn=None):
             except Exception as rollback_error:
                 logger.error(f"[DB] 回滚事务失败: {rollback_error}")
         logger.error(f"[BUSINESS] Database error: {e}")
+        swipe_events.publish(swipe_events.OUTCOME_ERROR, jihao)
         display_text = GetChineseCode("{错误}系统异常DB")
         return f"{response_base},{display_text},10,0,,0,0"
         
@@ -402,6 +427,7 @@ def process_card(card, jihao, info, dn=None):
                 logger.info("[DB] 事务已回滚")
             except Exception as rollback_error:
                 logger.error(f"[DB] 回滚事务失败: {rollback_error}")
+        swipe_events.publish(swipe_events.OUTCOME_ERROR, jihao)
         display_text = GetChineseCode("{错误}系统异常过程")
         return f"{response_base},{display_text},10,0,,0,0"
         
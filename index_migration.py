@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+在线索引迁移
+逐条执行 db/migration/V9 中的建索引语句（每个索引一个短事务，表不存在时跳过），
+对建了索引的表做采样ANALYZE，然后用 EXPLAIN QUERY PLAN 确认管理界面的统计查询都走索引。
+服务运行时也可以执行：WAL模式下建索引期间读不受影响，写会在busy_timeout内等待。
+
+用法: python index_migration.py [--db ic_manager.db] [--check-only]
+"""
+import re
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+from pathlib import Path
+
+import swipe_rollup
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_FILE = Path(__file__).parent / 'db' / 'migration' / 'V9__Add_count_and_failure_indexes.sql'
+# ANALYZE每个索引最多采样的行数，避免千万行的表上长时间持有锁
+ANALYZE_LIMIT = 1000
+
+INDEX_PATTERN = re.compile(r'CREATE\s+INDEX\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+ON\s+(\w+)', re.IGNORECASE)
+SCAN_PATTERN = re.compile(r'SCAN (\w+)')
+
+
+def migration_statements(path=MIGRATION_FILE):
+    """读取迁移文件，返回 [(索引名, 表名, 语句)]"""
+    statements = []
+    for line in Path(path).read_text(encoding='utf-8').splitlines():
+        line = line.strip()
+        if not line or line.startswith('--'):
+            continue
+        match = INDEX_PATTERN.match(line)
+        if not match:
+            raise ValueError(f"迁移文件中只能包含建索引语句: {line}")
+        statements.append((match.group(1), match.group(2), line))
+    return statements
+
+
+def existing_objects(conn, object_type):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = ?", (object_type,))}
+
+
+def apply_indexes(conn, path=MIGRATION_FILE):
+    """
+    创建迁移文件中尚不存在的索引并ANALYZE相关的表
+    返回 {索引名: 'created' | 'exists' | 'skipped'}，skipped 表示表不存在
+    """
+    results = {}
+    analyzed_tables = set()
+    tables = existing_objects(conn, 'table')
+    indexes = existing_objects(conn, 'index')
+    for index_name, table, statement in migration_statements(path):
+        if table not in tables:
+            logger.info(f"表 {table} 不存在，跳过索引 {index_name}")
+            results[index_name] = 'skipped'
+            continue
+        if index_name in indexes:
+            results[index_name] = 'exists'
+            continue
+        start_time = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(statement)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"已创建索引 {index_name}，耗时 {time.perf_counter() - start_time:.2f}秒")
+        results[index_name] = 'created'
+        analyzed_tables.add(table)
+
+    if analyzed_tables:
+        conn.execute(f"PRAGMA analysis_limit = {ANALYZE_LIMIT}")
+        for table in sorted(analyzed_tables):
+            conn.execute(f"ANALYZE {table}")
+        logger.info(f"已ANALYZE: {', '.join(sorted(analyzed_tables))}")
+    return results
+
+
+def dashboard_queries(conn, department='部门', user='用户'):
+    """
+    管理界面和Streamlit页面使用的统计查询，返回 [(名称, sql, params)]，只包含相关表都存在的查询
+    department/user 为查询条件中使用的示例值
+    """
+    from manager_server import build_counts_query
+
+    tables = existing_objects(conn, 'table')
+    count_tables = swipe_rollup.existing_count_tables(conn)
+    queries = []
+    if count_tables:
+        queries.append(("计数统计(日期范围)",) + build_counts_query(count_tables, '2025-05-01', '2025-06-01'))
+        queries.append(("计数统计(日期范围+部门+用户)",) + build_counts_query(
+            count_tables, '2025-05-01', '2025-06-01', department, user))
+        queries.append(("计数统计(部门)",) + build_counts_query(count_tables, department=department))
+        queries.append(("计数统计(部门+用户)",) + build_counts_query(count_tables, department=department, user=user))
+        if swipe_rollup.rollups_available(conn):
+            queries.append(("汇总表计数统计",) + swipe_rollup.rollup_counts_query(
+                count_tables, '2025-05-01', '2025-06-01', department))
+            queries.append(("汇总表计数统计(部门)",) + swipe_rollup.rollup_counts_query(
+                count_tables, department=department))
+    if 'kbk_ic_failure_records' in tables:
+        queries.append(("失败记录统计", '''
+            SELECT failure_type, department, COUNT(*) FROM kbk_ic_failure_records
+            WHERE transaction_date >= ? AND transaction_date < ?
+            GROUP BY failure_type, department
+        ''', ['2025-05-01', '2025-06-01']))
+    if 'kbk_ic_manager' in tables:
+        queries.append(("部门状态统计", '''
+            SELECT department, COUNT(*) as total, SUM(CASE WHEN status = 1 THEN 1 ELSE 0 END) as active
+            FROM kbk_ic_manager GROUP BY department ORDER BY department
+        ''', []))
+        queries.append(("按用户更新状态", '''
+            SELECT id FROM kbk_ic_manager WHERE user IN (?, ?)
+        ''', [user, user + '1']))
+    return queries
+
+
+def verify_query_plans(conn, path=MIGRATION_FILE):
+    """
+    用 EXPLAIN QUERY PLAN 检查统计查询：迁移涉及的表不能出现不带索引的全表扫描
+    返回 [(查询名称, 是否使用索引, 查询计划文本)]
+    """
+    indexed_tables = {table for _, table, _ in migration_statements(path)}
+    results = []
+    for name, sql, params in dashboard_queries(conn):
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        full_scans = [detail for detail in plan
+                      if (match := SCAN_PATTERN.match(detail)) and match.group(1) in indexed_tables
+                      and 'INDEX' not in detail]
+        results.append((name, not full_scans, "\n".join(plan)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='在线创建统计查询索引并检查查询计划')
+    parser.add_argument('--db', default='ic_manager.db', help='数据库路径（默认ic_manager.db）')
+    parser.add_argument('--check-only', action='store_true', help='只检查查询计划，不建索引')
+    parser.add_argument('--busy-timeout', type=int, default=30, help='等待写锁的秒数（默认30）')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = sqlite3.connect(args.db, timeout=args.busy_timeout, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        if not args.check_only:
+            results = apply_indexes(conn)
+            logger.info(f"索引迁移完成: {results}")
+        failed = 0
+        for name, uses_index, plan in verify_query_plans(conn):
+            if uses_index:
+                logger.info(f"[OK] {name}")
+            else:
+                failed += 1
+                logger.warning(f"[全表扫描] {name}\n{plan}")
+        return 1 if failed else 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+日志尾部读取
+按字节位置读取按大小轮转的日志（ic_manager.log, ic_manager.log.1 ... ic_manager.log.5），
+不再整文件读入内存：
+1. 尾部: 从文件末尾向前按块查找最后N行，当前文件不够时继续读取轮转文件
+2. 游标: "<inode>-<偏移>"，RotatingFileHandler 轮转时只改名不改inode，游标在轮转后仍然有效，
+   从游标读取时会跨越到更新的文件
+3. since: 按行首时间戳在文件内二分查找，只读取需要的部分
+4. follow: 每个订阅者每秒stat一次日志文件，只有文件增长或轮转时才读取新增的完整行
+"""
+import os
+import time
+from datetime import datetime
+
+# 与 http_reader 中 RotatingFileHandler 的 backupCount 一致
+LOG_BACKUP_COUNT = 5
+DEFAULT_LINES = 200
+MAX_LINES = 5000
+# 单次响应最多返回的字节数，超出部分由客户端带着游标继续读取
+MAX_READ_BYTES = 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+# 行首时间戳 "YYYY-MM-DD HH:MM:SS"
+TIMESTAMP_LENGTH = 19
+
+FOLLOW_POLL_INTERVAL = 1.0
+FOLLOW_KEEPALIVE = 15
+# 单个follow连接的最长时间，超时后关闭，浏览器EventSource会带着 Last-Event-ID 自动重连
+# 同时follow的连接数与实时刷卡订阅共用 wsgi_server.stream_slots 的名额
+FOLLOW_MAX_SECONDS = 300
+
+
+def log_files(path, backup_count=LOG_BACKUP_COUNT):
+    """返回存在的日志文件 [(路径, os.stat结果)]，从最旧的轮转文件到当前文件"""
+    files = []
+    for name in [f"{path}.{i}" for i in range(backup_count, 0, -1)] + [path]:
+        try:
+            files.append((name, os.stat(name)))
+        except FileNotFoundError:
+            continue
+    return files
+
+
+def make_cursor(st, offset):
+    return f"{st.st_ino}-{offset}"
+
+
+def parse_cursor(value):
+    """解析游标，返回 (inode, 偏移)；纯数字表示当前文件内的字节偏移，inode为None；格式不合法时抛出 ValueError"""
+    value = str(value).strip()
+    if '-' in value:
+        inode, offset = value.split('-', 1)
+        inode, offset = int(inode), int(offset)
+    else:
+        inode, offset = None, int(value)
+    if offset < 0:
+        raise ValueError(f"无效的日志游标: {value}")
+    return inode, offset
+
+
+def parse_since(value):
+    """把 since 参数规范为行首时间戳格式，支持日期、日期时间和ISO格式；格式不合法时抛出 ValueError"""
+    return datetime.fromisoformat(value.strip()).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def end_cursor(path):
+    """当前文件末尾的游标，文件不存在时返回None"""
+    files = log_files(path, 0)
+    return make_cursor(files[0][1], files[0][1].st_size) if files else None
+
+
+def _decode(data):
+    return data.decode('utf-8', errors='ignore')
+
+
+def tail(path, lines=DEFAULT_LINES):
+    """返回 (最后lines行文本, 当前文件末尾的游标)，从文件末尾按块向前读取，跨越轮转文件"""
+    files = log_files(path)
+    if not files:
+        return '', None
+    chunks = []
+    newlines = 0
+    budget = MAX_READ_BYTES
+    for name, st in reversed(files):
+        with open(name, 'rb') as f:
+            position = st.st_size
+            while position > 0 and newlines <= lines and budget > 0:
+                size = min(BLOCK_SIZE, position, budget)
+                position -= size
+                budget -= size
+                f.seek(position)
+                block = f.read(size)
+                chunks.append(block)
+                newlines += block.count(b'\n')
+        if newlines > lines or budget <= 0:
+            break
+    data = b''.join(reversed(chunks))
+    # 当前文件末尾未写完的行留给下一次读取
+    current = files[-1][1]
+    partial = min(len(data) - data.rfind(b'\n') - 1, current.st_size)
+    data = data[:len(data) - partial]
+    text = _decode(data).splitlines()[-lines:] if lines else []
+    return '\n'.join(text) + ('\n' if text else ''), make_cursor(current, current.st_size - partial)
+
+
+def read_from(path, cursor, max_bytes=MAX_READ_BYTES):
+    """
+    从游标读取之后的完整行，返回 (文本, 新游标, 是否还有剩余)
+    游标所在文件已被轮转删除时从最旧的文件开始；只返回以换行结束的行，未写完的行留到下次
+    """
+    inode, offset = parse_cursor(cursor)
+    files = log_files(path)
+    if not files:
+        return '', cursor, False
+    if inode is None:
+        start = len(files) - 1
+    else:
+        start = next((i for i, (_, st) in enumerate(files) if st.st_ino == inode), None)
+        if start is None:
+            start, offset = 0, 0
+    chunks = []
+    budget = max_bytes
+    new_cursor = make_cursor(files[start][1], min(offset, files[start][1].st_size))
+    for index in range(start, len(files)):
+        name, st = files[index]
+        if index > start or offset > st.st_size:
+            offset = 0
+        remaining = st.st_size - offset
+        with open(name, 'rb') as f:
+            f.seek(offset)
+            data = f.read(min(remaining, budget))
+        limited = len(data) < remaining
+        if limited or index == len(files) - 1:
+            # 只返回完整的行；轮转文件中超过预算的单行不截断，避免游标停滞
+            complete = data[:data.rfind(b'\n') + 1]
+            data = complete if complete or index == len(files) - 1 else data
+        chunks.append(data)
+        budget -= len(data)
+        new_cursor = make_cursor(st, offset + len(data))
+        if offset + len(data) < st.st_size:
+            return _decode(b''.join(chunks)), new_cursor, limited
+    return _decode(b''.join(chunks)), new_cursor, False
+
+
+def _entry_at(f, position, size):
+    """返回 position 处或之后第一条带时间戳的行 (行首偏移, 时间戳)，没有时返回 (size, None)"""
+    if position > 0:
+        # 从前一个字节开始丢弃半行，position 恰好是行首时不会跳过这一行
+        f.seek(position - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    while True:
+        start = f.tell()
+        if start >= size:
+            return size, None
+        line = f.readline()
+        stamp = _decode(line[:TIMESTAMP_LENGTH])
+        if len(stamp) == TIMESTAMP_LENGTH and stamp[:2].isdigit() and stamp[4] == '-' and stamp[13] == ':':
+            return start, stamp
+
+
+def find_since(path, since):
+    """返回第一条时间戳不早于 since 的日志行的游标，只在一个文件内二分查找"""
+    files = log_files(path)
+    if not files:
+        return None
+    target = files[0]
+    for name, st in files:
+        with open(name, 'rb') as f:
+            _, stamp = _entry_at(f, 0, st.st_size)
+        if stamp is not None and stamp <= since:
+            target = (name, st)
+    name, st = target
+    with open(name, 'rb') as f:
+        low, high = 0, st.st_size
+        while low < high:
+            middle = (low + high) // 2
+            start, stamp = _entry_at(f, middle, st.st_size)
+            if stamp is None or stamp >= since:
+                high = middle
+            else:
+                low = start + 1
+        start, _ = _entry_at(f, low, st.st_size)
+    return make_cursor(st, start)
+
+
+def read_range(path, start, stop):
+    """读取当前文件 [start, stop) 字节，返回 (字节, 文件大小)"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(max(0, min(stop, size) - start)), size
+
+
+def sse_event(text, cursor):
+    """把若干行日志编码为一个SSE事件，id为读完这些行后的游标"""
+    data = ''.join(f"data: {line}\n" for line in text.splitlines())
+    return f"id: {cursor}\n{data}\n"
+
+
+def follow(path, cursor=None, poll_interval=FOLLOW_POLL_INTERVAL, keepalive=FOLLOW_KEEPALIVE,
+           max_seconds=FOLLOW_MAX_SECONDS, sleep=time.sleep):
+    """
+    SSE事件生成器：从游标（默认当前文件末尾）开始只推送新增的完整行
+    只在文件大小或inode变化时读取，空闲时定期发送注释行保活；达到 max_seconds 后结束
+    """
+    cursor = cursor or end_cursor(path) or '0'
+    yield f"retry: {int(poll_interval * 1000)}\n\n"
+    started = last_sent = time.monotonic()
+    seen = None
+    while time.monotonic() - started < max_seconds:
+        files = log_files(path, 0)
+        state = (files[0][1].st_ino, files[0][1].st_size) if files else None
+        if state != seen:
+            seen = state
+            more = True
+            while more:
+                text, cursor, more = read_from(path, cursor)
+                if text:
+                    last_sent = time.monotonic()
+                    yield sse_event(text, cursor)
+        if time.monotonic() - last_sent >= keepalive:
+            last_sent = time.monotonic()
+            yield ": keepalive\n\n"
+        sleep(poll_interval)
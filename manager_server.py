@@ -1,10 +1,23 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+from flask import Flask, Response, request, jsonify, send_from_directory, render_template_string, stream_with_context
 from flask_cors import CORS
 import os
 import sqlite3
-from datetime import datetime, time as time_obj
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 import argparse
+import logging
+import prometheus_client as prom
+
+import wsgi_server
+import log_tail
+import swipe_events
+import swipe_export
+import data_version
+import response_cache
+import swipe_facts
+import swipe_rollup
+import failure_stats
+from swipe_rollup import TIME_SLOTS
 
 app = Flask(__name__)
 CORS(app)
@@ -16,6 +29,15 @@ ALLOWED_EXTENSIONS = {'xls', 'xlsx'}
 
 os.makedirs(EXCEL_DIR, exist_ok=True)
 
+# /api/counts 的响应缓存，按数据版本和TTL失效
+counts_cache = response_cache.ResponseCache('counts')
+
+# /api/failures/top 的响应缓存，失败记录写入后失效
+failures_cache = response_cache.ResponseCache('failures')
+
+# 实时刷卡事件，第一次订阅时在当前工作进程内启动接收线程
+swipe_hub = swipe_events.SwipeEventHub()
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -72,6 +94,9 @@ def index():
             <label>部门: <input type="text" id="department"></label>
             <label>用户: <input type="text" id="user"></label>
             <button type="button" onclick="fetchCounts()">查询</button>
+            <button type="button" onclick="exportRecords('swipes', 'csv')">导出刷卡CSV</button>
+            <button type="button" onclick="exportRecords('swipes', 'xlsx')">导出刷卡XLSX</button>
+            <button type="button" onclick="exportRecords('failures', 'csv')">导出失败记录CSV</button>
         </form>
         <table id="countTable">
             <thead>
@@ -89,6 +114,13 @@ def index():
         </table>
     </div>
 
+    <!-- 实时刷卡区 -->
+    <div class="section">
+        <h2>实时刷卡</h2>
+        <div>最近一秒: <span id="liveSecond">-</span></div>
+        <div>打开页面以来: <span id="liveTotal">-</span></div>
+    </div>
+
     <!-- 日志查看区 -->
     <div class="section">
         <h2>日志查看</h2>
@@ -132,7 +164,25 @@ def index():
             setDateMode('day');
             fetchCounts();
             fetchLog();
+            watchSwipes();
         };
+        // 实时刷卡：服务端按秒聚合后推送，页面只累加
+        const outcomeNames = {success: '成功', inactive: '未激活', unknown_card: '卡号不存在', off_hours: '非用餐时间', error: '异常'};
+        const liveTotals = {};
+        function formatCounts(counts) {
+            return Object.entries(counts).map(([k, v]) => `${outcomeNames[k] || k} ${v}`).join('，') || '-';
+        }
+        function watchSwipes() {
+            if (!window.EventSource) return;
+            const source = new EventSource('/api/swipes/stream?mode=counts');
+            source.addEventListener('counts', e => {
+                const data = JSON.parse(e.data);
+                for (const [k, v] of Object.entries(data.counts)) liveTotals[k] = (liveTotals[k] || 0) + v;
+                document.getElementById('liveSecond').textContent =
+                    new Date(data.ts * 1000).toLocaleTimeString() + ' ' + formatCounts(data.counts);
+                document.getElementById('liveTotal').textContent = formatCounts(liveTotals);
+            });
+        }
         // 用餐计数查询
         function fetchCounts() {
             const area = document.getElementById('areaSelect').value;
@@ -155,12 +205,36 @@ def index():
             });
         }
 
-        // 日志查看
+        // 按当前筛选条件导出，浏览器直接下载
+        function exportRecords(kind, format) {
+            const params = new URLSearchParams({
+                area: document.getElementById('areaSelect').value, dateType,
+                startDate: document.getElementById('startDate').value,
+                endDate: document.getElementById('endDate').value,
+                department: document.getElementById('department').value,
+                user: document.getElementById('user').value, format
+            });
+            window.location = `/api/export/${kind}?` + params;
+        }
+
+        // 日志查看：先读取最后200行，再通过SSE只接收新增的行
+        let logSource = null;
+        function appendLog(text) {
+            const box = document.getElementById('logBox');
+            const lines = (box.textContent + text).split('\n');
+            box.textContent = lines.slice(-2000).join('\n');
+            box.scrollTop = box.scrollHeight;
+        }
         function fetchLog() {
-            fetch('/api/log')
-            .then(res => res.text())
-            .then(text => {
-                document.getElementById('logBox').textContent = text;
+            fetch('/api/log?lines=200')
+            .then(res => res.text().then(text => [text, res.headers.get('X-Log-Cursor')]))
+            .then(([text, cursor]) => {
+                document.getElementById('logBox').textContent = '';
+                appendLog(text);
+                if (logSource) logSource.close();
+                if (!window.EventSource || !cursor) return;
+                logSource = new EventSource('/api/log?' + new URLSearchParams({follow: '1', offset: cursor}));
+                logSource.onmessage = e => appendLog(e.data + '\n');
             });
         }
 
@@ -182,103 +256,326 @@ def index():
 </html>
     """)
 
-@app.route('/api/counts')
-def get_counts():
-    area = request.args.get('area', 'all')
+def date_range_bound(value, date_type, upper=False):
+    """
+    把 startDate/endDate 转换为 transaction_date 的范围边界，使条件可以使用索引
+    下界返回区间第一天 (>=)，上界返回区间结束后的第一天 (<)；格式不合法时抛出 ValueError
+    """
+    if date_type == 'month':
+        first = datetime.strptime(value, '%Y-%m').date()
+        if upper:
+            first = first.replace(year=first.year + first.month // 12, month=first.month % 12 + 1)
+    elif date_type == 'year':
+        first = datetime.strptime(value, '%Y').date()
+        if upper:
+            first = first.replace(year=first.year + 1)
+    else:
+        first = datetime.strptime(value, '%Y-%m-%d').date()
+        if upper:
+            first += timedelta(days=1)
+    return first.strftime('%Y-%m-%d')
+
+def build_counts_query(table_names, start_day=None, end_day=None, department='', user=''):
+    """
+    直接扫描计数表的 UNION ALL 统计查询（数据库中没有汇总表时使用），返回 (sql, params)
+    start_day 为包含的开始日期，end_day 为不包含的结束日期；每张表一个分组聚合，时段在SQL中按时间字符串归类
+    """
+    conditions = []
+    params = []
+    if start_day:
+        conditions.append("transaction_date >= ?")
+        params.append(start_day)
+    if end_day:
+        conditions.append("transaction_date < ?")
+        params.append(end_day)
+    if department:
+        conditions.append("department = ?")
+        params.append(department)
+    if user:
+        conditions.append("user = ?")
+        params.append(user)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+    slot_columns = ", ".join(
+        f"COUNT(CASE WHEN substr(transaction_date, 12, 8) BETWEEN '{slot_start}' AND '{slot_end}' THEN 1 END) AS {name}"
+        for name, slot_start, slot_end in TIME_SLOTS
+    )
+    selects = [f"SELECT '{table}' AS area, COUNT(*) AS count, {slot_columns} FROM {table}{where}"
+               for table in table_names]
+    return " UNION ALL ".join(selects), params * len(table_names)
+
+def count_filters():
+    """
+    解析 /api/counts 和导出共用的筛选参数，返回 (表名列表, 开始日期, 结束日期, 部门, 用户)
+    日期格式不合法时抛出 ValueError
+    """
     date_type = request.args.get('dateType', 'day')
     start_date = request.args.get('startDate')
     end_date = request.args.get('endDate')
-    department = request.args.get('department', '').strip()
-    user = request.args.get('user', '').strip()
+    start_day = date_range_bound(start_date, date_type) if start_date else None
+    end_day = date_range_bound(end_date, date_type, upper=True) if end_date else None
+    return (get_table_names(request.args.get('area', 'all')), start_day, end_day,
+            request.args.get('department', '').strip(), request.args.get('user', '').strip())
+
+@app.route('/api/counts')
+def get_counts():
+    try:
+        table_names, start_day, end_day, department, user = count_filters()
+    except ValueError:
+        return jsonify({'message': '日期格式错误'}), 400
 
-    table_names = get_table_names(area)
     conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    result = []
-
-    # 定义时段
-    morning_start = time_obj(5, 25)
-    morning_end = time_obj(7, 40)
-    noon_start = time_obj(11, 25)
-    noon_end = time_obj(12, 40)
-    evening_start = time_obj(16, 55)
-    evening_end = time_obj(19, 40)
-
-    for table in table_names:
-        sql = f"SELECT transaction_date FROM {table} WHERE 1=1"
-        params = []
-
-        if start_date:
-            if date_type == 'day':
-                sql += " AND date(transaction_date) >= ?"
-                params.append(start_date)
-            elif date_type == 'month':
-                sql += " AND strftime('%Y-%m', transaction_date) >= ?"
-                params.append(start_date)
-            elif date_type == 'year':
-                sql += " AND strftime('%Y', transaction_date) >= ?"
-                params.append(start_date)
-        if end_date:
-            if date_type == 'day':
-                sql += " AND date(transaction_date) <= ?"
-                params.append(end_date)
-            elif date_type == 'month':
-                sql += " AND strftime('%Y-%m', transaction_date) <= ?"
-                params.append(end_date)
-            elif date_type == 'year':
-                sql += " AND strftime('%Y', transaction_date) <= ?"
-                params.append(end_date)
-        if department:
-            sql += " AND department = ?"
-            params.append(department)
-        if user:
-            sql += " AND user = ?"
-            params.append(user)
-
-        cursor.execute(sql, params)
-        rows = cursor.fetchall()
-        count_total = len(rows)
-        count_morning = 0
-        count_noon = 0
-        count_evening = 0
-
-        for row in rows:
-            d = row[0]
-            dt = None
-            try:
-                dt = datetime.strptime(d, "%Y-%m-%d %H:%M:%S")
-            except Exception:
-                try:
-                    dt = datetime.strptime(d, "%Y-%m-%d")
-                except Exception:
-                    continue
-            t = dt.time()
-            if morning_start <= t <= morning_end:
-                count_morning += 1
-            elif noon_start <= t <= noon_end:
-                count_noon += 1
-            elif evening_start <= t <= evening_end:
-                count_evening += 1
-
-        result.append({
-            'area': table,
-            'count': count_total,
-            'morning': count_morning,
-            'noon': count_noon,
-            'evening': count_evening
-        })
-
-    conn.close()
-    return jsonify({'counts': result})
+    conn.row_factory = sqlite3.Row
+
+    def compute():
+        if swipe_rollup.rollups_available(conn):
+            # 已关闭的日期读汇总表，当天和尚未汇总的记录扫描原始表
+            sql, params = swipe_rollup.rollup_counts_query(table_names, start_day, end_day, department, user,
+                                                           fact_mode=swipe_facts.facts_enabled(conn))
+        else:
+            sql, params = build_counts_query(table_names, start_day, end_day, department, user)
+        return {'counts': [dict(row) for row in conn.execute(sql, params)]}
+
+    try:
+        # 先读版本再计算，计算期间的写入会让下一次请求重新计算
+        versions = data_version.versions(conn)
+        # 缓存只在历史数据被改写时失效；swipes 每次刷卡都会变化，包含当天的查询由较短的TTL限制数据延迟
+        closed = end_day is not None and end_day <= datetime.now().strftime('%Y-%m-%d')
+        version = versions.get(data_version.SWIPES_HISTORY, 0)
+        ttl = response_cache.CLOSED_TTL if closed else response_cache.OPEN_TTL
+        key = (DB_PATH, tuple(table_names), start_day, end_day, department, user)
+        entry = counts_cache.get_or_compute(key, version, ttl, compute)
+    finally:
+        conn.close()
+    return response_cache.make_response(app, request, entry, 'counts')
 
 @app.route('/api/log')
 def get_log():
+    """
+    日志尾部，不再整文件读入内存：
+    - 默认返回最后 lines 行（默认200），跨越轮转文件
+    - offset: 上次响应 X-Log-Cursor 中的游标（或当前文件字节偏移），返回之后的完整行
+    - since: 返回该时间之后的日志行
+    - Range: 当前文件的字节范围，返回206
+    - follow=1 或 Accept: text/event-stream: SSE推送新增行，断线重连时使用 Last-Event-ID
+    响应头 X-Log-Cursor 为下次读取的位置，X-Log-More 为1时还有未返回的内容
+    """
     if not os.path.exists(LOG_PATH):
         return "日志文件不存在", 404
-    with open(LOG_PATH, 'r', encoding='utf-8', errors='ignore') as f:
-        content = f.read()
-    # 直接返回日志内容，不替换换行符
-    return content
+    # EventSource重连时带 Last-Event-ID，优先于URL中最初的offset
+    offset = request.headers.get('Last-Event-ID') or request.args.get('offset')
+    since = request.args.get('since')
+    try:
+        if offset:
+            log_tail.parse_cursor(offset)
+        since = log_tail.parse_since(since) if since else None
+        lines = min(int(request.args.get('lines', log_tail.DEFAULT_LINES)), log_tail.MAX_LINES)
+    except ValueError:
+        return "参数格式错误", 400
+
+    if request.args.get('follow') == '1' or request.accept_mimetypes.best == 'text/event-stream':
+        return follow_log(offset or (log_tail.find_since(LOG_PATH, since) if since else None))
+
+    if request.range is not None:
+        return read_log_range()
+
+    more = False
+    if offset or since:
+        text, cursor, more = log_tail.read_from(LOG_PATH, offset or log_tail.find_since(LOG_PATH, since))
+    else:
+        text, cursor = log_tail.tail(LOG_PATH, max(lines, 0))
+    return Response(text, mimetype='text/plain', headers={
+        'X-Log-Cursor': cursor or '', 'X-Log-More': '1' if more else '0', 'Accept-Ranges': 'bytes'
+    })
+
+def read_log_range():
+    """按 Range 头返回当前日志文件的字节范围"""
+    size = os.path.getsize(LOG_PATH)
+    span = request.range.range_for_length(size)
+    if span is None:
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+    start, stop = span[0], min(span[1], span[0] + log_tail.MAX_READ_BYTES)
+    data, size = log_tail.read_range(LOG_PATH, start, stop)
+    return Response(data, status=206, mimetype='text/plain', headers={
+        'Content-Range': f'bytes {start}-{start + len(data) - 1}/{size}', 'Accept-Ranges': 'bytes'
+    })
+
+def acquire_stream_slot():
+    """
+    占用一个长连接名额，返回占用的信号量，名额已满时返回None
+    日志follow、实时刷卡订阅和导出共用名额（线程数的一半），长连接不会占满请求线程池
+    """
+    slots = wsgi_server.stream_slots
+    return slots if slots.acquire(blocking=False) else None
+
+def follow_log(cursor):
+    """SSE推送新增日志行；长连接名额已满时返回503"""
+    slots = acquire_stream_slot()
+    if slots is None:
+        return "长连接数已满", 503, {'Retry-After': str(log_tail.FOLLOW_KEEPALIVE)}
+
+    def stream():
+        try:
+            yield from log_tail.follow(LOG_PATH, cursor)
+        finally:
+            slots.release()
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/export/<kind>')
+def export_records(kind):
+    """
+    导出刷卡记录（swipes）或失败记录（failures），筛选参数与 /api/counts 相同，format 为 csv（默认）或 xlsx
+    记录按批从游标读取后写入响应，内存占用与导出行数无关
+    大量导出在整个下载期间占用一个线程，与长连接共用名额，名额已满时返回503
+    """
+    export_format = request.args.get('format', 'csv')
+    if kind not in swipe_export.EXPORT_KINDS or export_format not in ('csv', 'xlsx'):
+        return jsonify({'message': '不支持的导出类型'}), 404
+    try:
+        table_names, start_day, end_day, department, user = count_filters()
+    except ValueError:
+        return jsonify({'message': '日期格式错误'}), 400
+
+    slots = acquire_stream_slot()
+    if slots is None:
+        return jsonify({'message': '导出和长连接数已满'}), 503, {'Retry-After': str(swipe_export.RETRY_AFTER)}
+    conn = sqlite3.connect(DB_PATH)
+    closed = False
+
+    def close():
+        """释放名额并关闭连接；生成器结束和响应关闭时都会调用（客户端断开时生成器可能从未开始），只执行一次"""
+        nonlocal closed
+        if not closed:
+            closed = True
+            conn.close()
+            slots.release()
+
+    try:
+        queries = swipe_export.export_queries(kind, table_names, start_day, end_day, department, user,
+                                              fact_mode=swipe_facts.facts_enabled(conn),
+                                              failure_fact_mode=swipe_facts.failures_enabled(conn))
+    except Exception:
+        close()
+        raise
+
+    def generate():
+        try:
+            chunks = swipe_export.iter_rows(conn, queries)
+            if export_format == 'xlsx':
+                yield from swipe_export.xlsx_chunks(kind, chunks)
+            else:
+                yield from swipe_export.csv_chunks(kind, chunks)
+        finally:
+            close()
+
+    filename = f"{kind}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{export_format}"
+    mimetype = ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' if export_format == 'xlsx'
+                else 'text/csv')
+    response = Response(generate(), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+    response.call_on_close(close)
+    return response
+
+@app.route('/api/failures/top')
+def top_failures():
+    """
+    某个窗口内失败最多的卡号、用户或终端：
+    - dimension: card（默认）/ user / device（设备号，没有设备号时为 "jihao:机号"）
+    - hours: 最近N小时（默认24）；或 startDate/endDate/dateType，含义与 /api/counts 相同
+    - failureType: 1 卡片未激活 / 2 卡号不存在 / 3 不在用餐时间，不传表示全部
+    - limit: 返回条数（默认10，最多100）
+    读按小时维护的失败汇总表，只扫描尚未汇总的少量原始记录
+    """
+    dimension = request.args.get('dimension', 'card')
+    if dimension not in failure_stats.DIMENSIONS:
+        return jsonify({'message': '未知的统计维度'}), 400
+    try:
+        failure_type = request.args.get('failureType', type=int)
+        if failure_type is not None and failure_type not in failure_stats.FAILURE_TYPES:
+            raise ValueError(failure_type)
+        limit = min(max(request.args.get('limit', failure_stats.DEFAULT_LIMIT, type=int), 1), failure_stats.MAX_LIMIT)
+        if request.args.get('startDate') or request.args.get('endDate'):
+            _, start_day, end_day, _, _ = count_filters()
+            start, end = failure_stats.window_bounds(start_day=start_day, end_day=end_day)
+        else:
+            start, end = failure_stats.window_bounds(hours=max(request.args.get('hours', 24, type=int), 1))
+    except ValueError:
+        return jsonify({'message': '参数格式错误'}), 400
+
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+
+    def compute():
+        if failure_stats.current_source(conn) is None:
+            rows = []
+        else:
+            sql, params = failure_stats.top_failures_query(
+                dimension, start, end, failure_type, limit, fact_mode=swipe_facts.failures_enabled(conn),
+                use_rollup=failure_stats.failure_rollups_available(conn))
+            rows = [dict(row) for row in conn.execute(sql, params)]
+        return {'dimension': dimension, 'start': start, 'end': end, 'failureType': failure_type, 'top': rows}
+
+    try:
+        # failures 每次写入失败记录都会变化，不作为缓存版本；新的失败记录最多延迟TTL秒可见
+        version = data_version.versions(conn).get(data_version.SWIPES_HISTORY, 0)
+        key = (DB_PATH, dimension, start, end, failure_type, limit)
+        entry = failures_cache.get_or_compute(key, version, response_cache.OPEN_TTL, compute)
+    finally:
+        conn.close()
+    return response_cache.make_response(app, request, entry, 'failures')
+
+def split_param(name):
+    return {value.strip() for value in request.args.get(name, '').split(',') if value.strip()}
+
+@app.route('/api/swipes/stream')
+def stream_swipes():
+    """
+    实时刷卡SSE：
+    - area: 与 /api/counts 相同的区域名，all或不传表示全部
+    - department / outcome: 逗号分隔的多个值
+    - mode=counts 时每秒推送一次按结果聚合的计数，否则逐条推送事件
+    """
+    area = request.args.get('area', 'all')
+    outcomes = split_param('outcome')
+    if outcomes - set(swipe_events.OUTCOMES):
+        return jsonify({'message': '未知的刷卡结果'}), 400
+    filters = {
+        'jihao': {str(swipe_facts.AREA_CODES[table]) for table in get_table_names(area)} if area != 'all' else set(),
+        'department': split_param('department'),
+        'outcome': outcomes,
+    }
+    try:
+        last_id = request.headers.get('Last-Event-ID')
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    slots = acquire_stream_slot()
+    if slots is None:
+        return jsonify({'message': '长连接数已满'}), 503, {'Retry-After': str(swipe_events.STREAM_KEEPALIVE)}
+    try:
+        swipe_hub.start()
+    except OSError as e:
+        slots.release()
+        logging.error(f"启动刷卡事件订阅失败: {e}")
+        return jsonify({'message': '实时订阅不可用'}), 503
+
+    aggregate = request.args.get('mode') == 'counts'
+
+    def stream():
+        try:
+            yield from swipe_events.stream(swipe_hub, filters, aggregate=aggregate, last_id=last_id)
+        finally:
+            slots.release()
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus指标（每个工作进程各自统计）"""
+    return app.response_class(prom.generate_latest(), mimetype=prom.CONTENT_TYPE_LATEST)
 
 @app.route('/api/upload_excel', methods=['POST'])
 def upload_excel():
@@ -298,6 +595,28 @@ def upload_excel():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='ICmanager 管理界面服务器')
     parser.add_argument('-p', '--port', type=int, default=5550, help='指定服务器端口（默认5550）')
+    parser.add_argument('--threads', type=int, default=wsgi_server.DEFAULT_THREADS,
+                        help=f'每个工作进程的请求线程数（默认{wsgi_server.DEFAULT_THREADS}）')
+    parser.add_argument('--workers', type=int, default=wsgi_server.DEFAULT_WORKERS,
+                        help=f'工作进程数（默认{wsgi_server.DEFAULT_WORKERS}）')
+    parser.add_argument('--timeout', type=int, default=wsgi_server.DEFAULT_TIMEOUT,
+                        help=f'请求读超时秒数（默认{wsgi_server.DEFAULT_TIMEOUT}）')
+    parser.add_argument('--keep-alive', type=int, default=wsgi_server.DEFAULT_KEEP_ALIVE,
+                        help=f'keep-alive秒数，0表示不保持连接（默认{wsgi_server.DEFAULT_KEEP_ALIVE}）')
+    parser.add_argument('--dev', action='store_true', help='使用Flask开发服务器（调试模式）')
+    parser.add_argument('--rollup-interval', type=int, default=swipe_rollup.DEFAULT_INTERVAL,
+                        help=f'刷新统计汇总表的间隔秒数，0表示不刷新（默认{swipe_rollup.DEFAULT_INTERVAL}）')
     args = parser.parse_args()
+    refresher = swipe_rollup.RollupRefresher(DB_PATH, interval=args.rollup_interval) if args.rollup_interval > 0 else None
     # 监听所有IP，外网可访问
-    app.run(host='0.0.0.0', port=args.port, debug=True)
+    if args.dev:
+        if refresher:
+            refresher.start()
+        app.run(host='0.0.0.0', port=args.port, debug=True)
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        # 响应缓存和实时刷卡订阅是每个工作进程各自的；缓存按数据库中的数据版本失效，多进程运行时不会返回旧数据
+        # 刷新任务在fork工作进程之后于主进程中启动，只运行一份，也不会被子进程继承
+        wsgi_server.serve(app, host='0.0.0.0', port=args.port, threads=args.threads, workers=args.workers,
+                          timeout=args.timeout, keep_alive=args.keep_alive,
+                          on_start=refresher.start if refresher else None)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+管理界面只读接口的响应缓存
+- 键: 规范化后的查询参数（由调用方构造，相同含义的请求得到相同的键）
+- 失效: 条目记录生成时的数据版本（见 data_version.py），版本变化或TTL到期后重新计算；
+  包含当天的查询TTL短，已关闭的历史区间TTL长
+- 条目保存JSON正文、ETag和按需生成的gzip正文；客户端带 If-None-Match 时返回304
+- 命中率等指标通过Prometheus导出，用于调整TTL
+每个工作进程各有一份缓存，条目数超过上限时淘汰最久未使用的条目
+"""
+import gzip
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import prometheus_client as prom
+
+# 包含当天（仍在写入）的查询，以及已关闭历史区间的缓存秒数
+OPEN_TTL = 5
+CLOSED_TTL = 3600
+MAX_ENTRIES = 512
+# 正文小于该字节数时不压缩
+GZIP_MIN_SIZE = 1024
+
+CACHE_LOOKUPS = prom.Counter('manager_cache_lookups_total', '响应缓存查询次数',
+                             ['endpoint', 'result'])
+CACHE_HIT_RATE = prom.Gauge('manager_cache_hit_ratio', '响应缓存命中率', ['endpoint'])
+CACHE_ENTRIES = prom.Gauge('manager_cache_entries', '响应缓存条目数', ['endpoint'])
+NOT_MODIFIED = prom.Counter('manager_cache_not_modified_total', '返回304的次数', ['endpoint'])
+COMPUTE_TIME = prom.Histogram('manager_cache_compute_seconds', '缓存未命中时计算响应的耗时(秒)', ['endpoint'])
+
+
+class CacheEntry:
+    """一个缓存的JSON响应"""
+
+    def __init__(self, version, ttl, payload):
+        self.version = version
+        self.expires = time.monotonic() + ttl
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()[:20]
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+
+class ResponseCache:
+    """按键缓存JSON响应，条目在数据版本变化或TTL到期后失效"""
+
+    def __init__(self, endpoint, max_entries=MAX_ENTRIES):
+        self.endpoint = endpoint
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+
+    def _record(self, result):
+        self.lookups += 1
+        self.hits += result == 'hit'
+        CACHE_LOOKUPS.labels(endpoint=self.endpoint, result=result).inc()
+        CACHE_HIT_RATE.labels(endpoint=self.endpoint).set(self.hits / self.lookups)
+
+    def get(self, key, version):
+        """返回仍然有效的条目，没有、已过期或数据版本已变化时返回None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                result = 'miss'
+            elif entry.version != version:
+                result = 'stale'
+            elif entry.expires <= time.monotonic():
+                result = 'expired'
+            else:
+                result = 'hit'
+                self.entries.move_to_end(key)
+            self._record(result)
+            return entry if result == 'hit' else None
+
+    def put(self, key, version, ttl, payload):
+        """保存一个新计算的响应并返回条目"""
+        entry = CacheEntry(version, ttl, payload)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            CACHE_ENTRIES.labels(endpoint=self.endpoint).set(len(self.entries))
+        return entry
+
+    def get_or_compute(self, key, version, ttl, compute):
+        """命中时返回缓存条目，否则调用 compute() 计算后缓存"""
+        entry = self.get(key, version)
+        if entry is None:
+            with COMPUTE_TIME.labels(endpoint=self.endpoint).time():
+                payload = compute()
+            entry = self.put(key, version, ttl, payload)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            CACHE_ENTRIES.labels(endpoint=self.endpoint).set(0)
+
+
+def make_response(app, request, entry, endpoint):
+    """
+    用缓存条目构造Flask响应：ETag匹配时返回304，客户端接受gzip且正文足够大时返回压缩正文
+    Cache-Control: no-cache 让浏览器每次带 If-None-Match 重新验证
+    """
+    if request.if_none_match.contains_weak(entry.etag):
+        NOT_MODIFIED.labels(endpoint=endpoint).inc()
+        response = app.response_class(status=304)
+    elif len(entry.body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings:
+        response = app.response_class(entry.gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(entry.body, mimetype='application/json')
+    # 压缩和未压缩的正文内容相同，使用弱ETag
+    response.set_etag(entry.etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
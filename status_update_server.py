@@ -1,19 +1,25 @@
 import os
 import time
+import numpy as np
 import pandas as pd
 import schedule
 import logging
 import sqlite3
 import aiohttp
+from aiohttp import web
 import asyncio
 import hashlib
 import json
+import multiprocessing
 import watchdog.observers
 import watchdog.events
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import lru_cache
 import prometheus_client as prom
+from db_pool import AiosqlitePool
+from file_ingest import ExcelIngestDebouncer, is_excel_event_path
+import swipe_facts
 
 # 设置Prometheus指标
 REQUEST_COUNT = prom.Counter('duty_update_requests_total', '更新请求总数', ['time_point'])
@@ -21,53 +27,298 @@ UPDATE_COUNT = prom.Counter('duty_update_records_total', '更新记录总数', [
 ERROR_COUNT = prom.Counter('duty_update_errors_total', '错误总数', ['type'])
 PROCESS_TIME = prom.Histogram('duty_update_process_seconds', '处理时间(秒)')
 MEAL_UPDATE_COUNT = prom.Counter('meal_update_records_total', '餐饮更新记录总数', ['meal_type'])
+PLAN_BUILD_COUNT = prom.Counter('status_plan_builds_total', '状态计划构建次数', ['kind'])
+# 分阶段指标：hash、excel_open、sheet_parse、rule_eval、db_update、db_insert、commit
+PHASE_TIME = prom.Histogram('duty_update_phase_seconds', '各阶段耗时(秒)', ['phase', 'time_point', 'department'])
+ROSTER_SIZE = prom.Gauge('duty_roster_rows', '排班表行数', ['department'])
+LAST_APPLY_TIME = prom.Gauge('duty_last_apply_timestamp_seconds', '最近一次成功写入的时间戳', ['time_point'])
+CACHE_HIT_RATE = prom.Gauge('duty_cache_hit_ratio', '缓存命中率', ['cache'])
+WRITE_LOCK_TIME = prom.Gauge('duty_db_write_lock_seconds', '最近一次写事务持有写锁的时长(秒)')
+
+def phase_timer(phase, time_point='none', department='all'):
+    """返回记录指定阶段耗时的计时器，可用作with语句"""
+    return PHASE_TIME.labels(phase=phase, time_point=time_point, department=department).time()
+
+def observe_phase(phase, seconds, time_point='none', department='all'):
+    """记录一次已测得的阶段耗时（如进程池返回的耗时）"""
+    PHASE_TIME.labels(phase=phase, time_point=time_point, department=department).observe(seconds)
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def duty_rule_masks(df, time_point):
+    """
+    按班次规则计算指定时间点的两个布尔数组 (selected, activate)：
+    selected为需要写入的行，activate为其中写入1的行（其余写入0且只更新不插入）
+    """
+    on_duty = df['is_on_duty']
+    shift = df['shift'].where(df['shift'].notna(), '').astype(str).str.lower()
+    
+    # 值班状态为1时：ns/lds班次在a、b、c时间点激活，ds班次在a、c时间点激活
+    active_shifts = ['ns', 'lds'] if time_point in ['a', 'b', 'c'] else []
+    if time_point in ['a', 'c']:
+        active_shifts.append('ds')
+    activate = (on_duty == 1) & shift.isin(active_shifts)
+    # 值班状态为0时：仅更新为0
+    selected = activate | (on_duty == 0)
+    return selected.to_numpy(dtype=bool), activate.to_numpy(dtype=bool)
+
+def _sheet_cards(df, mask):
+    """取出选中行的卡号，空值为None"""
+    if 'card' not in df.columns:
+        return [None] * int(mask.sum())
+    return [card if pd.notna(card) else None for card in df.loc[mask, 'card'].tolist()]
+
+def evaluate_duty_rows(df, dept, time_point):
+    """
+    按班次规则计算一个部门在指定时间点需要写入的状态
+    返回紧凑结果 (dept, users, cards, statuses)，statuses为bytes：
+    1表示更新为激活（不存在则插入），0表示仅更新为未激活（不插入）
+    """
+    if df.empty:
+        return dept, [], [], b''
+    
+    selected, activate = duty_rule_masks(df, time_point)
+    users = df.loc[selected, 'user'].tolist()
+    cards = _sheet_cards(df, selected)
+    statuses = activate[selected].astype(np.uint8).tobytes()
+    return dept, users, cards, statuses
+
+def expand_duty_updates(dept, users, cards, statuses):
+    """将紧凑结果还原为batch_update_users使用的用户列表"""
+    users_to_update = []
+    for user, card, status in zip(users, cards, statuses):
+        if status == 1:
+            users_to_update.append({"user": user, "department": dept, "card": card, "status": 1})
+        else:
+            users_to_update.append({"user": user, "department": dept, "card": card, "status": 0, "update_only": True})
+    return users_to_update
+
+@lru_cache(maxsize=2)
+def _open_duty_workbook(file_path, file_hash):
+    """工作进程内按文件哈希缓存打开的工作簿，打开工作簿比解析单个sheet慢得多"""
+    return pd.ExcelFile(file_path)
+
+@lru_cache(maxsize=32)
+def _read_duty_sheet(file_path, file_hash, sheet_name):
+    """工作进程内按文件哈希缓存解析后的sheet"""
+    return _open_duty_workbook(file_path, file_hash).parse(sheet_name)
+
+def _read_duty_sheet_timed(file_path, file_hash, dept):
+    """读取sheet并返回 (df, stats)，stats记录解析耗时、是否命中缓存和行数"""
+    hits = _read_duty_sheet.cache_info().hits
+    start_time = time.perf_counter()
+    df = _read_duty_sheet(file_path, file_hash, dept)
+    stats = {
+        "sheet_parse": time.perf_counter() - start_time,
+        "cache_hit": _read_duty_sheet.cache_info().hits > hits,
+        "rows": len(df)
+    }
+    return df, stats
+
+def evaluate_duty_sheet(file_path, file_hash, dept, time_point):
+    """进程池任务：解析一个部门的sheet并返回 (紧凑的状态更新, 阶段统计)"""
+    df, stats = _read_duty_sheet_timed(file_path, file_hash, dept)
+    start_time = time.perf_counter()
+    result = evaluate_duty_rows(df, dept, time_point)
+    stats["rule_eval"] = time.perf_counter() - start_time
+    return result, stats
+
+def evaluate_duty_sheet_plan(file_path, file_hash, dept, time_points):
+    """
+    进程池任务：一次解析一个部门的sheet，计算所有时间点的写入掩码
+    返回 ((dept, users, cards, {时间点: (selected字节, activate字节)}), 阶段统计)，只包含至少被一个时间点选中的行
+    """
+    df, stats = _read_duty_sheet_timed(file_path, file_hash, dept)
+    start_time = time.perf_counter()
+    if df.empty:
+        stats["rule_eval"] = 0.0
+        return (dept, [], [], {}), stats
+    masks = {tp: duty_rule_masks(df, tp) for tp in time_points}
+    keep = np.logical_or.reduce([selected for selected, _ in masks.values()])
+    users = df.loc[keep, 'user'].tolist()
+    cards = _sheet_cards(df, keep)
+    packed = {
+        tp: (selected[keep].astype(np.uint8).tobytes(), activate[keep].astype(np.uint8).tobytes())
+        for tp, (selected, activate) in masks.items()
+    }
+    stats["rule_eval"] = time.perf_counter() - start_time
+    return (dept, users, cards, packed), stats
+
+def evaluate_duty_plan(file_path, file_hash, departments, time_points):
+    """在本进程内依次计算所有部门的计划（未启用进程池时使用）"""
+    results = []
+    for dept in departments:
+        try:
+            results.append(evaluate_duty_sheet_plan(file_path, file_hash, dept, time_points))
+        except Exception as e:
+            results.append(e)
+    return results
+
+MEAL_COLUMNS = ['breakfast', 'breakfast_department', 'breakfast_card',
+                'dinner', 'dinner_department', 'dinner_card']
+
+def evaluate_meal_rows(df, meal_type):
+    """按餐饮表的多列结构取出指定餐次需要激活的用户列表"""
+    users_to_update = []
+    users = df[meal_type]
+    departments = df[f'{meal_type}_department']
+    cards = df[f'{meal_type}_card']
+    for user, department, card in zip(users.tolist(), departments.tolist(), cards.tolist()):
+        if pd.notna(user) and str(user).strip():
+            users_to_update.append({
+                "user": str(user).strip(),
+                "department": str(department).strip() if pd.notna(department) else None,
+                "card": str(card).strip() if pd.notna(card) else None,
+                "status": 1
+            })
+    return users_to_update
+
+def _plan_value(value):
+    """比较计划与数据库时统一取值类型（TEXT列会把数字存成文本）"""
+    return None if value is None else str(value)
+
+class StatusPlan:
+    """
+    预先计算的状态计划
+    所有行共用一组用户/部门/卡号数组，每个任务（时间点或餐次）用两个位图表示：
+    selected为该任务需要写入的行，active为其中写入1的行
+    """
+    
+    def __init__(self, kind, source_file, file_hash, users, departments, cards, masks):
+        self.kind = kind
+        self.source_file = source_file
+        self.file_hash = file_hash
+        self.users = users
+        self.departments = departments
+        self.cards = cards
+        self.size = len(users)
+        self.bitsets = {
+            key: (np.packbits(selected).tobytes(), np.packbits(active).tobytes())
+            for key, (selected, active) in masks.items()
+        }
+        self.built_at = datetime.now().isoformat()
+        self.applied = {}
+        
+    def has(self, key):
+        return key in self.bitsets
+        
+    def _unpack(self, packed):
+        return np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=self.size).astype(bool)
+        
+    def updates_for(self, key):
+        """还原指定任务的目标用户列表（与batch_update_users的入参格式相同）"""
+        selected_bits, active_bits = self.bitsets[key]
+        selected = self._unpack(selected_bits)
+        active = self._unpack(active_bits)
+        users_to_update = []
+        for i in np.flatnonzero(selected):
+            if active[i]:
+                users_to_update.append({"user": self.users[i], "department": self.departments[i], "card": self.cards[i], "status": 1})
+            else:
+                users_to_update.append({"user": self.users[i], "department": self.departments[i], "card": self.cards[i], "status": 0, "update_only": True})
+        return users_to_update
+        
+    def mark_applied(self, key, targets, delta, updated):
+        self.applied[key] = {
+            "time": datetime.now().isoformat(),
+            "targets": targets,
+            "delta": delta,
+            "updated": updated
+        }
+        
+    def summary(self):
+        """计划摘要，用于HTTP查看"""
+        keys = {}
+        for key, (selected_bits, active_bits) in self.bitsets.items():
+            keys[key] = {
+                "selected": int(self._unpack(selected_bits).sum()),
+                "active": int(self._unpack(active_bits).sum()),
+                "bytes": len(selected_bits) + len(active_bits),
+                "last_applied": self.applied.get(key)
+            }
+        return {
+            "kind": self.kind,
+            "source_file": self.source_file,
+            "file_hash": self.file_hash,
+            "built_at": self.built_at,
+            "rows": self.size,
+            "keys": keys
+        }
+
+def diff_plan_updates(users_to_update, current_rows):
+    """
+    只保留与数据库当前值不同的目标行
+    current_rows为 (user, card, department, status) 行；同一用户有多条目标时，
+    只要其中一条与数据库不同就全部保留，保证按顺序写入后的结果与全量写入一致
+    """
+    current = {}
+    for user, card, department, status in current_rows:
+        current.setdefault(user, []).append((_plan_value(card), _plan_value(department), status))
+    
+    changed_users = set()
+    for u in users_to_update:
+        existing = current.get(u["user"])
+        if existing is None:
+            if not u.get("update_only", False):
+                changed_users.add(u["user"])
+            continue
+        target = (_plan_value(u["card"]), _plan_value(u["department"]), u["status"])
+        if any(row != target for row in existing):
+            changed_users.add(u["user"])
+    return [u for u in users_to_update if u["user"] in changed_users]
+
+def _warm_up_worker():
+    """进程池预热任务"""
+    return os.getpid()
+
 class ExcelFileHandler(watchdog.events.FileSystemEventHandler):
-    """监控Excel文件变化的处理器"""
+    """监控Excel文件变化的处理器，事件交给去抖动阶段合并"""
     
     def __init__(self, service):
         self.service = service
         super().__init__()
         
     def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith('.xlsx'):
+        if not event.is_directory and is_excel_event_path(event.src_path):
             logger.info(f"检测到新文件: {event.src_path}")
-            self.service.check_new_excel()
+            self.service.excel_ingest.submit(event.src_path)
             
     def on_modified(self, event):
-        if not event.is_directory and event.src_path.endswith('.xlsx'):
-            logger.info(f"检测到文件修改: {event.src_path}")
-            # 如果是当前正在使用的文件被修改
-            if self.service.latest_excel and event.src_path.endswith(self.service.latest_excel):
-                logger.info(f"当前使用的文件已修改，重新加载文件: {self.service.latest_excel}")
-                self.service.reload_excel()
+        if not event.is_directory and is_excel_event_path(event.src_path):
+            logger.debug(f"检测到文件修改: {event.src_path}")
+            self.service.excel_ingest.submit(event.src_path)
+            
+    def on_moved(self, event):
+        if not event.is_directory and is_excel_event_path(event.dest_path):
+            logger.info(f"检测到文件移入: {event.dest_path}")
+            self.service.excel_ingest.submit(event.dest_path)
 
 class UniqueExcelFileHandler(watchdog.events.FileSystemEventHandler):
-    """监控餐饮Excel文件变化的处理器"""
+    """监控餐饮Excel文件变化的处理器，事件交给去抖动阶段合并"""
     
     def __init__(self, service):
         self.service = service
         super().__init__()
         
     def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith('.xlsx'):
+        if not event.is_directory and is_excel_event_path(event.src_path):
             logger.info(f"检测到新餐饮文件: {event.src_path}")
-            self.service.check_new_unique_excel()
+            self.service.unique_excel_ingest.submit(event.src_path)
             
     def on_modified(self, event):
-        if not event.is_directory and event.src_path.endswith('.xlsx'):
-            logger.info(f"检测到餐饮文件修改: {event.src_path}")
-            # 如果是当前正在使用的文件被修改
-            if self.service.latest_unique_excel and event.src_path.endswith(self.service.latest_unique_excel):
-                logger.info(f"当前使用的餐饮文件已修改，重新加载文件: {self.service.latest_unique_excel}")
-                self.service.reload_unique_excel()
+        if not event.is_directory and is_excel_event_path(event.src_path):
+            logger.debug(f"检测到餐饮文件修改: {event.src_path}")
+            self.service.unique_excel_ingest.submit(event.src_path)
+            
+    def on_moved(self, event):
+        if not event.is_directory and is_excel_event_path(event.dest_path):
+            logger.info(f"检测到餐饮文件移入: {event.dest_path}")
+            self.service.unique_excel_ingest.submit(event.dest_path)
 
 class DutyUpdateService:
-    def __init__(self, excel_folder, db_config, time_points, unique_excel_folder=None, cache_size=500, batch_size=100, max_workers=4, monitor_port=5551, test_mode=False):
+    def __init__(self, excel_folder, db_config, time_points, unique_excel_folder=None, cache_size=500, batch_size=100, max_workers=4, monitor_port=5551, test_mode=False, db_pool_size=4, file_settle_seconds=2.0, process_workers=0):
         """
         初始化服务
         excel_folder: Excel文件存储路径
@@ -79,6 +330,9 @@ class DutyUpdateService:
         max_workers: 最大并发工作线程数
         monitor_port: prometheus监控端口，None表示不启动监控
         test_mode: 测试模式，为True时跳过餐饮任务的日期校验
+        db_pool_size: 数据库连接池的最大连接数
+        file_settle_seconds: Excel文件大小/修改时间需保持不变的秒数，之后才会导入
+        process_workers: 排班解析进程池大小，0表示在本进程内解析
         """
         self.excel_folder = excel_folder
         self.unique_excel_folder = unique_excel_folder
@@ -91,6 +345,21 @@ class DutyUpdateService:
         self.batch_size = batch_size
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
         self.db_pool = None
+        self.db_pool_size = db_pool_size
+        self.file_settle_seconds = file_settle_seconds
+        self.excel_ingest = None
+        self.unique_excel_ingest = None
+        self.process_workers = process_workers
+        self.process_pool = None
+        # 预先计算的排班/餐饮状态计划，文件变化时重建，触发时只写入差异
+        self.status_plan = None
+        self.meal_plan = None
+        self.plan_lock = asyncio.Lock()
+        # 缓存命中统计 {缓存名: [命中次数, 查询次数]}，用于计算命中率
+        self.cache_stats = {}
+        # 常驻事件循环，调度器、文件监控回调和HTTP服务共用
+        self.loop = None
+        self.http_runner = None
         self.monitor_port = monitor_port
         self.test_mode = False  # 测试模式
         # 健康状态
@@ -110,7 +379,7 @@ class DutyUpdateService:
         prom.start_http_server(port)
         logger.info(f"监控服务已启动在端口 {port}")
         
-    def start(self):
+    def start(self, http_host='localhost', http_port=5552):
         """启动服务"""
         # 设置定时任务
         for point, time_value in self.time_points.items():
@@ -138,13 +407,27 @@ class DutyUpdateService:
         # 启动文件监控
         self.start_file_monitoring()
         
-        # 启动异步事件循环
-        loop = asyncio.get_event_loop()
+        try:
+            # 在一个常驻事件循环中运行所有异步任务
+            asyncio.run(self.serve(http_host, http_port))
+        except KeyboardInterrupt:
+            logger.info("服务已停止")
+        finally:
+            self.executor.shutdown(wait=True)
+            self.shutdown_process_pool()
+            
+    async def serve(self, http_host=None, http_port=None):
+        """常驻事件循环主体：初始化连接池、启动HTTP服务并驱动调度器"""
+        self.loop = asyncio.get_running_loop()
         
         # 初始化数据库连接池
-        loop.run_until_complete(self.initialize_db_pool())
+        await self.initialize_db_pool()
+        self.start_process_pool()
         
         try:
+            if http_port is not None:
+                await self.start_http_server(http_host, http_port)
+            
             logger.info("服务已启动")
             # 首次运行时检查一次
             self.check_new_excel()
@@ -153,19 +436,80 @@ class DutyUpdateService:
             
             # 保持服务运行
             while True:
-                loop.run_until_complete(self.run_scheduled_tasks())
-                time.sleep(1)  # 每秒检查一次调度任务
-        except KeyboardInterrupt:
-            logger.info("服务已停止")
+                await self.run_scheduled_tasks()
+                await asyncio.sleep(1)  # 每秒检查一次调度任务
         finally:
+            await self.stop_http_server()
             # 关闭数据库连接池
             if self.db_pool:
-                loop.run_until_complete(self.close_db_pool())
-            self.executor.shutdown(wait=True)
+                await self.close_db_pool()
+            self.loop = None
+            
+    async def start_http_server(self, host='localhost', port=5552):
+        """在常驻事件循环中启动提供健康状态API的HTTP服务"""
+        app = web.Application()
+        app.router.add_get('/health', self.get_health)
+        app.router.add_get('/plan', self.get_plan)
+        app.router.add_get('/plan/{key}', self.get_plan_key)
+        
+        self.http_runner = web.AppRunner(app)
+        await self.http_runner.setup()
+        site = web.TCPSite(self.http_runner, host, port)
+        
+        await site.start()
+        logger.info(f"HTTP服务器已启动在端口 {port}")
+        
+    async def stop_http_server(self):
+        """停止HTTP服务"""
+        if self.http_runner:
+            await self.http_runner.cleanup()
+            self.http_runner = None
+            
+    def start_process_pool(self):
+        """创建并预热排班解析进程池，常驻以摊薄进程启动和模块导入的开销"""
+        if self.process_pool is None and self.process_workers:
+            # 服务进程中有多个线程，使用spawn避免fork带来的锁状态问题
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=self.process_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            # 每个工作进程提交一个空任务，提前完成启动和导入
+            for _ in range(self.process_workers):
+                self.process_pool.submit(_warm_up_worker)
+            logger.info(f"排班解析进程池已启动，工作进程数: {self.process_workers}")
+        return self.process_pool
+        
+    def shutdown_process_pool(self):
+        """关闭排班解析进程池"""
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True)
+            self.process_pool = None
+            logger.info("排班解析进程池已关闭")
+            
+    def submit_coroutine(self, coro):
+        """将协程提交到常驻事件循环执行，可在任意线程调用"""
+        if self.loop is None or not self.loop.is_running():
+            coro.close()
+            logger.warning("服务事件循环未运行，任务未提交")
+            return None
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_future_exception)
+        return future
+        
+    def _log_future_exception(self, future):
+        """记录后台任务中未处理的异常"""
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            logger.error(f"执行后台任务时出错: {str(exc)}")
             
     def start_file_monitoring(self):
         """启动文件监控"""
         # 监控普通排班Excel文件
+        self.excel_ingest = ExcelIngestDebouncer(
+            self.on_excel_settled, name='roster', settle_seconds=self.file_settle_seconds, logger=logger
+        )
         self.event_handler = ExcelFileHandler(self)
         self.observer = watchdog.observers.Observer()
         self.observer.schedule(self.event_handler, self.excel_folder, recursive=False)
@@ -174,6 +518,9 @@ class DutyUpdateService:
         
         # 监控餐饮Excel文件
         if self.unique_excel_folder:
+            self.unique_excel_ingest = ExcelIngestDebouncer(
+                self.on_unique_excel_settled, name='unique', settle_seconds=self.file_settle_seconds, logger=logger
+            )
             self.unique_event_handler = UniqueExcelFileHandler(self)
             self.unique_observer = watchdog.observers.Observer()
             self.unique_observer.schedule(self.unique_event_handler, self.unique_excel_folder, recursive=False)
@@ -184,8 +531,16 @@ class DutyUpdateService:
         """运行所有待执行的调度任务"""
         schedule.run_pending()
         
-    def check_new_excel(self):
-        """检查是否有新的Excel文件"""
+    def on_excel_settled(self, file_path, file_hash):
+        """排班文件稳定并校验通过后的导入回调"""
+        if self.latest_excel and os.path.basename(file_path) == self.latest_excel:
+            logger.info(f"当前使用的文件已修改，重新加载文件: {self.latest_excel}")
+            self.reload_excel(file_hash=file_hash)
+        else:
+            self.check_new_excel(known_hashes={file_path: file_hash})
+            
+    def check_new_excel(self, known_hashes=None):
+        """检查是否有新的Excel文件，known_hashes为已计算过的 {路径: 哈希}"""
         try:
             excel_files = [f for f in os.listdir(self.excel_folder) 
                           if f.endswith('.xlsx') and self._is_date_format(f.split('.')[0])]
@@ -207,8 +562,8 @@ class DutyUpdateService:
             newest_file = excel_files[0]
             newest_file_path = os.path.join(self.excel_folder, newest_file)
             
-            # 计算文件哈希值
-            new_hash = self.get_file_hash(newest_file_path)
+            # 计算文件哈希值（去抖动阶段已计算过的直接复用）
+            new_hash = (known_hashes or {}).get(newest_file_path) or self.get_file_hash(newest_file_path)
             
             # 如果是新文件或文件内容有变化
             if self.latest_excel != newest_file or self.current_file_hash != new_hash:
@@ -233,8 +588,8 @@ class DutyUpdateService:
             })
             self.health_status["status"] = "warning"
     
-    def reload_excel(self):
-        """重新加载当前Excel文件"""
+    def reload_excel(self, file_hash=None):
+        """重新加载当前Excel文件，file_hash为已计算过的哈希值"""
         if not self.latest_excel:
             return
             
@@ -242,7 +597,7 @@ class DutyUpdateService:
             file_path = os.path.join(self.excel_folder, self.latest_excel)
             
             # 计算新的哈希值
-            new_hash = self.get_file_hash(file_path)
+            new_hash = file_hash or self.get_file_hash(file_path)
             
             # 如果文件内容有变化，更新缓存
             if self.current_file_hash != new_hash:
@@ -290,26 +645,33 @@ class DutyUpdateService:
         else:
             # 超过c点后不再有区间，可根据实际业务返回None或c，这里返回None
             return "a"
+    def record_cache_lookup(self, cache, hit):
+        """记录一次缓存查询并更新命中率指标"""
+        stats = self.cache_stats.setdefault(cache, [0, 0])
+        stats[0] += 1 if hit else 0
+        stats[1] += 1
+        CACHE_HIT_RATE.labels(cache=cache).set(stats[0] / stats[1])
+        
+    def record_sheet_stats(self, dept, time_point, stats):
+        """记录读取sheet和规则计算的阶段统计"""
+        observe_phase('sheet_parse', stats["sheet_parse"], time_point, dept)
+        observe_phase('rule_eval', stats["rule_eval"], time_point, dept)
+        self.record_cache_lookup('sheet', stats["cache_hit"])
+        ROSTER_SIZE.labels(department=dept).set(stats["rows"])
+        
+    def record_transaction(self, timings, time_point='none', department='all'):
+        """记录一次写事务的提交耗时和持有写锁的时长（timings 由 db_pool.transaction 填写）"""
+        observe_phase('commit', timings['commit'], time_point, department)
+        WRITE_LOCK_TIME.set(timings['write_lock'])
+        
     def trigger_update(self, time_point=None):
         """触发异步更新任务，支持自动判断时间点"""
         if time_point is None:
             time_point = self.get_time_point_by_now()
         REQUEST_COUNT.labels(time_point=time_point).inc()
         logger.info(f"触发时间点 {time_point} 的更新任务")
-        self.executor.submit(self.run_async_update, time_point)
+        self.submit_coroutine(self.update_status(time_point))
         return schedule.CancelJob
-        
-    def run_async_update(self, time_point):
-        """在线程池中运行异步更新任务"""
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            loop.run_until_complete(self.update_status(time_point))
-        except Exception as e:
-            logger.error(f"执行更新任务时出错: {str(e)}")
-        finally:
-            loop.close()
             
     @lru_cache(maxsize=10)
     def get_sheet_data(self, file_path, sheet_name):
@@ -323,11 +685,12 @@ class DutyUpdateService:
     def get_file_hash(self, file_path):
         """获取文件的MD5哈希值，用于缓存标识"""
         hasher = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            buf = f.read(65536)
-            while len(buf) > 0:
-                hasher.update(buf)
+        with phase_timer('hash'):
+            with open(file_path, 'rb') as f:
                 buf = f.read(65536)
+                while len(buf) > 0:
+                    hasher.update(buf)
+                    buf = f.read(65536)
         return hasher.hexdigest()
     
     async def initialize_db_pool(self):
@@ -350,11 +713,8 @@ class DutyUpdateService:
         db_type = self.db_config.get("type", "sqlite").lower()
         
         if db_type == "sqlite":
-            # SQLite连接
-            import aiosqlite
-            conn = await aiosqlite.connect(self.db_config["path"])
-            conn.row_factory = aiosqlite.Row
-            return conn
+            # SQLite连接池，连接按需创建
+            return AiosqlitePool(self.db_config["path"], max_size=self.db_pool_size)
         
         
         else:
@@ -369,31 +729,16 @@ class DutyUpdateService:
             return
             
         try:
-            # 打开Excel文件
             file_path = os.path.join(self.excel_folder, self.latest_excel)
-            excel = pd.ExcelFile(file_path)
-            
-            # 获取所有部门的sheet
-            departments = excel.sheet_names
-            
             total_updates = 0
             
-            # 并发处理所有部门
-            tasks = []
-            for dept in departments:
-                task = self.process_department(file_path, dept, time_point)
-                tasks.append(task)
-                
-            # 等待所有部门处理完成
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # 处理结果
-            for result in results:
-                if isinstance(result, Exception):
-                    logger.error(f"处理部门时出错: {str(result)}")
-                    ERROR_COUNT.labels(type='department_process').inc()
-                else:
-                    total_updates += result
+            plan = await self.ensure_status_plan()
+            if plan is not None and plan.has(time_point):
+                # 使用预先计算的计划，只写入与数据库不同的记录
+                total_updates = await self.apply_status_plan(plan, time_point)
+            else:
+                # 没有可用计划时按原流程解析文件
+                total_updates = await self.update_status_from_file(file_path, time_point)
             
             # 更新健康状态
             self.health_status["last_update"] = datetime.now().isoformat()
@@ -402,6 +747,7 @@ class DutyUpdateService:
             process_time = time.time() - start_time
             PROCESS_TIME.observe(process_time)
             
+            LAST_APPLY_TIME.labels(time_point=time_point).set_to_current_time()
             logger.info(f"时间点 {time_point} 的更新完成，共更新 {total_updates} 条记录，耗时 {process_time:.2f} 秒")
             
         except Exception as e:
@@ -414,55 +760,99 @@ class DutyUpdateService:
             })
             self.health_status["status"] = "error"
             
+    async def update_status_from_file(self, file_path, time_point):
+        """直接解析排班文件并写库，返回更新记录数"""
+        # 打开Excel文件（阻塞IO放到线程池，避免阻塞事件循环）
+        loop = asyncio.get_running_loop()
+        with phase_timer('excel_open', time_point):
+            excel = await loop.run_in_executor(self.executor, pd.ExcelFile, file_path)
+        
+        # 获取所有部门的sheet
+        departments = excel.sheet_names
+        
+        total_updates = 0
+        
+        if self.process_workers:
+            # 在进程池中并行解析和计算，再由单一写入方合并写库
+            total_updates = await self.update_status_parallel(file_path, departments, time_point)
+        else:
+            # 并发处理所有部门
+            tasks = []
+            for dept in departments:
+                task = self.process_department(file_path, dept, time_point)
+                tasks.append(task)
+                
+            # 等待所有部门处理完成
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            
+            # 处理结果
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"处理部门时出错: {str(result)}")
+                    ERROR_COUNT.labels(type='department_process').inc()
+                else:
+                    total_updates += result
+        return total_updates
+        
+    async def update_status_parallel(self, file_path, departments, time_point):
+        """将各部门的sheet解析和班次规则计算分发到进程池，合并结果后在一个事务中写库"""
+        pool = self.start_process_pool()
+        loop = asyncio.get_running_loop()
+        
+        futures = [
+            loop.run_in_executor(pool, evaluate_duty_sheet, file_path, self.current_file_hash, dept, time_point)
+            for dept in departments
+        ]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        
+        # 合并各部门的紧凑结果
+        updates_by_dept = []
+        for dept, result in zip(departments, results):
+            if isinstance(result, Exception):
+                logger.error(f"处理部门 {dept} 时出错: {str(result)}")
+                ERROR_COUNT.labels(type='department_process').inc()
+                continue
+            result, stats = result
+            self.record_sheet_stats(dept, time_point, stats)
+            users_to_update = expand_duty_updates(*result)
+            if users_to_update:
+                updates_by_dept.append((dept, users_to_update))
+        
+        if not updates_by_dept:
+            return 0
+        
+        counts = await self.apply_department_updates(updates_by_dept, time_point)
+        for dept, update_count in counts.items():
+            UPDATE_COUNT.labels(department=dept).inc(update_count)
+            logger.info(f"部门 {dept} 在时间点 {time_point} 更新了 {update_count} 条记录")
+        return sum(counts.values())
+        
     async def process_department(self, file_path, dept, time_point):
         """处理单个部门的数据更新"""
         try:
             # 读取并缓存部门的排班数据
-            df = self.get_sheet_data(file_path, dept)
+            loop = asyncio.get_running_loop()
+            hits = self.get_sheet_data.cache_info().hits
+            start_time = time.perf_counter()
+            df = await loop.run_in_executor(self.executor, self.get_sheet_data, file_path, dept)
+            stats = {
+                "sheet_parse": time.perf_counter() - start_time,
+                "cache_hit": self.get_sheet_data.cache_info().hits > hits,
+                "rows": len(df)
+            }
             
             # 筛选需要更新的用户
-            users_to_update = []
-            
-            # 遍历员工排班信息
-            for _, row in df.iterrows():
-                user = row['user']
-                is_on_duty = row['is_on_duty']
-                shift = str(row['shift']).lower() if pd.notna(row['shift']) else ""
-                card = row['card'] if 'card' in row and pd.notna(row['card']) else None
-                
-                # 分开处理值班状态为1和0的情况
-                if is_on_duty == 1:
-                    # 值班状态为1时，根据班次和时间点决定是否更新
-                    should_update = False
-                    
-                    if shift in ['ns', 'lds'] and time_point in ['a', 'b', 'c']:
-                        should_update = True
-                    elif shift == 'ds' and time_point in ['a', 'c']:
-                        should_update = True
-                        
-                    if should_update:
-                        users_to_update.append({
-                            "user": user,
-                            "department": dept,
-                            "card": card,
-                            "status": 1
-                        })
-                elif is_on_duty == 0:
-                    # 值班状态为0时，将状态更新为0（仅执行更新操作，不执行插入）
-                    users_to_update.append({
-                        "user": user,
-                        "department": dept,
-                        "card": card,
-                        "status": 0,
-                        "update_only": True  # 标记仅执行更新，不执行插入
-                    })
+            start_time = time.perf_counter()
+            users_to_update = expand_duty_updates(*evaluate_duty_rows(df, dept, time_point))
+            stats["rule_eval"] = time.perf_counter() - start_time
+            self.record_sheet_stats(dept, time_point, stats)
             
             # 如果没有需要更新的用户，直接返回
             if not users_to_update:
                 return 0
                 
             # 批量更新数据库
-            update_count = await self.batch_update_users(users_to_update)
+            update_count = await self.batch_update_users(users_to_update, time_point, dept)
             UPDATE_COUNT.labels(department=dept).inc(update_count)
             
             logger.info(f"部门 {dept} 在时间点 {time_point} 更新了 {update_count} 条记录")
@@ -472,86 +862,302 @@ class DutyUpdateService:
             logger.error(f"处理部门 {dept} 时出错: {str(e)}")
             raise
             
-    async def batch_update_users(self, users):
+    async def batch_update_users(self, users, time_point='none', department='all'):
         """批量更新用户状态，不存在则插入，插入时带department、card、status字段，更新时也同步更新card、department、status（不处理is_on_duty）"""
         db_type = self.db_config.get("type", "sqlite").lower()
-        total_updated = 0
         # 获取本地当前时间字符串
-        from datetime import datetime
         local_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # 将用户列表分成批次
-        batches = [users[i:i+self.batch_size] for i in range(0, len(users), self.batch_size)]
         try:
             if db_type == "sqlite":
                 # SQLite批量更新
-                # 将 cursor 操作和 commit 分开
-                async with self.db_pool.cursor() as cursor:
-                    for batch in batches:
-                        user_names = [u["user"] for u in batch]
-                        # 依次更新每个用户的所有字段（不处理is_on_duty）
-                        updated_count = 0
-                        for u in batch:
-                            await cursor.execute(
-                                "UPDATE kbk_ic_manager SET card = ?, department = ?, status = ?, last_updated = ? WHERE user = ?",
-                                (u["card"], u["department"], u["status"], local_now, u["user"])
-                            )
-                            updated_count += cursor.rowcount
-                        total_updated += updated_count
-                        # 查找未被更新的用户（即数据库不存在的用户）
-                        if updated_count < len(user_names):
-                            placeholders = ','.join(['?'] * len(user_names))
-                            await cursor.execute(f"SELECT user, card FROM kbk_ic_manager WHERE user IN ({placeholders})", user_names)
-                            exist_users = set([row[0] for row in await cursor.fetchall()])
-                            # 新增：查找已存在的card，避免唯一性冲突
-                            card_values = [u["card"] for u in batch if u["card"] is not None]
-                            if card_values:
-                                card_placeholders = ','.join(['?'] * len(card_values))
-                                await cursor.execute(f"SELECT card FROM kbk_ic_manager WHERE card IN ({card_placeholders})", card_values)
-                                exist_cards = set([row[0] for row in await cursor.fetchall()])
-                            else:
-                                exist_cards = set()
-                            # 只对没有update_only标记且card未冲突的用户执行插入操作
-                            to_insert_candidates = [u for u in batch if u["user"] not in exist_users and not u.get("update_only", False) and (u["card"] is None or u["card"] not in exist_cards)]
-                            
-                            actually_inserted_cards_in_batch = set() # To track cards inserted in THIS loop iteration for THIS batch
-                            
-                            for u_candidate in to_insert_candidates:
-                                if u_candidate["card"] is not None and u_candidate["card"] in actually_inserted_cards_in_batch:
-                                    logger.warning(f"Skipping insertion of user {u_candidate['user']} with card {u_candidate['card']} as this card was already used for insertion in the current batch.")
-                                    continue
-
-                                try:
-                                    await cursor.execute(
-                                        "INSERT INTO kbk_ic_manager (user, card, department, status, last_updated) VALUES (?, ?, ?, ?, ?)",
-                                        (u_candidate["user"], u_candidate["card"], u_candidate["department"], u_candidate["status"], local_now)
-                                    )
-                                    if u_candidate["card"] is not None:
-                                        actually_inserted_cards_in_batch.add(u_candidate["card"])
-                                    total_updated += 1 
-                                except sqlite3.IntegrityError as integrity_error:
-                                    logger.error(f"IntegrityError during insertion for user {u_candidate['user']} with card {u_candidate['card']}: {integrity_error}. This card might have been inserted by a concurrent operation or pre-check missed it.")
-                                    ERROR_COUNT.labels(type='batch_insert_integrity_error').inc()
-                                except Exception as general_insert_error:
-                                    logger.error(f"Unexpected error during insertion for user {u_candidate['user']} with card {u_candidate['card']}: {general_insert_error}")
-                                    ERROR_COUNT.labels(type='batch_insert_unexpected_error').inc()
-                            # 记录日志：标记为update_only但未找到的用户
-                            update_only_users = [u["user"] for u in batch if u["user"] not in exist_users and u.get("update_only", False)]
-                            if update_only_users:
-                                logger.info(f"跳过插入update_only标记的用户: {', '.join(update_only_users)}")
-                # commit 操作移到 cursor 上下文管理器外面
-                await self.db_pool.commit()
+                # 在写事务中执行，退出时统一提交
+                timings = {}
+                async with self.db_pool.transaction(timings) as conn, conn.cursor() as cursor:
+                    total_updated = await self._write_user_batches(cursor, users, local_now, time_point, department)
+                self.record_transaction(timings, time_point, department)
             else:
                 raise ValueError(f"不支持的数据库类型: {db_type}")
             return total_updated
         except Exception as e:
             logger.error(f"批量更新用户时出错: {str(e)}")
             raise
+            
+    async def apply_department_updates(self, updates_by_dept, time_point='none'):
+        """单一写入方：在一个写事务中依次应用多个部门的更新，返回 {部门: 更新记录数}"""
+        db_type = self.db_config.get("type", "sqlite").lower()
+        local_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        counts = {}
+        try:
+            if db_type == "sqlite":
+                timings = {}
+                async with self.db_pool.transaction(timings) as conn, conn.cursor() as cursor:
+                    for dept, users in updates_by_dept:
+                        counts[dept] = await self._write_user_batches(cursor, users, local_now, time_point, dept)
+                self.record_transaction(timings, time_point)
+            else:
+                raise ValueError(f"不支持的数据库类型: {db_type}")
+            return counts
+        except Exception as e:
+            logger.error(f"合并写入部门更新时出错: {str(e)}")
+            raise
+            
+    async def _write_user_batches(self, cursor, users, local_now, time_point='none', department='all'):
+        """在给定游标上分批写入用户状态，返回更新和插入的记录数"""
+        total_updated = 0
+        update_seconds = 0.0
+        insert_seconds = 0.0
+        # 将用户列表分成批次
+        batches = [users[i:i+self.batch_size] for i in range(0, len(users), self.batch_size)]
+        # 数据库已有维表时，名单中的用户和部门同时登记到维表，事实表按整数id引用
+        await cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('kbk_ic_user', 'kbk_ic_department')"
+        )
+        register_dimensions = (await cursor.fetchone())[0] == 2
+        for batch in batches:
+            user_names = [u["user"] for u in batch]
+            if register_dimensions:
+                await cursor.executemany(swipe_facts.REGISTER_USER_SQL, [(name,) for name in user_names if name])
+                await cursor.executemany(swipe_facts.REGISTER_DEPARTMENT_SQL,
+                                         [(name,) for name in {u["department"] for u in batch} if name])
+            # 一次executemany更新整批用户的所有字段（不处理is_on_duty），rowcount为整批受影响行数
+            start_time = time.perf_counter()
+            await cursor.executemany(
+                "UPDATE kbk_ic_manager SET card = ?, department = ?, status = ?, last_updated = ? WHERE user = ?",
+                [(u["card"], u["department"], u["status"], local_now, u["user"]) for u in batch]
+            )
+            updated_count = cursor.rowcount
+            total_updated += updated_count
+            update_seconds += time.perf_counter() - start_time
+            # 查找未被更新的用户（即数据库不存在的用户）
+            if updated_count < len(user_names):
+                start_time = time.perf_counter()
+                placeholders = ','.join(['?'] * len(user_names))
+                await cursor.execute(f"SELECT user, card FROM kbk_ic_manager WHERE user IN ({placeholders})", user_names)
+                exist_users = set([row[0] for row in await cursor.fetchall()])
+                # 新增：查找已存在的card，避免唯一性冲突
+                card_values = [u["card"] for u in batch if u["card"] is not None]
+                if card_values:
+                    card_placeholders = ','.join(['?'] * len(card_values))
+                    await cursor.execute(f"SELECT card FROM kbk_ic_manager WHERE card IN ({card_placeholders})", card_values)
+                    exist_cards = set([row[0] for row in await cursor.fetchall()])
+                else:
+                    exist_cards = set()
+                # 只对没有update_only标记且card未冲突的用户执行插入操作
+                to_insert_candidates = [u for u in batch if u["user"] not in exist_users and not u.get("update_only", False) and (u["card"] is None or u["card"] not in exist_cards)]
+                            
+                actually_inserted_cards_in_batch = set() # To track cards inserted in THIS loop iteration for THIS batch
+                            
+                for u_candidate in to_insert_candidates:
+                    if u_candidate["card"] is not None and u_candidate["card"] in actually_inserted_cards_in_batch:
+                        logger.warning(f"Skipping insertion of user {u_candidate['user']} with card {u_candidate['card']} as this card was already used for insertion in the current batch.")
+                        continue
+
+                    try:
+                        await cursor.execute(
+                            "INSERT INTO kbk_ic_manager (user, card, department, status, last_updated) VALUES (?, ?, ?, ?, ?)",
+                            (u_candidate["user"], u_candidate["card"], u_candidate["department"], u_candidate["status"], local_now)
+                        )
+                        if u_candidate["card"] is not None:
+                            actually_inserted_cards_in_batch.add(u_candidate["card"])
+                        total_updated += 1 
+                    except sqlite3.IntegrityError as integrity_error:
+                        logger.error(f"IntegrityError during insertion for user {u_candidate['user']} with card {u_candidate['card']}: {integrity_error}. This card might have been inserted by a concurrent operation or pre-check missed it.")
+                        ERROR_COUNT.labels(type='batch_insert_integrity_error').inc()
+                    except Exception as general_insert_error:
+                        logger.error(f"Unexpected error during insertion for user {u_candidate['user']} with card {u_candidate['card']}: {general_insert_error}")
+                        ERROR_COUNT.labels(type='batch_insert_unexpected_error').inc()
+                # 记录日志：标记为update_only但未找到的用户
+                update_only_users = [u["user"] for u in batch if u["user"] not in exist_users and u.get("update_only", False)]
+                if update_only_users:
+                    logger.info(f"跳过插入update_only标记的用户: {', '.join(update_only_users)}")
+                insert_seconds += time.perf_counter() - start_time
+        observe_phase('db_update', update_seconds, time_point, department)
+        observe_phase('db_insert', insert_seconds, time_point, department)
+        return total_updated
+        
+    async def ensure_status_plan(self):
+        """返回与当前排班文件一致的状态计划，文件或内容变化时重建，失败时返回None"""
+        if not self.latest_excel:
+            return None
+        async with self.plan_lock:
+            plan = self.status_plan
+            hit = plan is not None and plan.source_file == self.latest_excel and plan.file_hash == self.current_file_hash
+            self.record_cache_lookup('plan', hit)
+            if hit:
+                return plan
+            try:
+                self.status_plan = await self.build_status_plan(self.latest_excel, self.current_file_hash)
+            except Exception as e:
+                ERROR_COUNT.labels(type='plan_build').inc()
+                logger.error(f"构建排班状态计划时出错: {str(e)}")
+                self.status_plan = None
+            return self.status_plan
+            
+    async def build_status_plan(self, file_name, file_hash):
+        """解析排班文件一次，计算所有时间点的目标状态"""
+        loop = asyncio.get_running_loop()
+        file_path = os.path.join(self.excel_folder, file_name)
+        with phase_timer('excel_open', 'plan'):
+            excel = await loop.run_in_executor(self.executor, pd.ExcelFile, file_path)
+        departments = excel.sheet_names
+        time_points = list(self.time_points)
+        
+        if self.process_workers:
+            pool = self.start_process_pool()
+            futures = [
+                loop.run_in_executor(pool, evaluate_duty_sheet_plan, file_path, file_hash, dept, time_points)
+                for dept in departments
+            ]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        else:
+            results = await loop.run_in_executor(
+                self.executor, evaluate_duty_plan, file_path, file_hash, departments, time_points
+            )
+        
+        # 合并各部门的结果为一组共用的行数组
+        users, depts, cards = [], [], []
+        selected = {tp: [] for tp in time_points}
+        active = {tp: [] for tp in time_points}
+        for dept, result in zip(departments, results):
+            if isinstance(result, Exception):
+                raise RuntimeError(f"部门 {dept} 计划计算失败: {str(result)}")
+            (_, dept_users, dept_cards, packed), stats = result
+            self.record_sheet_stats(dept, 'plan', stats)
+            if not dept_users:
+                continue
+            users.extend(dept_users)
+            depts.extend([dept] * len(dept_users))
+            cards.extend(dept_cards)
+            for tp, (selected_bytes, active_bytes) in packed.items():
+                selected[tp].append(np.frombuffer(selected_bytes, dtype=np.uint8).astype(bool))
+                active[tp].append(np.frombuffer(active_bytes, dtype=np.uint8).astype(bool))
+        
+        masks = {
+            tp: (np.concatenate(selected[tp]) if selected[tp] else np.zeros(0, dtype=bool),
+                 np.concatenate(active[tp]) if active[tp] else np.zeros(0, dtype=bool))
+            for tp in time_points
+        }
+        plan = StatusPlan('duty', file_name, file_hash, users, depts, cards, masks)
+        PLAN_BUILD_COUNT.labels(kind='duty').inc()
+        logger.info(f"排班状态计划已构建: {file_name}，共 {plan.size} 行，时间点 {time_points}")
+        return plan
+        
+    async def ensure_meal_plan(self):
+        """返回与当前餐饮文件一致的餐饮计划，文件或内容变化时重建，失败时返回None"""
+        if not self.latest_unique_excel or not self.unique_excel_folder:
+            return None
+        async with self.plan_lock:
+            plan = self.meal_plan
+            hit = plan is not None and plan.source_file == self.latest_unique_excel and plan.file_hash == self.current_unique_file_hash
+            self.record_cache_lookup('plan', hit)
+            if hit:
+                return plan
+            try:
+                self.meal_plan = await self.build_meal_plan(self.latest_unique_excel, self.current_unique_file_hash)
+            except Exception as e:
+                ERROR_COUNT.labels(type='plan_build').inc()
+                logger.error(f"构建餐饮状态计划时出错: {str(e)}")
+                self.meal_plan = None
+            return self.meal_plan
+            
+    async def build_meal_plan(self, file_name, file_hash):
+        """解析餐饮文件一次，计算早餐和晚餐的目标状态"""
+        loop = asyncio.get_running_loop()
+        file_path = os.path.join(self.unique_excel_folder, file_name)
+        
+        def read_sheets():
+            with pd.ExcelFile(file_path) as excel:
+                return {sheet: excel.parse(sheet) for sheet in excel.sheet_names}
+        sheets = await loop.run_in_executor(self.executor, read_sheets)
+        
+        rows = {"breakfast": [], "dinner": []}
+        for dept, df in sheets.items():
+            missing_columns = [col for col in MEAL_COLUMNS if col not in df.columns]
+            if missing_columns:
+                logger.warning(f"部门 {dept} 的表格中缺少列: {missing_columns}")
+                continue
+            for meal_type in rows:
+                rows[meal_type].extend(evaluate_meal_rows(df, meal_type))
+        
+        # 早餐行在前、晚餐行在后，各自的位图只选中自己的行
+        all_rows = rows["breakfast"] + rows["dinner"]
+        breakfast_mask = np.zeros(len(all_rows), dtype=bool)
+        breakfast_mask[:len(rows["breakfast"])] = True
+        masks = {
+            "breakfast": (breakfast_mask, breakfast_mask),
+            "dinner": (~breakfast_mask, ~breakfast_mask)
+        }
+        plan = StatusPlan(
+            'meal', file_name, file_hash,
+            [u["user"] for u in all_rows], [u["department"] for u in all_rows], [u["card"] for u in all_rows],
+            masks
+        )
+        PLAN_BUILD_COUNT.labels(kind='meal').inc()
+        logger.info(f"餐饮状态计划已构建: {file_name}，早餐 {len(rows['breakfast'])} 行，晚餐 {len(rows['dinner'])} 行")
+        return plan
+        
+    async def load_plan_delta(self, users_to_update):
+        """读取目标用户在数据库中的当前值，返回需要实际写入的目标"""
+        user_names = list(dict.fromkeys(u["user"] for u in users_to_update))
+        current_rows = []
+        async with self.db_pool.acquire() as conn:
+            for i in range(0, len(user_names), 500):
+                chunk = user_names[i:i+500]
+                placeholders = ','.join(['?'] * len(chunk))
+                async with conn.execute(
+                    f"SELECT user, card, department, status FROM kbk_ic_manager WHERE user IN ({placeholders})", chunk
+                ) as cursor:
+                    current_rows.extend(tuple(row) for row in await cursor.fetchall())
+        return diff_plan_updates(users_to_update, current_rows)
+        
+    async def apply_status_plan(self, plan, key):
+        """应用计划中指定任务的差异，返回写入的记录数"""
+        users_to_update = plan.updates_for(key)
+        delta = await self.load_plan_delta(users_to_update)
+        updated = 0
+        if delta:
+            if plan.kind == 'meal':
+                updated = await self.batch_meal_update_users(delta)
+            else:
+                # 按部门分组后由单一写入方在一个事务中写入
+                by_dept = {}
+                for u in delta:
+                    by_dept.setdefault(u["department"], []).append(u)
+                counts = await self.apply_department_updates(list(by_dept.items()), key)
+                for dept, update_count in counts.items():
+                    UPDATE_COUNT.labels(department=dept).inc(update_count)
+                    logger.info(f"部门 {dept} 在时间点 {key} 更新了 {update_count} 条记录")
+                updated = sum(counts.values())
+        plan.mark_applied(key, len(users_to_update), len(delta), updated)
+        logger.info(f"{plan.kind}计划 {key}: 目标 {len(users_to_update)} 条，差异 {len(delta)} 条，写入 {updated} 条")
+        return updated
         
     async def get_health(self, request):
         """返回服务健康状态"""
         # 健康检查API
         return aiohttp.web.json_response(self.health_status)
     
+    async def get_plan(self, request):
+        """返回当前排班和餐饮计划的摘要"""
+        return web.json_response({
+            "duty": self.status_plan.summary() if self.status_plan else None,
+            "meal": self.meal_plan.summary() if self.meal_plan else None
+        })
+        
+    async def get_plan_key(self, request):
+        """返回指定任务（时间点或餐次）的目标列表"""
+        key = request.match_info['key']
+        plan = self.meal_plan if key in ("breakfast", "dinner") else self.status_plan
+        if plan is None or not plan.has(key):
+            return web.json_response({"error": f"没有任务 {key} 的计划"}, status=404)
+        return web.json_response({
+            "kind": plan.kind,
+            "key": key,
+            "source_file": plan.source_file,
+            "last_applied": plan.applied.get(key),
+            "targets": plan.updates_for(key)
+        })
+    
     def cleanup(self):
         """清理资源"""
         if hasattr(self, 'observer') and self.observer.is_alive():
@@ -562,15 +1168,29 @@ class DutyUpdateService:
         if hasattr(self, 'unique_observer') and self.unique_observer.is_alive():
             self.unique_observer.stop()
             self.unique_observer.join()
+            
+        # 停止去抖动导入线程
+        for ingest in (self.excel_ingest, self.unique_excel_ingest):
+            if ingest is not None:
+                ingest.stop()
         
-        # 关闭线程池
+        # 关闭线程池和进程池
         if hasattr(self, 'executor'):
             self.executor.shutdown(wait=True)
+        self.shutdown_process_pool()
         
         logger.info("资源已清理")
 
-    def check_new_unique_excel(self):
-        """检查是否有新的餐饮Excel文件"""
+    def on_unique_excel_settled(self, file_path, file_hash):
+        """餐饮文件稳定并校验通过后的导入回调"""
+        if self.latest_unique_excel and os.path.basename(file_path) == self.latest_unique_excel:
+            logger.info(f"当前使用的餐饮文件已修改，重新加载文件: {self.latest_unique_excel}")
+            self.reload_unique_excel(file_hash=file_hash)
+        else:
+            self.check_new_unique_excel(known_hashes={file_path: file_hash})
+            
+    def check_new_unique_excel(self, known_hashes=None):
+        """检查是否有新的餐饮Excel文件，known_hashes为已计算过的 {路径: 哈希}"""
         if not self.unique_excel_folder:
             return
             
@@ -595,8 +1215,8 @@ class DutyUpdateService:
             newest_file = excel_files[0]
             newest_file_path = os.path.join(self.unique_excel_folder, newest_file)
             
-            # 计算文件哈希值
-            new_hash = self.get_file_hash(newest_file_path)
+            # 计算文件哈希值（去抖动阶段已计算过的直接复用）
+            new_hash = (known_hashes or {}).get(newest_file_path) or self.get_file_hash(newest_file_path)
             
             # 如果是新文件或文件内容有变化
             if self.latest_unique_excel != newest_file or self.current_unique_file_hash != new_hash:
@@ -606,6 +1226,8 @@ class DutyUpdateService:
                 self.health_status["latest_unique_excel"] = newest_file
                 # 清除缓存
                 self.get_sheet_data.cache_clear()
+                # 提前构建餐饮计划，触发时只需写入差异
+                self.submit_coroutine(self.ensure_meal_plan())
                 
         except Exception as e:
             ERROR_COUNT.labels(type='unique_file_check').inc()
@@ -617,8 +1239,8 @@ class DutyUpdateService:
             })
             self.health_status["status"] = "warning"
     
-    def reload_unique_excel(self):
-        """重新加载当前餐饮Excel文件"""
+    def reload_unique_excel(self, file_hash=None):
+        """重新加载当前餐饮Excel文件，file_hash为已计算过的哈希值"""
         if not self.latest_unique_excel or not self.unique_excel_folder:
             return
             
@@ -626,7 +1248,7 @@ class DutyUpdateService:
             file_path = os.path.join(self.unique_excel_folder, self.latest_unique_excel)
             
             # 计算新的哈希值
-            new_hash = self.get_file_hash(file_path)
+            new_hash = file_hash or self.get_file_hash(file_path)
             
             # 如果文件内容有变化，更新缓存
             if self.current_unique_file_hash != new_hash:
@@ -635,6 +1257,7 @@ class DutyUpdateService:
                 
                 # 清除缓存
                 self.get_sheet_data.cache_clear()
+                self.submit_coroutine(self.ensure_meal_plan())
                 
         except Exception as e:
             ERROR_COUNT.labels(type='unique_file_reload').inc()
@@ -677,7 +1300,7 @@ class DutyUpdateService:
         else:
             logger.info(f"测试模式启用，跳过{meal_type}餐饮任务的日期校验")
         logger.info(f"触发{meal_type}餐饮更新任务，文件日期校验通过")
-        self.executor.submit(self.run_async_unique_update, meal_type)
+        self.submit_coroutine(self.update_meal_status(meal_type))
         return schedule.CancelJob
         
     def manual_trigger_unique_update(self, meal_type):
@@ -687,20 +1310,7 @@ class DutyUpdateService:
             return False
         
         logger.info(f"手动触发{meal_type}餐饮更新任务")
-        self.executor.submit(self.run_async_unique_update, meal_type)
-        return True
-        
-    def run_async_unique_update(self, meal_type):
-        """在线程池中运行餐饮异步更新任务"""
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            loop.run_until_complete(self.update_meal_status(meal_type))
-        except Exception as e:
-            logger.error(f"执行餐饮更新任务时出错: {str(e)}")
-        finally:
-            loop.close()
+        return self.submit_coroutine(self.update_meal_status(meal_type)) is not None
             
     async def update_meal_status(self, meal_type):
         """更新餐饮状态"""
@@ -711,31 +1321,37 @@ class DutyUpdateService:
             return
             
         try:
-            # 打开Excel文件
-            file_path = os.path.join(self.unique_excel_folder, self.latest_unique_excel)
-            excel = pd.ExcelFile(file_path)
-            
-            # 获取所有部门的sheet
-            departments = excel.sheet_names
-            
             total_updates = 0
             
-            # 并发处理所有部门
-            tasks = []
-            for dept in departments:
-                task = self.process_meal_department(file_path, dept, meal_type)
-                tasks.append(task)
+            plan = await self.ensure_meal_plan()
+            if plan is not None and plan.has(meal_type):
+                # 使用预先计算的计划，只写入与数据库不同的记录
+                total_updates = await self.apply_status_plan(plan, meal_type)
+            else:
+                # 打开Excel文件（阻塞IO放到线程池，避免阻塞事件循环）
+                loop = asyncio.get_running_loop()
+                file_path = os.path.join(self.unique_excel_folder, self.latest_unique_excel)
+                excel = await loop.run_in_executor(self.executor, pd.ExcelFile, file_path)
                 
-            # 等待所有部门处理完成
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # 处理结果
-            for result in results:
-                if isinstance(result, Exception):
-                    logger.error(f"处理部门餐饮时出错: {str(result)}")
-                    ERROR_COUNT.labels(type='meal_department_process').inc()
-                else:
-                    total_updates += result
+                # 获取所有部门的sheet
+                departments = excel.sheet_names
+                
+                # 并发处理所有部门
+                tasks = []
+                for dept in departments:
+                    task = self.process_meal_department(file_path, dept, meal_type)
+                    tasks.append(task)
+                    
+                # 等待所有部门处理完成
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                
+                # 处理结果
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.error(f"处理部门餐饮时出错: {str(result)}")
+                        ERROR_COUNT.labels(type='meal_department_process').inc()
+                    else:
+                        total_updates += result
             
             # 更新健康状态
             self.health_status["last_update"] = datetime.now().isoformat()
@@ -746,6 +1362,7 @@ class DutyUpdateService:
             
             logger.info(f"餐饮类型 {meal_type} 的更新完成，共更新 {total_updates} 条记录，耗时 {process_time:.2f} 秒")
             MEAL_UPDATE_COUNT.labels(meal_type=meal_type).inc(total_updates)
+            LAST_APPLY_TIME.labels(time_point=meal_type).set_to_current_time()
             
         except Exception as e:
             ERROR_COUNT.labels(type='meal_update_process').inc()
@@ -761,49 +1378,18 @@ class DutyUpdateService:
         """处理单个部门的餐饮数据更新，支持新的多列结构"""
         try:
             # 读取并缓存部门的餐饮数据
-            df = self.get_sheet_data(file_path, dept)
+            loop = asyncio.get_running_loop()
+            df = await loop.run_in_executor(self.executor, self.get_sheet_data, file_path, dept)
             
             # 检查新的列结构是否存在
-            required_columns = ['breakfast', 'breakfast_department', 'breakfast_card', 
-                              'dinner', 'dinner_department', 'dinner_card']
-            missing_columns = [col for col in required_columns if col not in df.columns]
+            missing_columns = [col for col in MEAL_COLUMNS if col not in df.columns]
             
             if missing_columns:
                 logger.warning(f"部门 {dept} 的表格中缺少列: {missing_columns}")
                 return 0
                 
             # 筛选需要更新的用户
-            users_to_update = []
-            
-            # 遍历每一行数据
-            for _, row in df.iterrows():
-                # 处理breakfast相关数据
-                if meal_type == "breakfast":
-                    breakfast_user = row['breakfast']
-                    breakfast_dept = row['breakfast_department'] 
-                    breakfast_card = row['breakfast_card']
-                    
-                    if pd.notna(breakfast_user) and str(breakfast_user).strip():
-                        users_to_update.append({
-                            "user": str(breakfast_user).strip(),
-                            "department": str(breakfast_dept).strip() if pd.notna(breakfast_dept) else None,
-                            "card": str(breakfast_card).strip() if pd.notna(breakfast_card) else None,
-                            "status": 1
-                        })
-                
-                # 处理dinner相关数据
-                elif meal_type == "dinner":
-                    dinner_user = row['dinner']
-                    dinner_dept = row['dinner_department']
-                    dinner_card = row['dinner_card']
-                    
-                    if pd.notna(dinner_user) and str(dinner_user).strip():
-                        users_to_update.append({
-                            "user": str(dinner_user).strip(),
-                            "department": str(dinner_dept).strip() if pd.notna(dinner_dept) else None,
-                            "card": str(dinner_card).strip() if pd.notna(dinner_card) else None,
-                            "status": 1
-                        })
+            users_to_update = evaluate_meal_rows(df, meal_type)
             
             # 如果没有需要更新的用户，直接返回
             if not users_to_update:
@@ -830,8 +1416,9 @@ class DutyUpdateService:
         
         try:
             if db_type == "sqlite":
-                # SQLite批量更新
-                async with self.db_pool.cursor() as cursor:
+                # SQLite批量更新，在写事务中执行，退出时统一提交
+                timings = {}
+                async with self.db_pool.transaction(timings) as conn, conn.cursor() as cursor:
                     for batch in batches:
                         user_names = [u["user"] for u in batch]
                         # 首先尝试更新已存在的用户
@@ -883,9 +1470,7 @@ class DutyUpdateService:
                                 except Exception as general_insert_error:
                                     logger.error(f"餐饮数据插入意外错误，用户 {u_candidate['user']} 卡号 {u_candidate['card']}: {general_insert_error}")
                                     ERROR_COUNT.labels(type='meal_insert_unexpected_error').inc()
-                
-                # 提交事务
-                await self.db_pool.commit()
+                self.record_transaction(timings)
             else:
                 raise ValueError(f"不支持的数据库类型: {db_type}")
             
@@ -917,34 +1502,18 @@ if __name__ == "__main__":
         "c": "16:55"
     }
     
-    # 创建并启动HTTP服务器来提供健康状态API
-    async def start_http_server(service):
-        from aiohttp import web
-        app = web.Application()
-        app.router.add_get('/health', service.get_health)
-        
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, 'localhost', 5552)
-        
-        await site.start()
-        logger.info("HTTP服务器已启动在端口 5552")
-    
     # 创建服务实例（启用测试模式）
     service = DutyUpdateService(
         excel_folder, db_config, time_points, 
         unique_excel_folder=unique_excel_folder,  # 添加餐饮Excel文件夹
         cache_size=20, batch_size=100, max_workers=4,
-        test_mode=True  # 启用测试模式，跳过餐饮任务的日期校验
+        test_mode=True,  # 启用测试模式，跳过餐饮任务的日期校验
+        process_workers=max(1, (os.cpu_count() or 2) - 1)  # 多核机器上并行解析大排班表
     )
     
     try:
-        # 启动HTTP服务器
-        loop = asyncio.get_event_loop()
-        loop.create_task(start_http_server(service))
-        
-        # 启动主服务
-        service.start()
+        # 启动主服务，健康状态API在同一事件循环中提供
+        service.start(http_host='localhost', http_port=5552)
     except KeyboardInterrupt:
         logger.info("收到终止信号，正在关闭服务...")
     finally:
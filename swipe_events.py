@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+实时刷卡事件
+http_reader 处理完每次刷卡后发布一条小事件（结果、机号、部门、时间），管理界面订阅后以SSE推送给看板，
+看板不再反复查询整张表。
+
+发布/订阅基于本机Unix数据报套接字，不需要额外的消息服务：
+- 每个订阅进程（manager_server的每个工作进程）在 EVENT_DIR 下绑定自己的套接字文件
+- 发布方把事件非阻塞地发送给目录中的每个套接字，订阅方不存在或缓冲区已满时直接丢弃，
+  不影响刷卡处理；对方已退出的套接字文件由发布方清理
+- 订阅进程内由一个接收线程维护最近事件和按秒聚合的计数，所有SSE连接共享
+"""
+import os
+import json
+import time
+import errno
+import socket
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+EVENT_DIR = os.environ.get('IC_SWIPE_EVENT_DIR', '/tmp/ic_swipe_events')
+
+# 刷卡结果
+OUTCOME_SUCCESS = 'success'
+OUTCOME_INACTIVE = 'inactive'
+OUTCOME_UNKNOWN_CARD = 'unknown_card'
+OUTCOME_OFF_HOURS = 'off_hours'
+OUTCOME_ERROR = 'error'
+OUTCOMES = [OUTCOME_SUCCESS, OUTCOME_INACTIVE, OUTCOME_UNKNOWN_CARD, OUTCOME_OFF_HOURS, OUTCOME_ERROR]
+
+# 发布方缓存订阅者列表的秒数
+SUBSCRIBER_REFRESH = 5.0
+MAX_DATAGRAM = 4096
+# 订阅进程保留的最近事件数和按秒聚合的秒数
+RECENT_EVENTS = 1000
+AGGREGATE_SECONDS = 300
+
+STREAM_KEEPALIVE = 15
+# 单个SSE连接的最长时间，超时后关闭，浏览器EventSource会自动重连
+# 同时订阅的连接数与日志follow共用 wsgi_server.stream_slots 的名额
+STREAM_MAX_SECONDS = 300
+
+
+class SwipeEventPublisher:
+    """向 EVENT_DIR 中所有订阅套接字发送事件，发送失败只记调试日志"""
+
+    def __init__(self, event_dir=EVENT_DIR):
+        self.event_dir = event_dir
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.refreshed_at = 0.0
+
+    def _targets(self):
+        now = time.monotonic()
+        if now - self.refreshed_at >= SUBSCRIBER_REFRESH:
+            try:
+                self.subscribers = [os.path.join(self.event_dir, name) for name in os.listdir(self.event_dir)
+                                    if name.endswith('.sock')]
+            except FileNotFoundError:
+                self.subscribers = []
+            self.refreshed_at = now
+        return list(self.subscribers)
+
+    def publish(self, outcome, jihao, department=None, ts=None):
+        """发布一次刷卡结果，返回送达的订阅者数"""
+        payload = json.dumps({
+            'ts': round(ts if ts is not None else time.time(), 3),
+            'outcome': outcome,
+            'jihao': str(jihao),
+            'department': department,
+        }, ensure_ascii=False).encode('utf-8')
+        delivered = 0
+        with self.lock:
+            for target in self._targets():
+                try:
+                    self.sock.sendto(payload, target)
+                    delivered += 1
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # 订阅进程已退出，清理遗留的套接字文件
+                    self.subscribers.remove(target)
+                    try:
+                        os.unlink(target)
+                    except OSError:
+                        pass
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                        logger.debug(f"发送刷卡事件失败 {target}: {e}")
+        return delivered
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def publish(outcome, jihao, department=None, ts=None):
+    """模块级发布入口，首次调用时创建发布者；任何错误都不会抛给刷卡处理流程"""
+    global _publisher
+    try:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = SwipeEventPublisher()
+        return _publisher.publish(outcome, jihao, department, ts)
+    except Exception as e:
+        logger.debug(f"发布刷卡事件失败: {e}")
+        return 0
+
+
+def matches(event, filters):
+    """事件是否满足订阅者的过滤条件 {'jihao': set, 'department': set, 'outcome': set}，空集合表示不过滤"""
+    return all(not values or event.get(key) in values for key, values in filters.items())
+
+
+class SwipeEventHub:
+    """
+    订阅进程内的事件中心：接收线程把事件追加到最近事件队列，并累加到按秒聚合的计数中，
+    SSE连接在条件变量上等待，不各自读取套接字
+    """
+
+    def __init__(self, event_dir=EVENT_DIR):
+        self.event_dir = event_dir
+        self.path = None
+        self.sock = None
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.events = deque(maxlen=RECENT_EVENTS)
+        # {秒: {(结果, 机号, 部门): 次数}}
+        self.seconds = {}
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """绑定本进程的套接字并启动接收线程，重复调用无副作用"""
+        with self.condition:
+            if self.thread is not None and self.path == self._socket_path():
+                return self
+            # fork后的子进程不继承接收线程，按当前pid重新绑定
+            os.makedirs(self.event_dir, exist_ok=True)
+            self.path = self._socket_path()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.path)
+            self.sock.settimeout(1.0)
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._receive, name='swipe-events', daemon=True)
+            self.thread.start()
+        logger.info(f"刷卡事件订阅已启动: {self.path}")
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _socket_path(self):
+        return os.path.join(self.event_dir, f"manager-{os.getpid()}.sock")
+
+    def _receive(self):
+        while not self.stopped.is_set():
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                event = json.loads(data.decode('utf-8'))
+            except ValueError:
+                logger.debug("忽略无法解析的刷卡事件")
+                continue
+            self.add(event)
+
+    def add(self, event):
+        """记录一条事件并唤醒等待的连接"""
+        second = int(event.get('ts', time.time()))
+        key = (event.get('outcome'), event.get('jihao'), event.get('department'))
+        with self.condition:
+            self.seq += 1
+            self.events.append((self.seq, event))
+            if second not in self.seconds:
+                # 新的一秒开始时丢弃超出聚合窗口的计数
+                for stale in [s for s in self.seconds if s < second - AGGREGATE_SECONDS]:
+                    del self.seconds[stale]
+                self.seconds[second] = {}
+            bucket = self.seconds[second]
+            bucket[key] = bucket.get(key, 0) + 1
+            self.condition.notify_all()
+
+    def events_after(self, seq):
+        """返回序号大于 seq 的最近事件"""
+        with self.condition:
+            return [(number, event) for number, event in self.events if number > seq]
+
+    def counts(self, second, filters):
+        """某一秒内满足过滤条件的计数 {结果: 次数}"""
+        with self.condition:
+            bucket = dict(self.seconds.get(second, {}))
+        totals = {}
+        for (outcome, jihao, department), count in bucket.items():
+            if matches({'outcome': outcome, 'jihao': jihao, 'department': department}, filters):
+                totals[outcome] = totals.get(outcome, 0) + count
+        return totals
+
+    def wait(self, seq, timeout):
+        """等待序号超过 seq 的新事件，返回当前序号"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > seq, timeout=timeout)
+            return self.seq
+
+
+def sse_message(data, event_id=None, event=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def stream(hub, filters, aggregate=False, last_id=None, keepalive=STREAM_KEEPALIVE,
+           max_seconds=STREAM_MAX_SECONDS, clock=time.time, sleep=time.sleep):
+    """
+    SSE事件生成器
+    aggregate 为False时逐条推送满足过滤条件的事件（断线重连时从 Last-Event-ID 之后继续）；
+    为True时每秒推送一次上一整秒内的计数 {ts, counts: {结果: 次数}}，没有刷卡的秒不推送
+    """
+    yield "retry: 1000\n\n"
+    started = time.monotonic()
+    # 序号只在本进程内有效，重连到其他工作进程或重启后的 Last-Event-ID 从当前位置开始
+    seq = hub.seq if last_id is None or last_id > hub.seq else last_id
+    last_second = int(clock()) - 1
+    last_sent = time.monotonic()
+    while time.monotonic() - started < max_seconds:
+        if aggregate:
+            sleep(max(0.0, last_second + 2 - clock()))
+            closed = int(clock()) - 1
+            for second in range(last_second + 1, closed + 1):
+                totals = hub.counts(second, filters)
+                if totals:
+                    last_sent = time.monotonic()
+                    yield sse_message({'ts': second, 'counts': totals}, event='counts')
+            last_second = closed
+        else:
+            hub.wait(seq, timeout=keepalive)
+            for number, event in hub.events_after(seq):
+                seq = number
+                if matches(event, filters):
+                    last_sent = time.monotonic()
+                    yield sse_message(event, event_id=number)
+        if time.monotonic() - last_sent >= keepalive:
+            last_sent = time.monotonic()
+            yield ": keepalive\n\n"
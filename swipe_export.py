@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+刷卡和失败记录导出
+按 /api/counts 相同的筛选条件逐批从数据库游标读取记录，边读边写CSV或XLSX，
+不把结果整体读入内存，可以导出数百万行：
+- CSV: 每批记录编码后直接作为响应的一块发送
+- XLSX: 使用openpyxl只写模式逐行写入临时文件（每个工作表最多1048575行数据，超出后自动新建工作表），
+  生成完成后按块发送并删除临时文件；xlsx是zip格式，只能在全部行写完后生成
+"""
+import io
+import os
+import csv
+import tempfile
+
+import openpyxl
+
+import swipe_facts
+from swipe_rollup import RawSource
+
+DEFAULT_CHUNK_SIZE = 5000
+SEND_BLOCK_SIZE = 64 * 1024
+# 导出与长连接共用名额，名额已满时建议客户端等待的秒数
+RETRY_AFTER = 30
+# Excel单个工作表最多1048576行，第一行为表头
+XLSX_SHEET_ROWS = 1048575
+
+EXPORT_KINDS = ('swipes', 'failures')
+EXPORT_HEADERS = {
+    'swipes': ['区域', '用户', '部门', '时间'],
+    'failures': ['用户', '部门', '时间', '失败类型'],
+}
+FAILURE_TYPES = {1: '卡片未激活', 2: '卡号不存在', 3: '不在用餐时间'}
+
+
+def _filters(ts, department_column, user_column, bound, start_day, end_day, department, user):
+    conditions = []
+    params = []
+    for condition, value in ((f"{ts} >= ?", bound(start_day) if start_day else None),
+                             (f"{ts} < ?", bound(end_day) if end_day else None),
+                             (f"{department_column} = ?", department or None),
+                             (f"{user_column} = ?", user or None)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    return "".join(f" AND {condition}" for condition in conditions), params
+
+
+def export_queries(kind, table_names, start_day=None, end_day=None, department='', user='',
+                   fact_mode=False, failure_fact_mode=False):
+    """
+    生成导出查询 [(sql, params)]，依次执行即为全部导出行
+    刷卡记录每个区域一条查询，日期条件与 /api/counts 相同，可以使用日期索引；失败记录没有区域，忽略区域条件
+    """
+    if kind == 'swipes':
+        queries = []
+        for table in table_names:
+            source = RawSource(table, fact_mode)
+            where, params = _filters(source.ts, source.department, source.user, source.bound,
+                                     start_day, end_day, department, user)
+            time_column = swipe_facts.EPOCH_TO_LOCAL_TEXT.format('s.ts') if fact_mode else 's.transaction_date'
+            queries.append((f"SELECT '{table}', {source.user}, {source.department}, {time_column} "
+                            f"FROM {source.joined}{where}", params))
+        return queries
+    if failure_fact_mode:
+        # 直接读事实表，时间条件使用 (ts, failure_type, department_id) 索引
+        where, params = _filters("f.ts", "d.name", "u.name", swipe_facts.local_epoch,
+                                 start_day, end_day, department, user)
+        return [(f"SELECT u.name, d.name, {swipe_facts.EPOCH_TO_LOCAL_TEXT.format('f.ts')}, f.failure_type "
+                 "FROM kbk_ic_failure f LEFT JOIN kbk_ic_user u ON u.id = f.user_id "
+                 f"LEFT JOIN kbk_ic_department d ON d.id = f.department_id WHERE 1 = 1{where}", params)]
+    where, params = _filters("transaction_date", "department", "user", str, start_day, end_day, department, user)
+    return [("SELECT user, department, transaction_date, failure_type "
+             f"FROM {swipe_facts.FAILURE_TABLE} WHERE 1 = 1{where}", params)]
+
+
+def iter_rows(conn, queries, chunk_size=DEFAULT_CHUNK_SIZE):
+    """依次执行查询，每次从游标取出 chunk_size 行，产出行列表"""
+    for sql, params in queries:
+        cursor = conn.execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+
+def _display(kind, rows):
+    if kind == 'failures':
+        return [row[:3] + (FAILURE_TYPES.get(row[3], row[3]),) for row in rows]
+    return rows
+
+
+def csv_chunks(kind, chunks):
+    """把行列表编码为CSV响应块；带BOM，Excel直接打开时中文不乱码"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_HEADERS[kind])
+    yield ('\ufeff' + buffer.getvalue()).encode('utf-8')
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_display(kind, rows))
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_xlsx(kind, chunks, path, sheet_rows=XLSX_SHEET_ROWS):
+    """用只写模式把行写入xlsx文件，返回写入的数据行数"""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = None
+    written = 0
+    sheet_count = 0
+    for rows in chunks:
+        for row in _display(kind, rows):
+            if sheet is None or written % sheet_rows == 0:
+                sheet_count += 1
+                sheet = workbook.create_sheet(title=kind if sheet_count == 1 else f"{kind}_{sheet_count}")
+                sheet.append(EXPORT_HEADERS[kind])
+            sheet.append(row)
+            written += 1
+    if sheet is None:
+        workbook.create_sheet(title=kind).append(EXPORT_HEADERS[kind])
+    workbook.save(path)
+    return written
+
+
+def xlsx_chunks(kind, chunks):
+    """先把xlsx写入临时文件，再按块产出文件内容，结束或客户端断开时删除临时文件"""
+    handle, path = tempfile.mkstemp(suffix='.xlsx', prefix='export_')
+    os.close(handle)
+    try:
+        write_xlsx(kind, chunks, path)
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(SEND_BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+    finally:
+        os.unlink(path)
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+统一刷卡事实表
+所有区域的成功刷卡写入一张窄表 kbk_ic_swipe：整数用户id、部门id、区域代码(即jihao)、
+epoch秒时间戳和设备id；失败记录写入 kbk_ic_failure。用户/部门/设备名称保存在各自的维表中，
+维表同时由名单导入（status_update_server）和余额导入（balance_manager）登记。
+
+迁移分两步：
+1. backfill: 按id分批把三张旧计数表和失败记录表的历史记录复制到事实表，可以中断后继续，服务照常运行
+2. cutover: 在一个写事务中复制剩余记录，把旧表改名为 *_legacy，并以原表名创建兼容视图，
+   视图带 INSTEAD OF INSERT 触发器，仍按旧表名读写的程序不需要修改
+
+用法: python swipe_facts.py [--db ic_manager.db] {backfill,cutover,status}
+"""
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+from datetime import datetime
+
+import data_version
+
+logger = logging.getLogger(__name__)
+
+# 旧计数表与区域代码（与读卡器上报的jihao一致）
+AREA_CODES = {
+    'kbk_ic_cn_count': 1,
+    'kbk_ic_en_count': 2,
+    'kbk_ic_nm_count': 3,
+}
+AREA_TABLES = {code: table for table, code in AREA_CODES.items()}
+FAILURE_TABLE = 'kbk_ic_failure_records'
+# 需要回填和切换的旧表
+LEGACY_TABLES = list(AREA_CODES) + [FAILURE_TABLE]
+
+DEFAULT_CHUNK_SIZE = 50000
+
+FACT_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_user (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_department (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_device (
+        id INTEGER PRIMARY KEY,
+        dn TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_swipe (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER NOT NULL,
+        area INTEGER NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES kbk_ic_user(id),
+        department_id INTEGER NOT NULL REFERENCES kbk_ic_department(id),
+        device_id INTEGER REFERENCES kbk_ic_device(id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_kbk_ic_swipe_area_ts ON kbk_ic_swipe(area, ts, department_id, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_kbk_ic_swipe_dept_user_ts ON kbk_ic_swipe(department_id, user_id, ts)',
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_failure (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER NOT NULL,
+        failure_type INTEGER NOT NULL,
+        user_id INTEGER REFERENCES kbk_ic_user(id),
+        department_id INTEGER REFERENCES kbk_ic_department(id),
+        card TEXT,
+        jihao TEXT,
+        device_id INTEGER REFERENCES kbk_ic_device(id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_kbk_ic_failure_ts_type ON kbk_ic_failure(ts, failure_type, department_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_swipe_backfill (
+        source TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        copied INTEGER NOT NULL DEFAULT 0,
+        skipped INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP
+    )
+    '''
+]
+
+# 失败记录中用于定位终端和卡片的列，旧数据库中由 ensure_failure_columns 补齐
+FAILURE_DETAIL_COLUMNS = {
+    FAILURE_TABLE: [('card', 'TEXT'), ('dn', 'TEXT'), ('jihao', 'TEXT')],
+    'kbk_ic_failure': [('card', 'TEXT'), ('jihao', 'TEXT'), ('device_id', 'INTEGER REFERENCES kbk_ic_device(id)')],
+}
+
+# 旧表的transaction_date是本地时间字符串，'utc'修饰符把它换算成UTC后再取epoch秒
+LOCAL_TEXT_TO_EPOCH = "CAST(strftime('%s', {0}, 'utc') AS INTEGER)"
+EPOCH_TO_LOCAL_TEXT = "datetime({0}, 'unixepoch', 'localtime')"
+
+
+def ensure_fact_tables(conn):
+    """创建事实表、维表和回填进度表（已存在时不做任何事）"""
+    for statement in FACT_SCHEMA:
+        conn.execute(statement)
+    ensure_failure_columns(conn)
+    conn.commit()
+
+
+def _object_type(conn, name):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def ensure_failure_columns(conn):
+    """
+    为失败记录补齐卡号、设备号和机号列（已存在时不做任何事），由调用方提交
+    旧表和 *_legacy 表用 ALTER TABLE 加列；已切换为兼容视图时按新的列重建视图和触发器
+    """
+    for table, columns in ((FAILURE_TABLE, FAILURE_DETAIL_COLUMNS[FAILURE_TABLE]),
+                           (f"{FAILURE_TABLE}_legacy", FAILURE_DETAIL_COLUMNS[FAILURE_TABLE]),
+                           ('kbk_ic_failure', FAILURE_DETAIL_COLUMNS['kbk_ic_failure'])):
+        if _object_type(conn, table) != 'table':
+            continue
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    if _object_type(conn, FAILURE_TABLE) == 'view':
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({FAILURE_TABLE})")}
+        if 'card' not in existing:
+            conn.execute(f"DROP TRIGGER IF EXISTS {FAILURE_TABLE}_insert")
+            conn.execute(f"DROP VIEW {FAILURE_TABLE}")
+            for statement in compat_view_sql(FAILURE_TABLE):
+                conn.execute(statement)
+
+
+def facts_enabled(conn):
+    """旧计数表是否已经切换为事实表上的兼容视图"""
+    row = conn.execute(
+        f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'view' AND name IN ({','.join(['?'] * len(AREA_CODES))})",
+        list(AREA_CODES)
+    ).fetchone()
+    return row[0] == len(AREA_CODES)
+
+
+def failures_enabled(conn):
+    """失败记录表是否已经切换为 kbk_ic_failure 上的兼容视图"""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?", (FAILURE_TABLE,)).fetchone()
+    return row is not None
+
+
+def dimensions_available(conn):
+    """数据库中是否已有用户和部门维表"""
+    row = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('kbk_ic_user', 'kbk_ic_department')"
+    ).fetchone()
+    return row[0] == 2
+
+
+# 名单/余额导入时批量登记维表，已存在的名称保持原id
+REGISTER_USER_SQL = "INSERT OR IGNORE INTO kbk_ic_user (name) VALUES (?)"
+REGISTER_DEPARTMENT_SQL = "INSERT OR IGNORE INTO kbk_ic_department (name) VALUES (?)"
+
+
+def register_dimensions(cursor, users, departments):
+    """在调用方的事务中登记一批用户和部门名称，返回 (新增用户数, 新增部门数)"""
+    cursor.executemany(REGISTER_USER_SQL, [(name,) for name in set(users) if name])
+    added_users = cursor.rowcount
+    cursor.executemany(REGISTER_DEPARTMENT_SQL, [(name,) for name in set(departments) if name])
+    return added_users, cursor.rowcount
+
+
+def local_epoch(day):
+    """本地日期 (YYYY-MM-DD) 零点对应的epoch秒"""
+    return int(time.mktime(datetime.strptime(day, '%Y-%m-%d').timetuple()))
+
+
+def dimension_id(cursor, table, column, value):
+    """返回维表中 value 对应的id，不存在时插入"""
+    cursor.execute(f"INSERT INTO {table} ({column}) VALUES (?) ON CONFLICT ({column}) DO NOTHING", (value,))
+    return cursor.execute(f"SELECT id FROM {table} WHERE {column} = ?", (value,)).fetchone()[0]
+
+
+def record_swipe(cursor, area, user, department, dn=None, ts=None):
+    """
+    向事实表写入一次成功刷卡，调用方负责提交事务
+    area: 区域代码(jihao)；dn: 读卡器设备号；ts: epoch秒，默认当前时间
+    """
+    cursor.execute(
+        "INSERT INTO kbk_ic_swipe (ts, area, user_id, department_id, device_id) VALUES (?, ?, ?, ?, ?)",
+        (int(ts if ts is not None else time.time()), area,
+         dimension_id(cursor, 'kbk_ic_user', 'name', user),
+         dimension_id(cursor, 'kbk_ic_department', 'name', department),
+         dimension_id(cursor, 'kbk_ic_device', 'dn', dn) if dn else None)
+    )
+
+
+def record_failure(cursor, failure_type, user=None, department=None, card=None, dn=None, jihao=None, ts=None):
+    """
+    向 kbk_ic_failure 写入一次失败刷卡，调用方负责提交事务
+    failure_type: 1 卡片未激活，2 卡号不存在，3 不在用餐时间；卡号不存在时没有用户和部门，但仍记录卡号
+    """
+    cursor.execute(
+        "INSERT INTO kbk_ic_failure (ts, failure_type, user_id, department_id, card, jihao, device_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (int(ts if ts is not None else time.time()), failure_type,
+         dimension_id(cursor, 'kbk_ic_user', 'name', user) if user else None,
+         dimension_id(cursor, 'kbk_ic_department', 'name', department) if department else None,
+         card, jihao, dimension_id(cursor, 'kbk_ic_device', 'dn', dn) if dn else None)
+    )
+
+
+def usage_since_query(since_epoch):
+    """
+    每个 (user, department) 在 since_epoch 之后的刷卡次数，返回 (sql, params)
+    先按整数id分组再连回名称，区域条件让查询可以使用 (area, ts) 索引
+    """
+    codes = ', '.join(str(code) for code in AREA_TABLES)
+    return f'''
+        SELECT u.name AS user, d.name AS department, g.meals
+        FROM (
+            SELECT user_id, department_id, COUNT(*) AS meals FROM kbk_ic_swipe
+            WHERE area IN ({codes}) AND ts >= ?
+            GROUP BY user_id, department_id
+        ) g
+        JOIN kbk_ic_user u ON u.id = g.user_id
+        JOIN kbk_ic_department d ON d.id = g.department_id
+    ''', [since_epoch]
+
+
+def legacy_tables(conn):
+    """仍是普通表、需要回填的旧计数表和失败记录表"""
+    rows = conn.execute(
+        f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({','.join(['?'] * len(LEGACY_TABLES))})",
+        LEGACY_TABLES
+    ).fetchall()
+    present = {row[0] for row in rows}
+    return [table for table in LEGACY_TABLES if table in present]
+
+
+def _fact_insert_sql(table):
+    """把旧表一个id区间内的记录编码后插入事实表的语句，参数为 (last_id, upper_id)"""
+    ts = LOCAL_TEXT_TO_EPOCH.format('t.transaction_date')
+    if table == FAILURE_TABLE:
+        # 卡号不存在的失败记录没有用户和部门
+        return f'''
+            INSERT INTO kbk_ic_failure (ts, failure_type, user_id, department_id, card, jihao, device_id)
+            SELECT {ts}, t.failure_type, u.id, d.id, t.card, t.jihao, v.id
+            FROM {table} t
+            LEFT JOIN kbk_ic_user u ON u.name = t.user
+            LEFT JOIN kbk_ic_department d ON d.name = t.department
+            LEFT JOIN kbk_ic_device v ON v.dn = t.dn
+            WHERE t.id > ? AND t.id <= ? AND {ts} IS NOT NULL
+            ORDER BY t.id
+        '''
+    return f'''
+        INSERT INTO kbk_ic_swipe (ts, area, user_id, department_id)
+        SELECT {ts}, {AREA_CODES[table]}, u.id, d.id
+        FROM {table} t
+        JOIN kbk_ic_user u ON u.name = t.user
+        JOIN kbk_ic_department d ON d.name = t.department
+        WHERE t.id > ? AND t.id <= ? AND {ts} IS NOT NULL
+        ORDER BY t.id
+    '''
+
+
+def _copy_chunk(conn, table, chunk_size):
+    """在调用方的事务中复制高水位之后的一批记录，返回 (读取的行数, 复制的行数)"""
+    row = conn.execute("SELECT last_id FROM kbk_ic_swipe_backfill WHERE source = ?", (table,)).fetchone()
+    last_id = row[0] if row else 0
+    upper_id, rows = conn.execute(
+        f"SELECT MAX(id), COUNT(*) FROM (SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?)",
+        (last_id, chunk_size)
+    ).fetchone()
+    if not rows:
+        return 0, 0
+    conn.execute(f"INSERT OR IGNORE INTO kbk_ic_user (name) "
+                 f"SELECT DISTINCT user FROM {table} WHERE id > ? AND id <= ? AND user IS NOT NULL", (last_id, upper_id))
+    conn.execute(f"INSERT OR IGNORE INTO kbk_ic_department (name) "
+                 f"SELECT DISTINCT department FROM {table} WHERE id > ? AND id <= ? AND department IS NOT NULL",
+                 (last_id, upper_id))
+    if table == FAILURE_TABLE:
+        conn.execute(f"INSERT OR IGNORE INTO kbk_ic_device (dn) "
+                     f"SELECT DISTINCT dn FROM {table} WHERE id > ? AND id <= ? AND dn IS NOT NULL", (last_id, upper_id))
+    # 无法解析的时间无法换算成epoch秒，跳过并计数，原始记录保留在 *_legacy 表中
+    copied = conn.execute(_fact_insert_sql(table), (last_id, upper_id)).rowcount
+    conn.execute('''
+        INSERT INTO kbk_ic_swipe_backfill (source, last_id, copied, skipped, updated_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id, copied = copied + excluded.copied,
+            skipped = skipped + excluded.skipped, updated_at = excluded.updated_at
+    ''', (table, upper_id, copied, rows - copied, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    return rows, copied
+
+
+def backfill(conn, chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=None):
+    """
+    分批把旧计数表的记录复制到事实表，每批一个短写事务，返回 {表名: 本次复制的行数}
+    max_chunks: 每张表最多处理的批数，None表示复制到当前末尾
+    """
+    ensure_fact_tables(conn)
+    results = {}
+    for table in legacy_tables(conn):
+        copied_total = 0
+        chunks = 0
+        while max_chunks is None or chunks < max_chunks:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows, copied = _copy_chunk(conn, table, chunk_size)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            copied_total += copied
+            chunks += 1
+            if rows < chunk_size:
+                break
+        results[table] = copied_total
+        logger.info(f"{table} 本次回填 {copied_total} 行")
+    return results
+
+
+def compat_view_sql(table):
+    """旧表名上的兼容视图和插入触发器"""
+    if table == FAILURE_TABLE:
+        return [
+            f'''
+            CREATE VIEW {table} AS
+            SELECT f.id AS id, u.name AS user, d.name AS department,
+                   {EPOCH_TO_LOCAL_TEXT.format('f.ts')} AS transaction_date, f.failure_type AS failure_type,
+                   f.card AS card, v.dn AS dn, f.jihao AS jihao
+            FROM kbk_ic_failure f
+            LEFT JOIN kbk_ic_user u ON u.id = f.user_id
+            LEFT JOIN kbk_ic_department d ON d.id = f.department_id
+            LEFT JOIN kbk_ic_device v ON v.id = f.device_id
+            ''',
+            f'''
+            CREATE TRIGGER {table}_insert INSTEAD OF INSERT ON {table}
+            BEGIN
+                INSERT OR IGNORE INTO kbk_ic_user (name) SELECT NEW.user WHERE NEW.user IS NOT NULL;
+                INSERT OR IGNORE INTO kbk_ic_department (name) SELECT NEW.department WHERE NEW.department IS NOT NULL;
+                INSERT OR IGNORE INTO kbk_ic_device (dn) SELECT NEW.dn WHERE NEW.dn IS NOT NULL;
+                INSERT INTO kbk_ic_failure (ts, failure_type, user_id, department_id, card, jihao, device_id) VALUES (
+                    COALESCE({LOCAL_TEXT_TO_EPOCH.format('NEW.transaction_date')}, CAST(strftime('%s', 'now') AS INTEGER)),
+                    NEW.failure_type,
+                    (SELECT id FROM kbk_ic_user WHERE name = NEW.user),
+                    (SELECT id FROM kbk_ic_department WHERE name = NEW.department),
+                    NEW.card, NEW.jihao,
+                    (SELECT id FROM kbk_ic_device WHERE dn = NEW.dn)
+                );
+            END
+            '''
+        ]
+    code = AREA_CODES[table]
+    return [
+        f'''
+        CREATE VIEW {table} AS
+        SELECT s.id AS id, u.name AS user, d.name AS department,
+               {EPOCH_TO_LOCAL_TEXT.format('s.ts')} AS transaction_date
+        FROM kbk_ic_swipe s
+        JOIN kbk_ic_user u ON u.id = s.user_id
+        JOIN kbk_ic_department d ON d.id = s.department_id
+        WHERE s.area = {code}
+        ''',
+        f'''
+        CREATE TRIGGER {table}_insert INSTEAD OF INSERT ON {table}
+        BEGIN
+            INSERT OR IGNORE INTO kbk_ic_user (name) VALUES (NEW.user);
+            INSERT OR IGNORE INTO kbk_ic_department (name) VALUES (NEW.department);
+            INSERT INTO kbk_ic_swipe (ts, area, user_id, department_id) VALUES (
+                COALESCE({LOCAL_TEXT_TO_EPOCH.format('NEW.transaction_date')}, CAST(strftime('%s', 'now') AS INTEGER)),
+                {code},
+                (SELECT id FROM kbk_ic_user WHERE name = NEW.user),
+                (SELECT id FROM kbk_ic_department WHERE name = NEW.department)
+            );
+        END
+        '''
+    ]
+
+
+def cutover(conn, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    在一个写事务中完成剩余回填并切换到兼容视图，返回切换的旧表列表
+    旧表改名为 *_legacy 保留备查；汇总表按旧表id累计，切换后清空，由刷新任务从事实表重新汇总
+    """
+    ensure_fact_tables(conn)
+    tables = legacy_tables(conn)
+    if not tables:
+        return []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table in tables:
+            while _copy_chunk(conn, table, chunk_size)[0] == chunk_size:
+                pass
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+            for statement in compat_view_sql(table):
+                conn.execute(statement)
+        has_rollups = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'kbk_ic_count_rollup_state'"
+        ).fetchone()
+        if has_rollups and set(tables) & set(AREA_CODES):
+            conn.execute("DELETE FROM kbk_ic_count_rollup")
+            conn.execute("DELETE FROM kbk_ic_count_rollup_state")
+        if FAILURE_TABLE in tables and _object_type(conn, 'kbk_ic_failure_rollup_state') == 'table':
+            # 失败汇总同样按旧表id累计，切换后从 kbk_ic_failure 重新汇总
+            conn.execute("DELETE FROM kbk_ic_failure_rollup")
+            conn.execute("DELETE FROM kbk_ic_failure_rollup_state")
+        # 表结构改变，使管理界面的统计缓存失效
+        data_version.bump(conn, data_version.SWIPES_HISTORY, data_version.FAILURES)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(f"已切换到事实表，旧表改名为: {', '.join(table + '_legacy' for table in tables)}")
+    return tables
+
+
+def backfill_status(conn):
+    """返回每张旧表的回填进度 [(表名, 高水位id, 旧表最大id, 已复制, 已跳过)]"""
+    status = []
+    progress = {row[0]: row[1:] for row in conn.execute(
+        "SELECT source, last_id, copied, skipped FROM kbk_ic_swipe_backfill"
+    )}
+    remaining = legacy_tables(conn)
+    for table in LEGACY_TABLES:
+        last_id, copied, skipped = progress.get(table, (0, 0, 0))
+        source = table if table in remaining else f"{table}_legacy"
+        try:
+            max_id = conn.execute(f"SELECT MAX(id) FROM {source}").fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            max_id = 0
+        status.append((table, last_id, max_id, copied, skipped))
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='统一刷卡事实表回填与切换')
+    parser.add_argument('--db', default='ic_manager.db', help='数据库路径（默认ic_manager.db）')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f'每个事务复制的记录数（默认{DEFAULT_CHUNK_SIZE}）')
+    parser.add_argument('command', choices=['backfill', 'cutover', 'status'],
+                        help='backfill: 分批回填；cutover: 完成回填并切换为兼容视图；status: 查看进度')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = sqlite3.connect(args.db, timeout=30.0, isolation_level=None)
+    try:
+        if args.command == 'backfill':
+            start_time = time.perf_counter()
+            results = backfill(conn, args.chunk_size)
+            logger.info(f"回填完成: {results}，耗时 {time.perf_counter() - start_time:.1f}秒")
+        elif args.command == 'cutover':
+            tables = cutover(conn, args.chunk_size)
+            if not tables:
+                logger.info("旧计数表已经切换过，无需操作")
+        ensure_fact_tables(conn)
+        for table, last_id, max_id, copied, skipped in backfill_status(conn):
+            logger.info(f"{table}: 已回填到id {last_id}/{max_id}，复制 {copied} 行，跳过 {skipped} 行")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+刷卡统计汇总表
+按 (日期, 时段, 区域, 部门, 用户) 汇总三张计数表，后台任务从每张表的高水位id之后增量累加，
+统计查询对已关闭的日期读汇总表，只对当天和高水位之后的新记录扫描原始表。
+切换到统一刷卡事实表（见 swipe_facts.py）之后，原始记录直接从 kbk_ic_swipe 读取。
+汇总只跟随插入；原始表中的记录被修改或删除后，需要用 rebuild 重建（check 可以发现这种不一致）。
+
+用法: python swipe_rollup.py [--db ic_manager.db] {refresh,rebuild,check}
+"""
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+
+import swipe_facts
+import failure_stats
+
+logger = logging.getLogger(__name__)
+
+COUNT_TABLES = list(swipe_facts.AREA_CODES)
+
+# 统计时段 (名称, 开始, 结束)，均为闭区间，与 transaction_date 中 "HH:MM:SS" 部分按字符串比较
+TIME_SLOTS = [
+    ('morning', '05:25:00', '07:40:00'),
+    ('noon', '11:25:00', '12:40:00'),
+    ('evening', '16:55:00', '19:40:00'),
+]
+# 不在任何时段内（包括只有日期的记录）
+OTHER_SLOT = 'other'
+
+DEFAULT_BATCH_SIZE = 50000
+DEFAULT_INTERVAL = 60
+
+ROLLUP_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_count_rollup (
+        day TEXT NOT NULL,
+        slot TEXT NOT NULL,
+        area TEXT NOT NULL,
+        department TEXT NOT NULL,
+        user TEXT NOT NULL,
+        swipes INTEGER NOT NULL,
+        PRIMARY KEY (day, slot, area, department, user)
+    ) WITHOUT ROWID
+    ''',
+    # 只按部门/用户筛选（不限日期）时使用，主键以日期开头无法定位
+    'CREATE INDEX IF NOT EXISTS idx_kbk_ic_count_rollup_dept_user ON kbk_ic_count_rollup(area, department, user, day, slot, swipes)',
+    'CREATE INDEX IF NOT EXISTS idx_kbk_ic_count_rollup_user ON kbk_ic_count_rollup(area, user, day, slot, swipes)',
+    '''
+    CREATE TABLE IF NOT EXISTS kbk_ic_count_rollup_state (
+        area TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP
+    )
+    '''
+]
+
+
+def slot_case_sql(time_expr="substr(transaction_date, 12, 8)"):
+    """把 "HH:MM:SS" 时间表达式归入时段的SQL表达式"""
+    whens = " ".join(
+        f"WHEN {time_expr} BETWEEN '{slot_start}' AND '{slot_end}' THEN '{name}'"
+        for name, slot_start, slot_end in TIME_SLOTS
+    )
+    return f"CASE {whens} ELSE '{OTHER_SLOT}' END"
+
+
+class RawSource:
+    """
+    汇总和统计读取原始刷卡记录的SQL片段
+    切换到事实表之前读各区域的旧计数表，之后直接读 kbk_ic_swipe，避免经过兼容视图后日期条件无法走索引
+    """
+
+    def __init__(self, area, fact_mode=False):
+        self.area = area
+        if fact_mode:
+            self.base = f"kbk_ic_swipe s WHERE s.area = {swipe_facts.AREA_CODES[area]}"
+            self.joined = ("kbk_ic_swipe s JOIN kbk_ic_user u ON u.id = s.user_id "
+                           f"JOIN kbk_ic_department d ON d.id = s.department_id WHERE s.area = {swipe_facts.AREA_CODES[area]}")
+            # 只按id范围读取高水位之后的记录，不使用任何索引
+            self.tail = ("kbk_ic_swipe s NOT INDEXED JOIN kbk_ic_user u ON u.id = s.user_id "
+                         f"JOIN kbk_ic_department d ON d.id = s.department_id WHERE s.area = {swipe_facts.AREA_CODES[area]}")
+            # 按 (area, ts) 索引读取一段日期；CROSS JOIN 固定事实表为外层循环，不按部门×用户逐个探查
+            self.dated = ("kbk_ic_swipe s CROSS JOIN kbk_ic_user u ON u.id = s.user_id "
+                          f"CROSS JOIN kbk_ic_department d ON d.id = s.department_id WHERE s.area = {swipe_facts.AREA_CODES[area]}")
+            self.day = "date(s.ts, 'unixepoch', 'localtime')"
+            self.time = "time(s.ts, 'unixepoch', 'localtime')"
+            self.ts = "s.ts"
+            self.department = "d.name"
+            self.user = "u.name"
+            self.bound = swipe_facts.local_epoch
+        else:
+            self.base = f"{area} s WHERE 1 = 1"
+            self.joined = self.base
+            self.tail = f"{area} s NOT INDEXED WHERE 1 = 1"
+            self.dated = self.base
+            self.day = "substr(s.transaction_date, 1, 10)"
+            self.time = "substr(s.transaction_date, 12, 8)"
+            self.ts = "s.transaction_date"
+            self.department = "s.department"
+            self.user = "s.user"
+            self.bound = str
+
+
+def ensure_rollup_tables(conn):
+    """创建汇总表和高水位表（已存在时不做任何事）"""
+    for statement in ROLLUP_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def rollups_available(conn):
+    """数据库中是否已有汇总表"""
+    row = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+        "AND name IN ('kbk_ic_count_rollup', 'kbk_ic_count_rollup_state')"
+    ).fetchone()
+    return row[0] == 2
+
+
+def existing_count_tables(conn):
+    """返回数据库中实际存在的计数表（切换到事实表后为同名的兼容视图）"""
+    rows = conn.execute(
+        f"SELECT name FROM sqlite_master WHERE type IN ('table', 'view') "
+        f"AND name IN ({','.join(['?'] * len(COUNT_TABLES))})",
+        COUNT_TABLES
+    ).fetchall()
+    present = {row[0] for row in rows}
+    return [table for table in COUNT_TABLES if table in present]
+
+
+def refresh_area(conn, area, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    把一张计数表中高水位id之后的记录累加进汇总表，每批在一个写事务中同时推进高水位
+    返回本次汇总的原始记录数
+    """
+    source = RawSource(area, swipe_facts.facts_enabled(conn))
+    consumed = 0
+    while True:
+        # BEGIN IMMEDIATE 保证读取高水位和推进高水位之间没有其他进程插队
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT last_id FROM kbk_ic_count_rollup_state WHERE area = ?", (area,)
+            ).fetchone()
+            last_id = row[0] if row else 0
+            upper_id, rows = conn.execute(
+                f"SELECT MAX(id), COUNT(*) FROM (SELECT s.id FROM {source.base} AND s.id > ? ORDER BY s.id LIMIT ?)",
+                (last_id, batch_size)
+            ).fetchone()
+            if not rows:
+                conn.rollback()
+                return consumed
+            conn.execute(f'''
+                INSERT INTO kbk_ic_count_rollup (day, slot, area, department, user, swipes)
+                SELECT {source.day}, {slot_case_sql(source.time)}, ?, {source.department}, {source.user}, COUNT(*)
+                FROM {source.joined} AND s.id > ? AND s.id <= ?
+                GROUP BY 1, 2, 4, 5
+                ON CONFLICT (day, slot, area, department, user) DO UPDATE SET swipes = swipes + excluded.swipes
+            ''', (area, last_id, upper_id))
+            conn.execute('''
+                INSERT INTO kbk_ic_count_rollup_state (area, last_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (area) DO UPDATE SET last_id = excluded.last_id, updated_at = excluded.updated_at
+            ''', (area, upper_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        consumed += rows
+        if rows < batch_size:
+            return consumed
+
+
+def refresh_rollups(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """增量刷新所有计数表的汇总，返回 {表名: 新汇总的记录数}"""
+    return {area: refresh_area(conn, area, batch_size) for area in existing_count_tables(conn)}
+
+
+def rebuild_rollups(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """清空汇总表和高水位后从头重新汇总，返回 {表名: 汇总的记录数}"""
+    ensure_rollup_tables(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM kbk_ic_count_rollup")
+        conn.execute("DELETE FROM kbk_ic_count_rollup_state")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return refresh_rollups(conn, batch_size)
+
+
+def check_rollups(conn):
+    """
+    把汇总表与原始表中高水位以内的记录逐组比较
+    返回不一致的组列表，每项为 (area, day, slot, department, user, 汇总值, 原始值)，一致时为空列表
+    """
+    fact_mode = swipe_facts.facts_enabled(conn)
+    mismatches = []
+    for area in existing_count_tables(conn):
+        source = RawSource(area, fact_mode)
+        # 单条语句在同一个读快照内完成，刷新任务同时运行也不会造成误报
+        mismatches.extend(conn.execute(f'''
+            WITH raw AS (
+                SELECT {source.day} AS day, {slot_case_sql(source.time)} AS slot,
+                       {source.department} AS department, {source.user} AS user, COUNT(*) AS swipes
+                FROM {source.joined}
+                AND s.id <= COALESCE((SELECT last_id FROM kbk_ic_count_rollup_state WHERE area = :area), 0)
+                GROUP BY 1, 2, 3, 4
+            ),
+            rolled AS (
+                SELECT day, slot, department, user, swipes FROM kbk_ic_count_rollup WHERE area = :area
+            )
+            SELECT :area, COALESCE(rolled.day, raw.day), COALESCE(rolled.slot, raw.slot),
+                   COALESCE(rolled.department, raw.department), COALESCE(rolled.user, raw.user),
+                   COALESCE(rolled.swipes, 0), COALESCE(raw.swipes, 0)
+            FROM rolled FULL OUTER JOIN raw
+                ON rolled.day = raw.day AND rolled.slot = raw.slot
+                AND rolled.department = raw.department AND rolled.user = raw.user
+            WHERE rolled.swipes IS NOT raw.swipes
+        ''', {'area': area}).fetchall())
+    return mismatches
+
+
+def rollup_counts_query(table_names, start_day=None, end_day=None, department='', user='', open_day=None,
+                        fact_mode=False):
+    """
+    生成统计查询，返回 (sql, params)，结果每行为 (area, count, morning, noon, evening)
+    start_day 为包含的开始日期，end_day 为不包含的结束日期 (YYYY-MM-DD)；
+    open_day 之前的日期从汇总表读取，open_day 当天及以后的记录、以及高水位之后尚未汇总的记录扫描原始表；
+    fact_mode 为True时原始记录直接从事实表读取
+
+    原始表分为两个各自可以走索引的分支，避免对整个日期范围做范围扫描后再过滤：
+    - 高水位之后的记录: 按id（rowid）范围读取，其他条件不使用索引
+    - 高水位以内、open_day 及以后的记录: 按日期索引读取 [max(start_day, open_day), end_day)，
+      结束日期不晚于 open_day 的已关闭区间没有这个分支
+    """
+    open_day = open_day or datetime.now().strftime('%Y-%m-%d')
+    open_start = max(start_day or open_day, open_day)
+    slot_columns = ", ".join(f"COALESCE(SUM({name}), 0) AS {name}" for name, _, _ in TIME_SLOTS)
+    rolled_columns = ", ".join(f"SUM(CASE WHEN slot = '{name}' THEN swipes END) AS {name}" for name, _, _ in TIME_SLOTS)
+    high_water_mark = "COALESCE((SELECT last_id FROM kbk_ic_count_rollup_state WHERE area = ?), 0)"
+    selects = []
+    params = []
+    for table in table_names:
+        source = RawSource(table, fact_mode)
+        raw_columns = ", ".join(
+            f"COUNT(CASE WHEN {source.time} BETWEEN '{slot_start}' AND '{slot_end}' THEN 1 END)"
+            for _, slot_start, slot_end in TIME_SLOTS
+        )
+        # 不按部门/用户筛选时固定按日期主键读取汇总表，不依赖ANALYZE统计选择索引
+        rolled_conditions = ["area = ?" if department or user else "+area = ?", "day < ?"]
+        rolled_params = [table, open_day]
+        tail_conditions = [f"s.id > {high_water_mark}"]
+        tail_params = [table]
+        open_conditions = [f"+s.id <= {high_water_mark}", f"{source.ts} >= ?"]
+        open_params = [table, source.bound(open_start)]
+        if start_day:
+            rolled_conditions.append("day >= ?")
+            rolled_params.append(start_day)
+            tail_conditions.append(f"+{source.ts} >= ?")
+            tail_params.append(source.bound(start_day))
+        if end_day:
+            rolled_conditions.append("day < ?")
+            rolled_params.append(end_day)
+            tail_conditions.append(f"+{source.ts} < ?")
+            tail_params.append(source.bound(end_day))
+            open_conditions.append(f"{source.ts} < ?")
+            open_params.append(source.bound(end_day))
+        for column, raw_column, value in (('department', source.department, department), ('user', source.user, user)):
+            if value:
+                rolled_conditions.append(f"{column} = ?")
+                rolled_params.append(value)
+                # 部门/用户条件不走索引，原始表只按id或日期范围读取
+                tail_conditions.append(f"+{raw_column} = ?")
+                tail_params.append(value)
+                open_conditions.append(f"+{raw_column} = ?")
+                open_params.append(value)
+        # 每个分支各自聚合为一行，外层只合并两三行
+        branches = [
+            f"SELECT SUM(swipes) AS swipes, {rolled_columns} FROM kbk_ic_count_rollup "
+            f"WHERE {' AND '.join(rolled_conditions)}",
+            f"SELECT COUNT(*), {raw_columns} FROM {source.tail} AND {' AND '.join(tail_conditions)}",
+        ]
+        params.extend(rolled_params + tail_params)
+        if end_day is None or end_day > open_day:
+            branches.append(f"SELECT COUNT(*), {raw_columns} FROM {source.dated} AND {' AND '.join(open_conditions)}")
+            params.extend(open_params)
+        union = "\n                UNION ALL\n                ".join(branches)
+        selects.append(f'''
+            SELECT '{table}' AS area, COALESCE(SUM(swipes), 0) AS count, {slot_columns}
+            FROM (
+                {union}
+            )
+        ''')
+    return " UNION ALL ".join(selects), params
+
+
+class RollupRefresher:
+    """后台线程，定期增量刷新汇总表"""
+
+    def __init__(self, db_path, interval=DEFAULT_INTERVAL, batch_size=DEFAULT_BATCH_SIZE):
+        self.db_path = db_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        try:
+            ensure_rollup_tables(conn)
+            start_time = time.perf_counter()
+            consumed = refresh_rollups(conn, self.batch_size)
+            # 失败记录汇总（/api/failures/top）由同一个任务维护
+            failure_stats.ensure_failure_rollup_tables(conn)
+            consumed['failures'] = failure_stats.refresh_failures(conn, self.batch_size)
+            if any(consumed.values()):
+                logger.info(f"汇总表已刷新: {consumed}，耗时 {time.perf_counter() - start_time:.3f}秒")
+            return consumed
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except sqlite3.Error as e:
+                logger.error(f"刷新汇总表失败: {str(e)}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="swipe-rollup", daemon=True)
+        self._thread.start()
+        logger.info(f"汇总表刷新任务已启动，间隔 {self.interval} 秒")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='刷卡统计汇总表维护')
+    parser.add_argument('--db', default='ic_manager.db', help='数据库路径（默认ic_manager.db）')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'每个事务汇总的原始记录数（默认{DEFAULT_BATCH_SIZE}）')
+    parser.add_argument('command', choices=['refresh', 'rebuild', 'check'],
+                        help='refresh: 增量刷新；rebuild: 清空后重建；check: 与原始表比对')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = sqlite3.connect(args.db, timeout=30.0, isolation_level=None)
+    try:
+        if args.command == 'check':
+            if not rollups_available(conn):
+                logger.error("数据库中没有汇总表，请先运行 rebuild")
+                return 1
+            mismatches = check_rollups(conn)
+            for area, day, slot, department, user, rolled, raw in mismatches:
+                logger.warning(f"不一致: {area} {day} {slot} {department} {user} 汇总={rolled} 原始={raw}")
+            logger.info(f"检查完成，不一致的组: {len(mismatches)}")
+            return 1 if mismatches else 0
+        start_time = time.perf_counter()
+        if args.command == 'rebuild':
+            consumed = rebuild_rollups(conn, args.batch_size)
+        else:
+            ensure_rollup_tables(conn)
+            consumed = refresh_rollups(conn, args.batch_size)
+        logger.info(f"{args.command} 完成: {consumed}，耗时 {time.perf_counter() - start_time:.3f}秒")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
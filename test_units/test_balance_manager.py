@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+余额管理测试单元
+测试余额检查的集合语句和各步骤计数
+"""
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import prometheus_client as prom
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import balance_manager
+from balance_manager import BalanceManager
+
+
+class TestBalanceManager(unittest.TestCase):
+    """余额管理测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, "test_ic_manager.db")
+        self.original_db_path = balance_manager.DB_PATH
+        balance_manager.DB_PATH = self.db_path
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+        CREATE TABLE kbk_ic_manager (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            card TEXT NOT NULL UNIQUE,
+            department TEXT NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0,
+            last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''')
+        conn.commit()
+        conn.close()
+
+        self.manager = BalanceManager(excel_folder=os.path.join(self.temp_dir, "excel_balance"))
+
+    def tearDown(self):
+        """测试后清理工作"""
+        self.manager.cleanup()
+        balance_manager.DB_PATH = self.original_db_path
+        shutil.rmtree(self.temp_dir)
+
+    def seed(self, managers, balances):
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany(
+            "INSERT INTO kbk_ic_manager (user, card, department, status) VALUES (?, ?, ?, ?)", managers
+        )
+        conn.executemany(
+            "INSERT INTO kbk_ic_balance (user, department, balance) VALUES (?, ?, ?)", balances
+        )
+        conn.commit()
+        conn.close()
+
+    def statuses(self):
+        conn = sqlite3.connect(self.db_path)
+        rows = dict(((user, dept), status) for user, dept, status in
+                    conn.execute("SELECT user, department, status FROM kbk_ic_manager"))
+        conn.close()
+        return rows
+
+    def test_tick_joins_on_user_and_department(self):
+        """测试余额检查按 (user, department) 配对，不会误伤同名用户的其他部门"""
+        self.seed(
+            [("u1", "c1", "A", 1), ("u1", "c2", "B", 0), ("u2", "c3", "B", 1), ("u3", "c4", "A", 0)],
+            [("u1", "A", 0), ("u1", "B", 3), ("u2", "B", 1), ("u3", "A", 2), ("ghost", "A", 5)]
+        )
+
+        counts = self.manager.process_balance_check("a")
+
+        self.assertEqual(counts, {
+            "positive": 4, "matched": 3, "missing": 1,
+            "activated": 3, "decremented": 4, "zeroed": 2
+        })
+        # u1/A原本余额为0、u2/B本次递减为0，都被置为0；u1/B和u3/A仍有余额，保持激活
+        self.assertEqual(self.statuses(), {
+            ("u1", "A"): 0, ("u1", "B"): 1, ("u2", "B"): 0, ("u3", "A"): 1
+        })
+
+    def test_tick_without_positive_balance(self):
+        """测试没有余额大于0的记录时不做任何修改"""
+        self.seed([("u1", "c1", "A", 1)], [("u1", "A", 0)])
+
+        counts = self.manager.process_balance_check("b")
+
+        self.assertEqual(counts["positive"], 0)
+        self.assertEqual(self.statuses(), {("u1", "A"): 1})
+
+    def test_upsert_import(self):
+        """测试UPSERT导入：已存在的 (user, department) 被更新，新的被插入"""
+        self.assertTrue(self.manager.upsert_supported)
+        self.seed([], [("u1", "A", 9), ("u1", "B", 4)])
+        file_path = os.path.join(self.temp_dir, "2025-05-20.xlsx")
+        pd.DataFrame({
+            "user": ["u1", "u2", "u3", None],
+            "department": ["A", "A", "B", "B"],
+            "balance": [2, None, 5, 1]
+        }).to_excel(file_path, index=False)
+
+        self.manager.import_excel_to_db(file_path)
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT user, department, balance FROM kbk_ic_balance ORDER BY user, department").fetchall()
+        conn.close()
+        self.assertEqual(rows, [("u1", "A", 2), ("u1", "B", 4), ("u2", "A", 0), ("u3", "B", 5)])
+        self.assertEqual(self.manager.health_status["status"], "healthy")
+
+    def test_incremental_import(self):
+        """测试增量导入只写入变化，重复上传相同文件直接跳过"""
+        first = os.path.join(self.temp_dir, "2025-05-20.xlsx")
+        second = os.path.join(self.temp_dir, "2025-05-21.xlsx")
+        pd.DataFrame({"user": ["u1", "u2", "u3"], "department": ["A", "A", "B"], "balance": [3, 4, 5]}).to_excel(first, index=False)
+        pd.DataFrame({"user": ["u1", "u2", "u4"], "department": ["A", "A", "B"], "balance": [3, 6, 1]}).to_excel(second, index=False)
+
+        self.assertEqual(self.manager.import_excel_to_db(first)["added"], 3)
+        # 模拟余额检查扣减了u1的余额，未变化的行不应被重新写入
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE kbk_ic_balance SET balance = 2 WHERE user = 'u1'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.manager.import_excel_to_db(first)["mode"], "skipped")
+
+        self.manager.delete_missing = True
+        summary = self.manager.import_excel_to_db(second)
+        self.assertEqual(
+            {key: summary[key] for key in ("added", "changed", "unchanged", "removed", "deleted")},
+            {"added": 1, "changed": 1, "unchanged": 1, "removed": 1, "deleted": 1}
+        )
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT user, department, balance FROM kbk_ic_balance ORDER BY user").fetchall()
+        history = conn.execute("SELECT mode FROM kbk_ic_balance_import_history ORDER BY id").fetchall()
+        conn.close()
+        self.assertEqual(rows, [("u1", "A", 2), ("u2", "A", 6), ("u4", "B", 1)])
+        self.assertEqual(history, [("incremental",), ("skipped",), ("incremental",)])
+
+    def test_import_validation_quarantines_bad_rows(self):
+        """测试导入校验：规范化空白和全角，问题行写入报告而不影响其余行，被拒绝的行不会被当作已移除"""
+        self.seed([("u1", "c1", "A", 0), ("u2", "c2", "A", 0), ("u3", "c3", "B", 0), ("u4", "c4", "B", 0)],
+                  [("u4", "B", 7)])
+        self.manager.delete_missing = True
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO kbk_ic_balance_snapshot (user, department, balance) VALUES ('u4', 'B', 7)")
+        conn.commit()
+        conn.close()
+        file_path = os.path.join(self.temp_dir, "2025-05-20.xlsx")
+        pd.DataFrame({
+            "user": [" u1 ", "ｕ２", "u3", "u3", "u4", "ghost", "u1", None],
+            "department": ["A", "A", "B", "B", "B", "A", "C", "A"],
+            "balance": [3, "５", 2, 4, "abc", 1, 2.5, 1]
+        }).to_excel(file_path, index=False)
+
+        summary = self.manager.import_excel_to_db(file_path)
+
+        self.assertEqual((summary["added"], summary["rejected"], summary["warnings"], summary["deleted"]), (3, 5, 1, 0))
+        report = pd.read_csv(summary["report"], encoding='utf-8-sig')
+        self.assertEqual(list(zip(report["row"], report["reason"], report["action"])), [
+            (4, "重复的用户行且余额不一致", "rejected"),
+            (5, "重复的用户行且余额不一致", "rejected"),
+            (6, "余额不是数字", "rejected"),
+            (7, "kbk_ic_manager中不存在该用户", "warning"),
+            (8, "余额不是整数", "rejected"),
+            (9, "用户或部门为空", "rejected"),
+        ])
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT user, department, balance FROM kbk_ic_balance ORDER BY user").fetchall()
+        conn.close()
+        # u4的行被拒绝，原余额保留；ghost只是提示，照常导入
+        self.assertEqual(rows, [("ghost", "A", 1), ("u1", "A", 3), ("u2", "A", 5), ("u4", "B", 7)])
+
+    def test_ledger_matches_materialized_balance(self):
+        """测试导入、余额检查和手工调整都记入流水，且与物化余额一致"""
+        self.seed([("u1", "c1", "A", 0), ("u2", "c2", "A", 0)], [])
+        file_path = os.path.join(self.temp_dir, "2025-05-20.xlsx")
+        pd.DataFrame({"user": ["u1", "u2"], "department": ["A", "A"], "balance": [2, 1]}).to_excel(file_path, index=False)
+
+        self.manager.import_excel_to_db(file_path)
+        self.manager.process_balance_check("a")
+        self.manager.process_balance_check("b")
+        self.assertEqual(self.manager.adjust_balance("u2", "A", 3, "补发"), 3)
+        with self.assertRaises(ValueError):
+            self.manager.adjust_balance("u1", "A", -1)
+
+        self.assertEqual(self.manager.check_ledger_consistency(), [])
+        summary = self.manager.ledger_summary("A", "2000-01-01", "2100-01-01")
+        self.assertEqual((summary["count"], summary["amount"]), (3, -3))
+        user_summary = self.manager.ledger_summary("A", "2000-01-01", "2100-01-01", user="u1")
+        self.assertEqual(user_summary["count"], 2)
+
+    def test_batch_lookup_cache_and_etag(self):
+        """测试批量查询、缓存失效和ETag"""
+        from balance_manager import BalanceManagerServer
+        self.seed([], [("u1", "A", 3), ("u1", "B", 1), ("u2", "A", 0)])
+        client = BalanceManagerServer(self.manager).app.test_client()
+
+        body = {"items": [{"user": "u1", "department": "A"}, {"user": "u1"}, {"user": "nobody", "department": "A"}]}
+        response = client.post('/api/balance/batch', json=body)
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()["results"]
+        self.assertEqual(results[0]["balance"], 3)
+        self.assertEqual(sorted((b["department"], b["balance"]) for b in results[1]["balances"]), [("A", 3), ("B", 1)])
+        self.assertFalse(results[2]["found"])
+
+        # 数据未变化时同一请求返回304，且命中缓存
+        etag = response.headers["ETag"]
+        misses = self.manager.balance_cache.misses
+        self.assertEqual(client.post('/api/balance/batch', json=body, headers={"If-None-Match": etag}).status_code, 304)
+        self.assertEqual(client.get('/api/balance?user=u1&department=A').get_json()["balance"], 3)
+        self.assertEqual(self.manager.balance_cache.misses, misses)
+
+        # 布尔值不是整数调整量
+        self.assertEqual(client.post('/api/balance/adjust', json={"user": "u1", "department": "A",
+                                                                  "amount": True}).status_code, 400)
+
+        # 调整余额后缓存和ETag失效
+        self.manager.adjust_balance("u1", "A", 2)
+        response = client.post('/api/balance/batch', json=body, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["results"][0]["balance"], 5)
+
+    def test_lookup_racing_import_is_not_cached(self):
+        """测试查询期间导入/调整余额并使缓存失效时，查询读到的旧值不会以新版本写入缓存"""
+        self.seed([], [("u1", "A", 3)])
+        store = self.manager.store_balance_lookups
+
+        def store_after_import(*args):
+            # 模拟查询已读到旧值、尚未写入缓存时，另一线程导入了新余额
+            self.manager.store_balance_lookups = store
+            self.manager.adjust_balance("u1", "A", 2)
+            store(*args)
+
+        self.manager.store_balance_lookups = store_after_import
+        etag = self.manager.balance_etag()
+        self.assertEqual(self.manager.lookup_balances([("u1", "A")])[("u1", "A")], 3)
+        self.assertNotEqual(self.manager.balance_etag(), etag)
+        self.assertEqual(self.manager.lookup_balances([("u1", "A")])[("u1", "A")], 5)
+
+    def test_low_balance_forecast(self):
+        """测试按最近刷卡次数预测用完日期，并统计N天内用完的用户"""
+        from datetime import date
+        from balance_manager import BalanceManagerServer
+        self.seed([], [("u1", "A", 2), ("u2", "A", 30), ("u3", "B", 5), ("u4", "B", 0)])
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+        CREATE TABLE kbk_ic_cn_count (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            department TEXT NOT NULL,
+            transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''')
+        # 最近14天：u1每天1次，u2每天1次，u3没有消耗；窗口之外的记录不计入
+        swipes = [(user, "A", f"2025-05-{day:02d} 12:00:00") for user in ("u1", "u2") for day in range(6, 20)]
+        swipes += [("u3", "B", "2025-04-01 12:00:00")]
+        conn.executemany("INSERT INTO kbk_ic_cn_count (user, department, transaction_date) VALUES (?, ?, ?)", swipes)
+        conn.commit()
+        conn.close()
+
+        summary = self.manager.refresh_balance_forecast(today=date(2025, 5, 20))
+
+        self.assertEqual((summary["total"], summary["low"]), (4, 1))
+        self.assertEqual(prom.REGISTRY.get_sample_value('balance_low_users', {'days': '3'}), 1)
+        users = self.manager.low_balance_users()
+        self.assertEqual([(u["user"], u["days_left"], u["exhaust_date"]) for u in users], [("u1", 2.0, "2025-05-22")])
+        self.assertEqual(len(self.manager.low_balance_users(days=30)), 2)
+
+        client = BalanceManagerServer(self.manager).app.test_client()
+        response = client.get('/api/balance/low?days=30&department=B')
+        self.assertEqual(response.get_json()["count"], 0)
+        self.assertIn(b'balance_low_users', client.get('/metrics').data)
+
+    def test_tick_runs_once_and_replays_missed(self):
+        """测试同一 (日期, 时间点) 只扣减一次，重启后按顺序补跑错过的时间点"""
+        from datetime import datetime
+        self.seed([("u1", "c1", "A", 0)], [("u1", "A", 10)])
+
+        self.assertEqual(self.manager.process_balance_check("b", run_date="2025-05-19")["decremented"], 1)
+        self.assertTrue(self.manager.process_balance_check("b", run_date="2025-05-19")["skipped"])
+
+        # 5月19日b之后停机，5月20日12:00启动：补跑19日c、20日a、20日b
+        replayed = self.manager.replay_missed_ticks(now=datetime(2025, 5, 20, 12, 0))
+        self.assertEqual(replayed, [("2025-05-19", "c"), ("2025-05-20", "a"), ("2025-05-20", "b")])
+        self.assertEqual(self.manager.replay_missed_ticks(now=datetime(2025, 5, 20, 12, 0)), [])
+        self.assertEqual(self.manager.lookup_balances([("u1", "A")])[("u1", "A")], 6)
+
+        # 补跑的用餐流水记在原时间点上
+        conn = sqlite3.connect(self.db_path)
+        replayed_at = [row[0] for row in conn.execute(
+            "SELECT created_at FROM kbk_ic_balance_ledger WHERE entry_type = 'meal' ORDER BY id")][1:]
+        conn.close()
+        self.assertEqual(replayed_at, ["2025-05-19 16:55:00", "2025-05-20 05:25:00", "2025-05-20 11:25:00"])
+        self.assertEqual(self.manager.ledger_summary("A", "2025-05-20", "2025-05-21")["count"], 2)
+
+        runs = self.manager.tick_runs(start="2025-05-20")
+        self.assertEqual([(run["time_point"], run["source"]) for run in runs], [("a", "replay"), ("b", "replay")])
+        self.assertEqual(runs[0]["counts"]["decremented"], 1)
+
+    def test_async_server_routes(self):
+        """测试异步运行方式提供相同路径的接口，查询走连接池，写操作走写线程"""
+        import asyncio
+        from aiohttp.test_utils import TestServer, TestClient
+        from balance_async_server import AsyncBalanceServer
+        self.seed([("u1", "c1", "A", 0)], [("u1", "A", 3), ("u1", "B", 1)])
+
+        async def scenario():
+            server = AsyncBalanceServer(self.manager, poll_interval=0.1)
+            async with TestClient(TestServer(server.app)) as client:
+                response = await client.get('/api/balance', params={"user": "u1", "department": "A"})
+                self.assertEqual((await response.json())["balance"], 3)
+                etag = response.headers["ETag"]
+                response = await client.get('/api/balance', params={"user": "u1", "department": "A"},
+                                            headers={"If-None-Match": etag})
+                self.assertEqual(response.status, 304)
+
+                response = await client.post('/api/balance/adjust', json={"user": "u1", "department": "A", "amount": -5})
+                self.assertEqual(response.status, 400)
+                # JSON的true在Python中是int的子类，不能当作1
+                response = await client.post('/api/balance/adjust', json={"user": "u1", "department": "A", "amount": True})
+                self.assertEqual(response.status, 400)
+                response = await client.post('/api/balance/adjust', json={"user": "u1", "department": "A", "amount": 2})
+                self.assertEqual((await response.json())["balance"], 5)
+
+                response = await client.post('/api/balance/batch', json={"users": ["u1"]})
+                balances = (await response.json())["results"][0]["balances"]
+                self.assertEqual(sorted((b["department"], b["balance"]) for b in balances), [("A", 5), ("B", 1)])
+
+                response = await client.get('/api/ledger/summary', params={"department": "A", "start": "2000-01-01",
+                                                                           "end": "2100-01-01", "type": "adjust"})
+                self.assertEqual((await response.json())["amount"], 2)
+                self.assertEqual((await client.get('/api/check-balance?time_point=x')).status, 400)
+                self.assertEqual((await (await client.get('/api/ticks')).json())["count"], 0)
+                self.assertEqual((await client.get('/api/balance/low')).status, 200)
+                self.assertEqual(response.headers["Access-Control-Allow-Origin"], "*")
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
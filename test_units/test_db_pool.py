@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+连接池测试单元
+测试AiosqlitePool的连接数上限、事务提交与异常回滚、写事务串行化、排队的写操作不占用读连接以及每个事务各自的耗时
+"""
+import unittest
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+from db_pool import AiosqlitePool
+
+
+class TestAiosqlitePool(unittest.TestCase):
+    """aiosqlite连接池测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, "test_pool.db")
+
+    def tearDown(self):
+        """测试后清理工作"""
+        shutil.rmtree(self.temp_dir)
+
+    def run_with_pool(self, scenario, max_size=2):
+        """在新的事件循环中创建连接池并执行 scenario(pool)，结束后关闭连接池"""
+        async def main():
+            pool = AiosqlitePool(self.db_path, max_size=max_size)
+            try:
+                async with pool.transaction() as conn:
+                    await conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, value TEXT)")
+                return await scenario(pool)
+            finally:
+                await pool.close()
+        return asyncio.run(main())
+
+    def test_size_bound(self):
+        """测试连接数不超过上限，连接都被借出时等待归还"""
+        async def scenario(pool):
+            active = 0
+            peak = 0
+
+            async def borrow():
+                nonlocal active, peak
+                async with pool.acquire() as conn:
+                    active += 1
+                    peak = max(peak, active)
+                    await conn.execute("SELECT 1")
+                    await asyncio.sleep(0.01)
+                    active -= 1
+
+            await asyncio.gather(*(borrow() for _ in range(6)))
+            return peak, pool.size, pool.idle
+
+        self.assertEqual(self.run_with_pool(scenario), (2, 2, 2))
+
+    def test_commit_and_rollback(self):
+        """测试正常退出时提交，异常时回滚并抛出异常，连接归还连接池"""
+        async def scenario(pool):
+            async with pool.transaction() as conn:
+                await conn.execute("INSERT INTO t (value) VALUES ('kept')")
+            with self.assertRaises(ValueError):
+                async with pool.transaction() as conn:
+                    await conn.execute("INSERT INTO t (value) VALUES ('dropped')")
+                    raise ValueError("中断事务")
+            async with pool.acquire() as conn:
+                async with conn.execute("SELECT value FROM t") as cursor:
+                    rows = [tuple(row) for row in await cursor.fetchall()]
+            return rows, pool.idle
+
+        rows, idle = self.run_with_pool(scenario)
+        self.assertEqual(rows, [("kept",)])
+        self.assertEqual(idle, 1)
+
+    def test_writes_are_serialized(self):
+        """测试同一时刻只有一个写事务持有写锁"""
+        async def scenario(pool):
+            inside = 0
+            overlaps = 0
+
+            async def write(i):
+                nonlocal inside, overlaps
+                async with pool.transaction() as conn:
+                    inside += 1
+                    overlaps += inside > 1
+                    await conn.execute("INSERT INTO t (value) VALUES (?)", (str(i),))
+                    await asyncio.sleep(0.01)
+                    inside -= 1
+
+            await asyncio.gather(*(write(i) for i in range(5)))
+            async with pool.acquire() as conn:
+                async with conn.execute("SELECT COUNT(*) FROM t") as cursor:
+                    count = (await cursor.fetchone())[0]
+            return overlaps, count
+
+        self.assertEqual(self.run_with_pool(scenario, max_size=3), (0, 5))
+
+    def test_queued_writes_leave_connections_for_reads(self):
+        """测试等待写锁的写操作不占用连接，读操作不必等排队的写事务依次完成"""
+        async def scenario(pool):
+            release = asyncio.Event()
+
+            async def slow_write():
+                async with pool.transaction() as conn:
+                    await conn.execute("INSERT INTO t (value) VALUES ('slow')")
+                    await release.wait()
+
+            async def queued_write():
+                async with pool.transaction() as conn:
+                    await conn.execute("INSERT INTO t (value) VALUES ('queued')")
+
+            writers = [asyncio.ensure_future(slow_write())]
+            await asyncio.sleep(0.01)
+            writers += [asyncio.ensure_future(queued_write()) for _ in range(3)]
+            await asyncio.sleep(0.01)
+
+            async def read():
+                async with pool.acquire() as conn:
+                    await conn.execute("SELECT 1")
+
+            try:
+                await asyncio.wait_for(read(), timeout=1)
+            finally:
+                release.set()
+                await asyncio.gather(*writers)
+
+        self.run_with_pool(scenario)
+
+    def test_timings_are_per_transaction(self):
+        """测试并发的事务各自得到本次事务的提交和持有写锁耗时，回滚的事务没有提交耗时"""
+        async def scenario(pool):
+            slow, fast, failed = {}, {}, {}
+
+            async def write(timings, seconds):
+                async with pool.transaction(timings) as conn:
+                    await conn.execute("INSERT INTO t (value) VALUES ('x')")
+                    await asyncio.sleep(seconds)
+
+            await asyncio.gather(write(slow, 0.2), write(fast, 0))
+            with self.assertRaises(ValueError):
+                async with pool.transaction(failed):
+                    raise ValueError("中断事务")
+            return slow, fast, failed
+
+        slow, fast, failed = self.run_with_pool(scenario)
+        self.assertGreaterEqual(slow['write_lock'], 0.2)
+        self.assertLess(fast['write_lock'], 0.2)
+        self.assertIn('commit', fast)
+        self.assertNotIn('commit', failed)
+        self.assertIn('write_lock', failed)
+
+
+if __name__ == "__main__":
+    unittest.main()
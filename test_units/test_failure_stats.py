@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+失败刷卡汇总测试单元
+测试失败记录写入卡号/设备号/机号、增量汇总加未汇总原始记录与直接扫描一致、切换事实表后重新汇总，以及 /api/failures/top
+"""
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import failure_stats
+import http_reader
+import manager_server
+import swipe_facts
+
+
+class TestFailureStats(unittest.TestCase):
+    """失败刷卡汇总测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, "test_ic_manager.db")
+        self.conn = sqlite3.connect(self.db_path, isolation_level=None)
+        # 旧版本的失败记录表没有卡号和设备列，启动时补齐
+        self.conn.execute('''
+        CREATE TABLE kbk_ic_failure_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT,
+            department TEXT,
+            transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            failure_type INTEGER NOT NULL
+        )''')
+        swipe_facts.ensure_failure_columns(self.conn)
+        self.record_failures([(2, "C9", 1, "D1"), (2, "C9", 1, "D1"), (2, "C9", 1, "D1"),
+                              (1, "C1", 1, "D1", "张三", "财务部"), (1, "C1", 1, "D1", "张三", "财务部"),
+                              (3, "C1", 2, None, "张三", "财务部")])
+
+    def tearDown(self):
+        """测试后清理工作"""
+        self.conn.close()
+        shutil.rmtree(self.temp_dir)
+
+    def record_failures(self, records):
+        cursor = self.conn.cursor()
+        for failure_type, card, jihao, dn, *owner in records:
+            http_reader.insert_failure_record(cursor, failure_type, card, jihao, dn, *owner)
+
+    def top(self, dimension, use_rollup=True, **kwargs):
+        start, _ = failure_stats.window_bounds(hours=24)
+        sql, params = failure_stats.top_failures_query(dimension, start, fact_mode=swipe_facts.failures_enabled(self.conn),
+                                                       use_rollup=use_rollup, **kwargs)
+        return self.conn.execute(sql, params).fetchall()
+
+    def test_rollup_plus_tail_matches_raw_scan(self):
+        """测试卡号不存在的记录也保存卡号，汇总后新写入的记录从原始表补上，切换事实表后重新汇总结果不变"""
+        self.assertEqual(self.conn.execute(
+            "SELECT card, dn, jihao FROM kbk_ic_failure_records WHERE failure_type = 2"
+        ).fetchall(), [("C9", "D1", "1")] * 3)
+        failure_stats.ensure_failure_rollup_tables(self.conn)
+        self.assertEqual(failure_stats.refresh_failures(self.conn, batch_size=4), 6)
+        self.record_failures([(2, "C8", 2, None), (3, "C1", 2, None, "张三", "财务部")])
+
+        self.assertEqual(self.top('card'), [("C1", 4, 2, 0, 2), ("C9", 3, 0, 3, 0), ("C8", 1, 0, 1, 0)])
+        self.assertEqual(self.top('device'), [("D1", 5, 2, 3, 0), ("jihao:2", 3, 0, 1, 2)])
+        self.assertEqual(self.top('user'), [("张三", 4, 2, 0, 2)])
+        self.assertEqual(self.top('card', failure_type=2, limit=1), [("C9", 3, 0, 3, 0)])
+        for dimension in failure_stats.DIMENSIONS:
+            self.assertEqual(self.top(dimension), self.top(dimension, use_rollup=False))
+
+        # 切换到事实表后清空汇总，从 kbk_ic_failure 重新汇总
+        swipe_facts.ensure_fact_tables(self.conn)
+        # 列已由代码补齐后再执行迁移脚本也不会失败
+        migration = Path(__file__).parent.parent / "db" / "migration" / "V13__Add_kbk_ic_failure_rollup.sql"
+        self.conn.executescript(migration.read_text(encoding='utf-8'))
+        swipe_facts.cutover(self.conn)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM kbk_ic_failure_rollup").fetchone()[0], 0)
+        self.record_failures([(2, "C8", 1, "D1")])
+        self.assertEqual(failure_stats.refresh_failures(self.conn), 9)
+        self.assertEqual(self.top('device'), [("D1", 6, 2, 4, 0), ("jihao:2", 3, 0, 1, 2)])
+        self.assertEqual(self.top('card'), self.top('card', use_rollup=False))
+
+    def test_top_failures_endpoint(self):
+        """测试 /api/failures/top 按维度返回失败最多的键，新的失败记录在缓存TTL到期后可见"""
+        original_db_path = manager_server.DB_PATH
+        manager_server.DB_PATH = self.db_path
+        try:
+            client = manager_server.app.test_client()
+            response = client.get('/api/failures/top?dimension=device&hours=2')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([(row['key'], row['failures'], row['unknown_card']) for row in response.get_json()['top']],
+                             [("D1", 5, 3), ("jihao:2", 1, 0)])
+
+            self.conn.execute("CREATE TABLE kbk_ic_data_version (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+            self.record_failures([(2, "C8", 2, None), (2, "C8", 2, None)])
+            # TTL内新的失败记录不使缓存失效
+            hits = manager_server.failures_cache.hits
+            top = client.get('/api/failures/top?dimension=device&hours=2').get_json()['top']
+            self.assertEqual([(row['key'], row['failures']) for row in top], [("D1", 5), ("jihao:2", 1)])
+            self.assertEqual(manager_server.failures_cache.hits, hits + 1)
+            for cached in manager_server.failures_cache.entries.values():
+                cached.expires = 0
+            top = client.get('/api/failures/top?dimension=device&hours=2').get_json()['top']
+            self.assertEqual([(row['key'], row['failures']) for row in top], [("D1", 5), ("jihao:2", 3)])
+            top = client.get('/api/failures/top?dimension=card&failureType=2').get_json()['top']
+            self.assertEqual([(row['key'], row['failures']) for row in top], [("C9", 3), ("C8", 2)])
+
+            self.assertEqual(client.get('/api/failures/top?dimension=area').status_code, 400)
+            self.assertEqual(client.get('/api/failures/top?failureType=4').status_code, 400)
+        finally:
+            manager_server.DB_PATH = original_db_path
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Excel落盘去抖动测试单元
+测试同一路径的事件合并、文件稳定等待和工作簿校验
+"""
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import pandas as pd
+import prometheus_client as prom
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+from file_ingest import ExcelIngestDebouncer, file_md5
+
+
+class TestFileIngest(unittest.TestCase):
+    """去抖动导入阶段测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, "2025-05-26.xlsx")
+        self.calls = []
+        self.called = threading.Event()
+
+        def callback(file_path, file_hash):
+            self.calls.append((file_path, file_hash))
+            self.called.set()
+
+        self.ingest = ExcelIngestDebouncer(callback, name='test', settle_seconds=0.3, poll_interval=0.05)
+
+    def tearDown(self):
+        """测试后清理工作"""
+        self.ingest.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def write_workbook(self):
+        pd.DataFrame({"user": ["u1", "u2"], "department": ["d", "d"], "balance": [3, 5]}).to_excel(
+            self.file_path, index=False
+        )
+
+    def suppressed_events(self):
+        """已被合并抑制的事件数（该标签还没有样本时为0）"""
+        return prom.REGISTRY.get_sample_value('excel_ingest_suppressed_events_total', {'watcher': 'test'}) or 0
+
+    def test_event_storm_is_coalesced(self):
+        """测试同一文件的大量事件只交付一次导入"""
+        self.write_workbook()
+        before = self.suppressed_events()
+        for _ in range(50):
+            self.ingest.submit(self.file_path)
+
+        self.assertTrue(self.called.wait(5))
+        time.sleep(0.5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0], (self.file_path, file_md5(self.file_path)))
+        self.assertEqual(self.suppressed_events() - before, 49)
+
+    def test_waits_until_file_stops_growing(self):
+        """测试文件仍在写入时不会被交付"""
+        with open(self.file_path, 'wb') as f:
+            f.write(b'PK')
+        self.ingest.submit(self.file_path)
+        for _ in range(5):
+            time.sleep(0.15)
+            with open(self.file_path, 'ab') as f:
+                f.write(b'x' * 1024)
+        self.assertEqual(self.calls, [])
+
+        # 写入完整的工作簿后才会交付
+        self.write_workbook()
+        self.ingest.submit(self.file_path)
+        self.assertTrue(self.called.wait(5))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_broken_workbook_is_rejected(self):
+        """测试稳定后仍无法打开的文件不会交付"""
+        with open(self.file_path, 'wb') as f:
+            f.write(b'not a workbook')
+        self.ingest.submit(self.file_path)
+        self.assertFalse(self.called.wait(1))
+        self.assertEqual(self.ingest.pending_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+在线索引迁移测试单元
+测试迁移文件中的索引被创建、重复执行无副作用，以及统计查询计划使用索引
+"""
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import index_migration
+
+
+class TestIndexMigration(unittest.TestCase):
+    """在线索引迁移测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.conn = sqlite3.connect(os.path.join(self.temp_dir, "test_ic_manager.db"), isolation_level=None)
+        for table in ['kbk_ic_en_count', 'kbk_ic_cn_count', 'kbk_ic_nm_count']:
+            self.conn.execute(f'''
+            CREATE TABLE {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                department TEXT NOT NULL,
+                transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )''')
+            self.conn.executemany(
+                f"INSERT INTO {table} (user, department, transaction_date) VALUES (?, ?, ?)",
+                [(f"user{i % 50}", f"部门{i % 5}", f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d} 06:00:00")
+                 for i in range(500)]
+            )
+        self.conn.execute('''
+        CREATE TABLE kbk_ic_manager (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            card TEXT NOT NULL UNIQUE,
+            department TEXT NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0,
+            last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+    def tearDown(self):
+        """测试后清理工作"""
+        self.conn.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_apply_is_idempotent_and_plans_use_indexes(self):
+        """测试缺少的表被跳过、再次执行不重复建索引，所有统计查询都不做无索引的全表扫描"""
+        before = {name: uses_index for name, uses_index, _ in index_migration.verify_query_plans(self.conn)}
+        self.assertFalse(before["计数统计(日期范围)"])
+
+        results = index_migration.apply_indexes(self.conn)
+        self.assertEqual(results["idx_kbk_ic_cn_count_date_dept_user"], "created")
+        self.assertEqual(results["idx_kbk_ic_failure_records_date_type_dept"], "skipped")
+        self.assertNotIn("skipped", {results[name] for name in results if "failure" not in name})
+        self.assertEqual(set(index_migration.apply_indexes(self.conn).values()), {"exists", "skipped"})
+
+        for name, uses_index, plan in index_migration.verify_query_plans(self.conn):
+            self.assertTrue(uses_index, f"{name}:\n{plan}")
+
+
+if __name__ == "__main__":
+    unittest.main()
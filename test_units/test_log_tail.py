@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+日志尾部读取测试单元
+测试跨轮转文件的尾部读取、游标在轮转后继续有效、since二分查找，以及 /api/log 的Range和SSE模式
+"""
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import log_tail
+import manager_server
+import wsgi_server
+
+
+class TestLogTail(unittest.TestCase):
+    """日志尾部读取测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.temp_dir, "ic_manager.log")
+        # 轮转文件 .2 最旧，当前文件最新；每条日志一行，第5条带一行无时间戳的续行
+        self.write(self.log_path + ".2", [self.entry(i) for i in range(0, 10)])
+        self.write(self.log_path + ".1", [self.entry(i) for i in range(10, 20)])
+        self.write(self.log_path, [self.entry(i) for i in range(20, 25)])
+
+    def tearDown(self):
+        """测试后清理工作"""
+        shutil.rmtree(self.temp_dir)
+
+    def entry(self, i):
+        line = f"2025-05-01 08:{i:02d}:00.%f - MainThread - INFO - 刷卡 {i}\n"
+        return line + ("Traceback 续行\n" if i == 5 else "")
+
+    def write(self, path, entries, mode='w'):
+        with open(path, mode, encoding='utf-8') as f:
+            f.write(''.join(entries))
+
+    def rotate(self):
+        """模拟 RotatingFileHandler：依次改名，当前文件变为 .1"""
+        os.rename(self.log_path + ".2", self.log_path + ".3")
+        os.rename(self.log_path + ".1", self.log_path + ".2")
+        os.rename(self.log_path, self.log_path + ".1")
+
+    def test_tail_cursor_and_since_span_rotated_files(self):
+        """测试尾部跨文件、未写完的行不返回、游标在轮转后继续读到新文件、since定位到第一条不早于该时间的日志"""
+        text, cursor = log_tail.tail(self.log_path, 7)
+        self.assertEqual(text.splitlines()[0], self.entry(18).strip())
+        self.assertEqual(len(text.splitlines()), 7)
+
+        self.write(self.log_path, [self.entry(25), "2025-05-01 08:26"], mode='a')
+        text, cursor, more = log_tail.read_from(self.log_path, cursor)
+        self.assertEqual((text, more), (self.entry(25), False))
+        self.write(self.log_path, [":00 - 写完\n"], mode='a')
+        self.rotate()
+        self.write(self.log_path, [self.entry(27)])
+        text, cursor, more = log_tail.read_from(self.log_path, cursor)
+        self.assertEqual(text, "2025-05-01 08:26:00 - 写完\n" + self.entry(27))
+        self.assertEqual(log_tail.read_from(self.log_path, cursor)[0], "")
+
+        since = log_tail.find_since(self.log_path, log_tail.parse_since("2025-05-01T08:05:30"))
+        text, _, more = log_tail.read_from(self.log_path, since, max_bytes=200)
+        self.assertTrue(more)
+        self.assertTrue(text.startswith(self.entry(6)))
+        text, _, _ = log_tail.read_from(self.log_path, log_tail.find_since(self.log_path, "2025-05-01 08:05:00"))
+        self.assertTrue(text.startswith(self.entry(5)))
+        self.assertEqual(log_tail.find_since(self.log_path, "2025-05-02 00:00:00"), log_tail.end_cursor(self.log_path))
+
+    def test_log_endpoint_range_and_follow(self):
+        """测试 /api/log 默认返回尾部和游标，Range返回206，follow模式只推送新增行"""
+        original_log_path = manager_server.LOG_PATH
+        manager_server.LOG_PATH = self.log_path
+        try:
+            client = manager_server.app.test_client()
+            response = client.get('/api/log', query_string={'lines': 2})
+            self.assertEqual(response.get_data(as_text=True), self.entry(23) + self.entry(24))
+            cursor = response.headers['X-Log-Cursor']
+            self.assertEqual(client.get('/api/log', query_string={'offset': cursor}).get_data(as_text=True), "")
+            self.assertEqual(client.get('/api/log', query_string={'since': '2025/05/01'}).status_code, 400)
+
+            response = client.get('/api/log', headers={'Range': 'bytes=-10'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.get_data(as_text=True), self.entry(24).encode('utf-8')[-10:].decode('utf-8'))
+
+            self.write(self.log_path, [self.entry(25), self.entry(26)], mode='a')
+            response = client.get('/api/log', query_string={'follow': '1', 'offset': cursor})
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            events = response.response
+            self.assertTrue(next(events).startswith(b"retry:"))
+            event = next(events).decode('utf-8')
+            response.close()
+            self.assertEqual(event.splitlines()[1:-1], [f"data: {self.entry(i).strip()}" for i in (25, 26)])
+            self.assertTrue(wsgi_server.stream_slots.acquire(blocking=False))
+            wsgi_server.stream_slots.release()
+        finally:
+            manager_server.LOG_PATH = original_log_path
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+管理界面服务器测试单元
+测试 /api/counts 的SQL聚合、日期范围条件和响应缓存，按相同条件流式导出CSV/XLSX，以及长连接不占满线程池、后台任务在fork之后启动
+"""
+import unittest
+import io
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import threading
+import http.client
+from pathlib import Path
+from unittest import mock
+
+import openpyxl
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import manager_server
+import swipe_export
+import data_version
+import log_tail
+import wsgi_server
+
+
+class TestManagerServer(unittest.TestCase):
+    """管理界面服务器测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, "test_ic_manager.db")
+        self.original_db_path = manager_server.DB_PATH
+        manager_server.DB_PATH = self.db_path
+
+        conn = sqlite3.connect(self.db_path)
+        for table in ['kbk_ic_en_count', 'kbk_ic_cn_count', 'kbk_ic_nm_count']:
+            conn.execute(f'''
+            CREATE TABLE {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                department TEXT NOT NULL,
+                transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )''')
+        conn.executemany("INSERT INTO kbk_ic_cn_count (user, department, transaction_date) VALUES (?, ?, ?)", [
+            ("u1", "A", "2025-04-30 07:00:00"),
+            ("u1", "A", "2025-05-01 05:25:00"),
+            ("u1", "A", "2025-05-01 07:40:00"),
+            ("u1", "A", "2025-05-01 07:40:01"),
+            ("u2", "A", "2025-05-31 12:00:00"),
+            ("u2", "B", "2025-05-31 19:40:00"),
+            ("u2", "B", "2025-06-01 00:00:00"),
+            ("u3", "B", "2025-05-15"),
+        ])
+        conn.commit()
+        conn.close()
+
+        self.client = manager_server.app.test_client()
+
+    def tearDown(self):
+        """测试后清理工作"""
+        manager_server.DB_PATH = self.original_db_path
+        shutil.rmtree(self.temp_dir)
+
+    def counts(self, **params):
+        response = self.client.get('/api/counts', query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return {row['area']: row for row in response.get_json()['counts']}
+
+    def test_counts_buckets_time_slots_in_sql(self):
+        """测试时段边界为闭区间，只有日期的记录计入总数但不计入时段，保持原有的响应结构"""
+        counts = self.counts(area='all')
+        self.assertEqual(list(counts), ['kbk_ic_cn_count', 'kbk_ic_en_count', 'kbk_ic_nm_count'])
+        self.assertEqual(counts['kbk_ic_cn_count'],
+                         {'area': 'kbk_ic_cn_count', 'count': 8, 'morning': 3, 'noon': 1, 'evening': 1})
+        self.assertEqual(counts['kbk_ic_en_count'],
+                         {'area': 'kbk_ic_en_count', 'count': 0, 'morning': 0, 'noon': 0, 'evening': 0})
+
+    def test_counts_date_ranges(self):
+        """测试日、月、年范围条件包含结束日期当天/当月/当年的全部记录"""
+        day = self.counts(area='kbk_ic_cn_count', startDate='2025-05-01', endDate='2025-05-31')
+        self.assertEqual(day['kbk_ic_cn_count']['count'], 6)
+        month = self.counts(area='kbk_ic_cn_count', dateType='month', startDate='2025-05', endDate='2025-05')
+        self.assertEqual(month['kbk_ic_cn_count']['count'], 6)
+        december = self.counts(area='kbk_ic_cn_count', dateType='month', startDate='2025-04', endDate='2025-12')
+        self.assertEqual(december['kbk_ic_cn_count']['count'], 8)
+        year = self.counts(area='kbk_ic_cn_count', dateType='year', endDate='2025', department='B')
+        self.assertEqual(year['kbk_ic_cn_count']['count'], 3)
+
+        response = self.client.get('/api/counts', query_string={'startDate': '2025/05/01'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_counts_cache_invalidated_by_data_version(self):
+        """测试相同含义的参数命中同一缓存，当天刷卡不使缓存失效（包含当天的查询TTL到期后更新），ETag匹配时返回304，大响应使用gzip"""
+        conn = sqlite3.connect(self.db_path)
+        data_version.ensure_version_table(conn)
+        conn.commit()
+        month = {'area': 'kbk_ic_cn_count', 'dateType': 'month', 'startDate': '2025-05', 'endDate': '2025-05'}
+        first = self.client.get('/api/counts', query_string=month)
+        self.assertEqual(first.get_json()['counts'][0]['count'], 6)
+        hits = manager_server.counts_cache.hits
+        same = self.client.get('/api/counts', query_string={'area': 'kbk_ic_cn_count', 'startDate': '2025-05-01',
+                                                            'endDate': '2025-05-31'})
+        self.assertEqual((manager_server.counts_cache.hits, same.headers['ETag']), (hits + 1, first.headers['ETag']))
+        self.assertEqual(self.client.get('/api/counts', query_string=month,
+                                         headers={'If-None-Match': first.headers['ETag']}).status_code, 304)
+
+        # 历史记录被改写但没有更新版本时仍返回缓存；更新 swipes 不影响已关闭区间，更新 swipes_history 后重新计算
+        conn.execute("INSERT INTO kbk_ic_cn_count (user, department, transaction_date) VALUES ('u9', 'A', '2025-05-20')")
+        data_version.bump(conn, data_version.SWIPES)
+        conn.commit()
+        self.assertEqual(self.client.get('/api/counts', query_string=month).get_json()['counts'][0]['count'], 6)
+        data_version.bump(conn, data_version.SWIPES_HISTORY)
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.client.get('/api/counts', query_string=month).get_json()['counts'][0]['count'], 7)
+
+        # 包含当天的查询在TTL内不因新的刷卡失效，TTL到期后重新计算
+        open_range = {'area': 'kbk_ic_cn_count', 'startDate': '2025-05-01'}
+        count = self.client.get('/api/counts', query_string=open_range).get_json()['counts'][0]['count']
+        conn = sqlite3.connect(self.db_path)
+        for _ in range(3):
+            conn.execute("INSERT INTO kbk_ic_cn_count (user, department, transaction_date) VALUES ('u9', 'A', '2025-05-21')")
+            data_version.bump(conn, data_version.SWIPES)
+            conn.commit()
+            hits = manager_server.counts_cache.hits
+            self.assertEqual(self.client.get('/api/counts', query_string=open_range).get_json()['counts'][0]['count'], count)
+            self.assertEqual(manager_server.counts_cache.hits, hits + 1)
+        conn.close()
+        for cached in manager_server.counts_cache.entries.values():
+            cached.expires = 0
+        self.assertEqual(self.client.get('/api/counts', query_string=open_range).get_json()['counts'][0]['count'],
+                         count + 3)
+
+        entry = manager_server.counts_cache.put(('large',), 0, 60, {'counts': [{'area': 'x' * 2000}]})
+        with manager_server.app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = manager_server.response_cache.make_response(manager_server.app, manager_server.request,
+                                                                   entry, 'counts')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(response.get_data()), 200)
+
+    def test_export_streams_filtered_rows(self):
+        """测试导出使用与 /api/counts 相同的筛选条件，CSV分块输出，XLSX超过单表行数时分到新工作表"""
+        response = self.client.get('/api/export/swipes', query_string={
+            'area': 'kbk_ic_cn_count', 'dateType': 'month', 'startDate': '2025-05', 'endDate': '2025-05',
+            'department': 'B'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        self.assertEqual(response.get_data(as_text=True).lstrip('\ufeff').splitlines(), [
+            '区域,用户,部门,时间',
+            'kbk_ic_cn_count,u2,B,2025-05-31 19:40:00',
+            'kbk_ic_cn_count,u3,B,2025-05-15',
+        ])
+        self.assertEqual(self.client.get('/api/export/swipes', query_string={'startDate': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/export/cards').status_code, 404)
+
+        # 导出与长连接共用名额：名额已满时返回503，未读取就关闭的响应也会归还名额
+        slots = wsgi_server.stream_slots
+        held = 0
+        while slots.acquire(blocking=False):
+            held += 1
+        try:
+            response = self.client.get('/api/export/swipes')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], str(swipe_export.RETRY_AFTER))
+        finally:
+            for _ in range(held):
+                slots.release()
+        for _ in range(held + 1):
+            # 客户端在开始发送之前断开：生成器从未开始，关闭响应时归还名额
+            with manager_server.app.test_request_context('/api/export/swipes'):
+                manager_server.export_records('swipes').close()
+        self.assertEqual(self.client.get('/api/export/swipes').status_code, 200)
+        acquired = 0
+        while slots.acquire(blocking=False):
+            acquired += 1
+        for _ in range(acquired):
+            slots.release()
+        self.assertEqual(acquired, held)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+        CREATE TABLE kbk_ic_failure_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT,
+            department TEXT,
+            transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            failure_type INTEGER NOT NULL
+        )''')
+        conn.executemany("INSERT INTO kbk_ic_failure_records (user, department, transaction_date, failure_type) "
+                         "VALUES (?, ?, ?, ?)", [("u1", "A", "2025-05-01 09:00:00", 3), (None, None, "2025-05-02", 2)])
+        conn.commit()
+        conn.close()
+        response = self.client.get('/api/export/failures', query_string={'format': 'xlsx', 'startDate': '2025-05-02'})
+        sheet = openpyxl.load_workbook(io.BytesIO(response.get_data()), read_only=True).active
+        self.assertEqual([tuple(row) for row in sheet.values], [
+            ('用户', '部门', '时间', '失败类型'), (None, None, '2025-05-02', '卡号不存在')
+        ])
+
+        path = os.path.join(self.temp_dir, "rollover.xlsx")
+        conn = sqlite3.connect(self.db_path)
+        queries = swipe_export.export_queries('swipes', ['kbk_ic_cn_count'])
+        self.assertEqual(swipe_export.write_xlsx('swipes', swipe_export.iter_rows(conn, queries, chunk_size=3),
+                                                 path, sheet_rows=5), 8)
+        conn.close()
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        self.assertEqual([len(list(sheet.values)) for sheet in workbook.worksheets], [6, 4])
+        workbook.close()
+
+    def test_streams_leave_threads_for_requests(self):
+        """测试长连接名额（线程数的一半）占满后，新的SSE连接返回503，普通请求仍由空闲线程及时处理"""
+        log_path = os.path.join(self.temp_dir, "ic_manager.log")
+        Path(log_path).write_text("", encoding='utf-8')
+        original_log_path = manager_server.LOG_PATH
+        manager_server.LOG_PATH = log_path
+        release = threading.Event()
+
+        def follow(path, cursor):
+            yield "retry: 1000\n\n"
+            release.wait(10)
+
+        server = wsgi_server.make_server(manager_server.app, '127.0.0.1', 0, threads=4, keep_alive=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        streams = []
+
+        def get(path):
+            conn = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+            conn.request('GET', path)
+            return conn, conn.getresponse()
+
+        try:
+            with mock.patch.object(log_tail, 'follow', follow):
+                for _ in range(2):
+                    conn, response = get('/api/log?follow=1')
+                    streams.append(conn)
+                    self.assertEqual(response.status, 200)
+                for path in ('/api/log?follow=1', '/api/swipes/stream'):
+                    conn, response = get(path)
+                    conn.close()
+                    self.assertEqual(response.status, 503)
+                conn, response = get('/api/counts')
+                self.assertEqual(response.status, 200)
+                self.assertIn('counts', response.read().decode('utf-8'))
+                conn.close()
+        finally:
+            release.set()
+            for conn in streams:
+                conn.close()
+            server.shutdown()
+            server.server_close()
+            wsgi_server.limit_streams(wsgi_server.DEFAULT_THREADS)
+            manager_server.LOG_PATH = original_log_path
+
+    def test_background_task_starts_after_fork(self):
+        """测试后台任务在fork工作进程之后于主进程中启动，不会被子进程继承"""
+        events = []
+
+        def fork():
+            events.append('fork')
+            return 1000 + len(events)
+
+        def serve_forever(server, *args, **kwargs):
+            events.append('serve')
+            raise KeyboardInterrupt
+
+        with mock.patch.object(wsgi_server.os, 'fork', fork), \
+                mock.patch.object(wsgi_server.os, 'kill'), mock.patch.object(wsgi_server.os, 'waitpid'), \
+                mock.patch.object(wsgi_server.signal, 'signal'), \
+                mock.patch.object(wsgi_server.PooledWSGIServer, 'serve_forever', serve_forever):
+            wsgi_server.serve(manager_server.app, host='127.0.0.1', port=0, workers=3,
+                              on_start=lambda: events.append('start'))
+        wsgi_server.limit_streams(wsgi_server.DEFAULT_THREADS)
+        self.assertEqual(events, ['fork', 'fork', 'start', 'serve'])
+
+
+if __name__ == "__main__":
+    unittest.main()
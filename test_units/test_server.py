@@ -605,6 +605,216 @@ class TestDutyUpdateService(unittest.TestCase):
         loop.close()
         logger.info("======= 完成性能压力测试 =======")
 
+    def test_10_duty_rules(self):
+        """测试班次规则的向量化计算结果"""
+        from status_update_server import evaluate_duty_rows, expand_duty_updates
+        df = pd.DataFrame({
+            "user": ["u1", "u2", "u3", "u4", "u5"],
+            "is_on_duty": [1, 1, 1, 0, 1],
+            "shift": ["ds", "NS", "lds", "ds", None],
+            "card": ["c1", None, "c3", "c4", "c5"]
+        })
+        # 时间点b只激活ns/lds班次，值班为0的用户仅更新
+        users = expand_duty_updates(*evaluate_duty_rows(df, "技术部", "b"))
+        self.assertEqual(
+            [(u["user"], u["card"], u["status"], u.get("update_only", False)) for u in users],
+            [("u2", None, 1, False), ("u3", "c3", 1, False), ("u4", "c4", 0, True)]
+        )
+        # 时间点a同时激活ds班次
+        dept, user_list, cards, statuses = evaluate_duty_rows(df, "技术部", "a")
+        self.assertEqual(user_list, ["u1", "u2", "u3", "u4"])
+        self.assertEqual(statuses, bytes([1, 1, 1, 0]))
+
+    def test_11_process_pool_update(self):
+        """测试进程池模式与进程内模式写入相同的结果"""
+        folder = os.path.join(self.temp_dir, "excel_parallel")
+        os.makedirs(folder, exist_ok=True)
+        file_path = os.path.join(folder, "2025-05-17.xlsx")
+        with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
+            for d in range(6):
+                pd.DataFrame({
+                    "user": [f"p{d}_{i}" for i in range(30)],
+                    "is_on_duty": [1 if i % 3 else 0 for i in range(30)],
+                    "shift": ["ds" if i % 5 == 0 else "ns" for i in range(30)],
+                    "card": [f"card{d}_{i}" for i in range(30)]
+                }).to_excel(writer, sheet_name=f"部门{d}", index=False)
+
+        def run_update(db_path, process_workers):
+            conn = sqlite3.connect(db_path)
+            conn.execute('''
+            CREATE TABLE kbk_ic_manager (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                card TEXT NOT NULL UNIQUE,
+                department TEXT NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )''')
+            conn.executemany(
+                "INSERT INTO kbk_ic_manager (user, card, department, status) VALUES (?, ?, ?, 1)",
+                [(f"p{d}_{i}", f"card{d}_{i}", f"部门{d}") for d in range(6) for i in range(0, 30, 2)]
+            )
+            conn.commit()
+            conn.close()
+
+            service = DutyUpdateService(
+                excel_folder=folder,
+                db_config={"type": "sqlite", "path": db_path},
+                time_points=self.time_points,
+                monitor_port=None,
+                process_workers=process_workers
+            )
+            service.check_new_excel()
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(service.initialize_db_pool())
+                loop.run_until_complete(service.update_status("b"))
+                loop.run_until_complete(service.close_db_pool())
+            finally:
+                loop.close()
+                service.cleanup()
+
+            conn = sqlite3.connect(db_path)
+            rows = conn.execute("SELECT user, card, department, status FROM kbk_ic_manager ORDER BY user").fetchall()
+            conn.close()
+            return rows
+
+        serial_rows = run_update(os.path.join(self.temp_dir, "serial.db"), 0)
+        parallel_rows = run_update(os.path.join(self.temp_dir, "parallel.db"), 2)
+        self.assertEqual(serial_rows, parallel_rows)
+        # 时间点b只有ns班次被激活（不存在则插入），值班为0的已有用户被置为0，ds班次保持不变
+        activated = {i for i in range(30) if i % 3 and i % 5}
+        inserted = {i for i in activated if i % 2}
+        untouched = {i for i in range(0, 30, 2) if i % 3 and not i % 5}
+        self.assertEqual(len(parallel_rows), 6 * (15 + len(inserted)))
+        self.assertEqual(sum(1 for row in parallel_rows if row[3] == 1), 6 * len(activated | untouched))
+
+    def test_12_status_plan_delta(self):
+        """测试预计算计划只写入差异，且结果与直接解析文件一致"""
+        folder = os.path.join(self.temp_dir, "excel_plan")
+        os.makedirs(folder, exist_ok=True)
+        pd.DataFrame({
+            "user": [f"q{i}" for i in range(20)],
+            "is_on_duty": [1 if i % 4 else 0 for i in range(20)],
+            "shift": ["ds" if i % 2 else "ns" for i in range(20)],
+            "card": [f"qc{i}" for i in range(20)]
+        }).to_excel(os.path.join(folder, "2025-05-18.xlsx"), sheet_name="部门P", index=False)
+
+        def make_service(db_path):
+            conn = sqlite3.connect(db_path)
+            conn.execute('''
+            CREATE TABLE kbk_ic_manager (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                card TEXT NOT NULL UNIQUE,
+                department TEXT NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )''')
+            conn.executemany(
+                "INSERT INTO kbk_ic_manager (user, card, department, status) VALUES (?, ?, '部门P', 1)",
+                [(f"q{i}", f"qc{i}") for i in range(0, 20, 3)]
+            )
+            conn.commit()
+            conn.close()
+            service = DutyUpdateService(
+                excel_folder=folder,
+                db_config={"type": "sqlite", "path": db_path},
+                time_points=self.time_points,
+                monitor_port=None
+            )
+            service.check_new_excel()
+            return service
+
+        def read_rows(db_path):
+            conn = sqlite3.connect(db_path)
+            rows = conn.execute("SELECT user, card, department, status FROM kbk_ic_manager ORDER BY user").fetchall()
+            conn.close()
+            return rows
+
+        plan_db = os.path.join(self.temp_dir, "plan.db")
+        file_db = os.path.join(self.temp_dir, "file.db")
+        plan_service = make_service(plan_db)
+        file_service = make_service(file_db)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(plan_service.initialize_db_pool())
+            loop.run_until_complete(file_service.initialize_db_pool())
+            plan = loop.run_until_complete(plan_service.ensure_status_plan())
+            self.assertEqual(set(plan.bitsets), set(self.time_points))
+
+            loop.run_until_complete(plan_service.update_status("a"))
+            first = plan.applied["a"]
+            self.assertGreater(first["delta"], 0)
+            # 再次应用同一时间点时数据库已是目标状态，没有差异
+            loop.run_until_complete(plan_service.update_status("a"))
+            self.assertEqual(plan.applied["a"]["delta"], 0)
+            self.assertEqual(plan.applied["a"]["targets"], first["targets"])
+
+            loop.run_until_complete(file_service.update_status_from_file(
+                os.path.join(folder, file_service.latest_excel), "a"
+            ))
+            loop.run_until_complete(plan_service.close_db_pool())
+            loop.run_until_complete(file_service.close_db_pool())
+        finally:
+            loop.close()
+            plan_service.cleanup()
+            file_service.cleanup()
+        self.assertEqual(read_rows(plan_db), read_rows(file_db))
+
+    def test_13_phase_metrics(self):
+        """测试分阶段指标和仪表盘"""
+        import prometheus_client as prom
+        folder = os.path.join(self.temp_dir, "excel_metrics")
+        os.makedirs(folder, exist_ok=True)
+        pd.DataFrame({
+            "user": [f"m{i}" for i in range(12)],
+            "is_on_duty": [1] * 12,
+            "shift": ["ns"] * 12,
+            "card": [f"mc{i}" for i in range(12)]
+        }).to_excel(os.path.join(folder, "2025-05-19.xlsx"), sheet_name="部门M", index=False)
+        db_path = os.path.join(self.temp_dir, "metrics.db")
+        conn = sqlite3.connect(db_path)
+        conn.execute('''
+        CREATE TABLE kbk_ic_manager (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            card TEXT NOT NULL UNIQUE,
+            department TEXT NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0,
+            last_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''')
+        conn.close()
+
+        service = DutyUpdateService(
+            excel_folder=folder,
+            db_config={"type": "sqlite", "path": db_path},
+            time_points=self.time_points,
+            monitor_port=None
+        )
+        service.check_new_excel()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(service.initialize_db_pool())
+            loop.run_until_complete(service.update_status("b"))
+            loop.run_until_complete(service.close_db_pool())
+        finally:
+            loop.close()
+            service.cleanup()
+
+        sample = prom.REGISTRY.get_sample_value
+        self.assertEqual(sample('duty_roster_rows', {'department': "部门M"}), 12)
+        self.assertGreater(sample('duty_update_phase_seconds_sum',
+                                  {'phase': 'db_insert', 'time_point': 'b', 'department': "部门M"}), 0)
+        self.assertGreater(sample('duty_last_apply_timestamp_seconds', {'time_point': 'b'}), 0)
+        self.assertGreaterEqual(sample('duty_update_phase_seconds_count',
+                                       {'phase': 'commit', 'time_point': 'b', 'department': 'all'}), 1)
+        self.assertEqual(service.cache_stats['plan'], [0, 1])
+        self.assertEqual(sample('duty_cache_hit_ratio', {'cache': 'plan'}), 0)
+
 def run_tests():
     """运行所有测试"""
     logger.info("========== 开始执行所有测试 ==========")
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+实时刷卡事件测试单元
+测试Unix数据报套接字的发布/订阅、已退出订阅者的清理，以及SSE逐条过滤和按秒聚合
+"""
+import unittest
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import swipe_events
+
+
+class TestSwipeEvents(unittest.TestCase):
+    """实时刷卡事件测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        # Unix套接字路径长度有限，使用短的临时目录
+        self.temp_dir = tempfile.mkdtemp(dir='/tmp', prefix='ev')
+        self.hub = swipe_events.SwipeEventHub(self.temp_dir).start()
+
+    def tearDown(self):
+        """测试后清理工作"""
+        self.hub.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def test_publish_reaches_hub_and_cleans_stale_subscribers(self):
+        """测试事件送达订阅进程，对方已退出的套接字文件被发布方删除，没有订阅者时发布不报错"""
+        stale = os.path.join(self.temp_dir, "manager-0.sock")
+        dead = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        dead.bind(stale)
+        dead.close()
+
+        publisher = swipe_events.SwipeEventPublisher(self.temp_dir)
+        self.assertEqual(publisher.publish(swipe_events.OUTCOME_SUCCESS, 1, "财务部", ts=100.5), 1)
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(self.hub.wait(0, timeout=2), 1)
+        self.assertEqual(self.hub.events_after(0), [
+            (1, {'ts': 100.5, 'outcome': 'success', 'jihao': '1', 'department': '财务部'})
+        ])
+        self.assertEqual(swipe_events.SwipeEventPublisher(os.path.join(self.temp_dir, "none")).publish("success", 1), 0)
+
+    def test_stream_filters_events_and_aggregates_per_second(self):
+        """测试逐条模式按部门过滤并带序号，聚合模式每秒推送一次过滤后的计数，空闲的秒不推送"""
+        for ts, outcome, jihao, department in [
+            (100.1, 'success', '1', '财务部'), (100.2, 'success', '1', '人事部'),
+            (100.9, 'inactive', '1', '财务部'), (101.5, 'success', '2', '财务部'), (103.0, 'success', '1', '财务部'),
+        ]:
+            self.hub.add({'ts': ts, 'outcome': outcome, 'jihao': jihao, 'department': department})
+
+        events = swipe_events.stream(self.hub, {'department': {'财务部'}, 'jihao': {'1'}}, last_id=0, keepalive=60)
+        self.assertEqual(next(events), "retry: 1000\n\n")
+        messages = [next(events) for _ in range(3)]
+        self.assertEqual([m.splitlines()[0] for m in messages], ["id: 1", "id: 3", "id: 5"])
+        self.assertEqual(json.loads(messages[1].splitlines()[1][len("data: "):])['outcome'], 'inactive')
+
+        now = [100.5]
+        aggregated = swipe_events.stream(self.hub, {'jihao': {'1'}}, aggregate=True, clock=lambda: now[0],
+                                         sleep=lambda seconds: now.__setitem__(0, now[0] + seconds))
+        next(aggregated)
+        data = [json.loads(next(aggregated).splitlines()[1][len("data: "):]) for _ in range(2)]
+        self.assertEqual(data, [{'ts': 100, 'counts': {'success': 2, 'inactive': 1}},
+                                {'ts': 103, 'counts': {'success': 1}}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+统一刷卡事实表测试单元
+测试分批回填、切换为兼容视图后旧表名照常读写，汇总统计改为读取事实表，以及失败记录和维表登记
+"""
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import swipe_facts
+import swipe_rollup
+from manager_server import build_counts_query
+
+
+class TestSwipeFacts(unittest.TestCase):
+    """统一刷卡事实表测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.conn = sqlite3.connect(os.path.join(self.temp_dir, "test_ic_manager.db"), isolation_level=None)
+        for table in swipe_facts.AREA_CODES:
+            self.conn.execute(f'''
+            CREATE TABLE {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                department TEXT NOT NULL,
+                transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )''')
+        self.swipe("kbk_ic_cn_count", [
+            ("张三", "财务部", "2025-05-01 06:00:00"), ("李四", "财务部", "2025-05-01 12:00:00"),
+            ("张三", "财务部", "2025-05-02 18:30:00"), ("王五", "人事部", "2025-05-02"),
+            ("李四", "人事部", "无效时间"),
+        ])
+        self.swipe("kbk_ic_nm_count", [("王五", "人事部", "2025-05-02 21:00:00")])
+        self.conn.execute('''
+        CREATE TABLE kbk_ic_failure_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT,
+            department TEXT,
+            transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            failure_type INTEGER NOT NULL
+        )''')
+        self.conn.executemany(
+            "INSERT INTO kbk_ic_failure_records (user, department, transaction_date, failure_type) VALUES (?, ?, ?, ?)",
+            [("张三", "财务部", "2025-05-01 09:00:00", 3), (None, None, "2025-05-01 12:01:00", 2)]
+        )
+
+    def tearDown(self):
+        """测试后清理工作"""
+        self.conn.close()
+        shutil.rmtree(self.temp_dir)
+
+    def swipe(self, table, rows):
+        self.conn.executemany(f"INSERT INTO {table} (user, department, transaction_date) VALUES (?, ?, ?)", rows)
+
+    def rows(self, table):
+        return self.conn.execute(f"SELECT user, department, transaction_date FROM {table} ORDER BY id").fetchall()
+
+    def test_backfill_and_cutover_keep_legacy_readers_working(self):
+        """测试分批回填可以继续，切换后兼容视图返回与旧表相同的记录，按旧表名插入仍然有效"""
+        # 无法解析的时间被跳过；只有日期的记录换算后显示为当天零点
+        expected = {table: [row if len(row[2]) != 10 else row[:2] + (row[2] + " 00:00:00",)
+                            for row in self.rows(table) if row[2] != "无效时间"]
+                    for table in swipe_facts.AREA_CODES}
+        swipe_rollup.ensure_rollup_tables(self.conn)
+        swipe_rollup.refresh_rollups(self.conn)
+
+        self.assertEqual(swipe_facts.backfill(self.conn, chunk_size=2, max_chunks=1)["kbk_ic_cn_count"], 2)
+        self.assertEqual(swipe_facts.backfill(self.conn, chunk_size=2)["kbk_ic_cn_count"], 2)
+        # 回填之后、切换之前到达的记录由cutover补齐
+        self.swipe("kbk_ic_en_count", [("赵六", "财务部", "2025-05-03 07:00:00")])
+        expected["kbk_ic_en_count"] = self.rows("kbk_ic_en_count")
+
+        self.assertFalse(swipe_facts.facts_enabled(self.conn))
+        self.assertEqual(swipe_facts.cutover(self.conn), swipe_facts.LEGACY_TABLES)
+        self.assertTrue(swipe_facts.facts_enabled(self.conn))
+        self.assertEqual(swipe_facts.cutover(self.conn), [])
+        for table in swipe_facts.AREA_CODES:
+            self.assertEqual(self.rows(table), expected[table])
+        status = {row[0]: row[1:] for row in swipe_facts.backfill_status(self.conn)}
+        self.assertEqual(status["kbk_ic_cn_count"], (5, 5, 4, 1))
+
+        self.swipe("kbk_ic_cn_count", [("新员工", "财务部", "2025-05-03 12:00:00")])
+        cursor = self.conn.cursor()
+        swipe_facts.record_swipe(cursor, 1, "张三", "财务部", dn="READER01",
+                                 ts=swipe_facts.local_epoch("2025-05-03") + 6 * 3600)
+        self.assertEqual(self.rows("kbk_ic_cn_count")[-2:], [
+            ("新员工", "财务部", "2025-05-03 12:00:00"), ("张三", "财务部", "2025-05-03 06:00:00")
+        ])
+        self.assertEqual(self.conn.execute(
+            "SELECT dn FROM kbk_ic_swipe s JOIN kbk_ic_device v ON v.id = s.device_id"
+        ).fetchall(), [("READER01",)])
+
+        # 切换清空了按旧表id累计的汇总，重新汇总后读事实表的统计与读兼容视图的结果一致
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM kbk_ic_count_rollup").fetchone()[0], 0)
+        swipe_rollup.refresh_rollups(self.conn)
+        self.assertEqual(swipe_rollup.check_rollups(self.conn), [])
+        tables = swipe_rollup.COUNT_TABLES
+        for filters in ({}, {"start_day": "2025-05-02", "end_day": "2025-05-04", "department": "财务部"}):
+            sql, params = swipe_rollup.rollup_counts_query(tables, open_day="2025-05-03", fact_mode=True, **filters)
+            rolled = self.conn.execute(sql, params).fetchall()
+            sql, params = build_counts_query(tables, **filters)
+            self.assertEqual(rolled, self.conn.execute(sql, params).fetchall())
+        self.assertEqual(rolled[0], ("kbk_ic_cn_count", 3, 1, 1, 1))
+
+
+    def test_failures_and_importers_share_dimensions(self):
+        """测试失败记录切换后按旧表名读写（卡号不存在的记录没有用户），导入登记的维表id被事实表复用"""
+        swipe_facts.ensure_fact_tables(self.conn)
+        cursor = self.conn.cursor()
+        self.assertEqual(swipe_facts.register_dimensions(cursor, ["张三", "张三", "钱七"], ["财务部", "后勤部"]), (2, 2))
+        self.assertEqual(swipe_facts.register_dimensions(cursor, ["张三"], ["财务部"]), (0, 0))
+        user_id = self.conn.execute("SELECT id FROM kbk_ic_user WHERE name = '张三'").fetchone()[0]
+
+        self.assertFalse(swipe_facts.failures_enabled(self.conn))
+        swipe_facts.cutover(self.conn)
+        self.assertTrue(swipe_facts.failures_enabled(self.conn))
+        self.conn.execute("INSERT INTO kbk_ic_failure_records (failure_type, transaction_date) VALUES (2, '2025-05-02 07:00:00')")
+        swipe_facts.record_failure(cursor, 1, "钱七", "后勤部", ts=swipe_facts.local_epoch("2025-05-02") + 8 * 3600)
+        self.assertEqual(self.conn.execute(
+            "SELECT user, department, transaction_date, failure_type FROM kbk_ic_failure_records ORDER BY id"
+        ).fetchall(), [
+            ("张三", "财务部", "2025-05-01 09:00:00", 3), (None, None, "2025-05-01 12:01:00", 2),
+            (None, None, "2025-05-02 07:00:00", 2), ("钱七", "后勤部", "2025-05-02 08:00:00", 1),
+        ])
+        # 维表id在回填前已由导入登记，事实表只保存整数
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM kbk_ic_swipe WHERE user_id = ?", (user_id,)).fetchone()[0], 2)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM kbk_ic_user").fetchone()[0], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+刷卡统计汇总表测试单元
+测试增量刷新、汇总查询与原始表查询一致，以及一致性检查和重建
+"""
+import unittest
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+import swipe_rollup
+from manager_server import build_counts_query
+
+
+class TestSwipeRollup(unittest.TestCase):
+    """刷卡统计汇总表测试类"""
+
+    def setUp(self):
+        """测试前准备工作"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.conn = sqlite3.connect(os.path.join(self.temp_dir, "test_ic_manager.db"), isolation_level=None)
+        for table in swipe_rollup.COUNT_TABLES:
+            self.conn.execute(f'''
+            CREATE TABLE {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                department TEXT NOT NULL,
+                transaction_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )''')
+        swipe_rollup.ensure_rollup_tables(self.conn)
+
+    def tearDown(self):
+        """测试后清理工作"""
+        self.conn.close()
+        shutil.rmtree(self.temp_dir)
+
+    def swipe(self, table, rows):
+        self.conn.executemany(f"INSERT INTO {table} (user, department, transaction_date) VALUES (?, ?, ?)", rows)
+
+    def assert_counts_match(self, open_day, **filters):
+        """汇总查询与直接扫描原始表的结果一致"""
+        tables = swipe_rollup.COUNT_TABLES
+        sql, params = swipe_rollup.rollup_counts_query(tables, open_day=open_day, **filters)
+        rolled = self.conn.execute(sql, params).fetchall()
+        sql, params = build_counts_query(tables, **filters)
+        self.assertEqual(rolled, self.conn.execute(sql, params).fetchall())
+        return rolled
+
+    def test_incremental_refresh_matches_raw_counts(self):
+        """测试分批增量刷新后，已关闭日期读汇总、当天和未汇总的记录扫描原始表，结果与原始表一致"""
+        self.swipe("kbk_ic_cn_count", [
+            ("u1", "A", "2025-05-01 05:25:00"), ("u1", "A", "2025-05-01 07:40:01"),
+            ("u2", "A", "2025-05-01 12:00:00"), ("u2", "B", "2025-05-02 19:40:00"),
+            ("u3", "B", "2025-05-02"), ("u1", "A", "2025-05-03 06:00:00"),
+        ])
+        self.swipe("kbk_ic_nm_count", [("u1", "A", "2025-05-02 17:00:00")])
+
+        consumed = swipe_rollup.refresh_rollups(self.conn, batch_size=4)
+        self.assertEqual(consumed, {'kbk_ic_cn_count': 6, 'kbk_ic_en_count': 0, 'kbk_ic_nm_count': 1})
+        self.assertEqual(swipe_rollup.refresh_rollups(self.conn)['kbk_ic_cn_count'], 0)
+
+        # 高水位之后到达的记录：当天的新刷卡，以及补录的历史记录
+        self.swipe("kbk_ic_cn_count", [("u1", "A", "2025-05-03 11:30:00"), ("u2", "A", "2025-05-01 06:00:00")])
+        rows = self.assert_counts_match('2025-05-03')
+        self.assertEqual(rows[0], ('kbk_ic_cn_count', 8, 3, 2, 1))
+        self.assert_counts_match('2025-05-03', start_day='2025-05-02', end_day='2025-05-03')
+        self.assert_counts_match('2025-05-03', department='A', user='u1')
+
+        swipe_rollup.refresh_rollups(self.conn)
+        self.assert_counts_match('2025-05-03')
+        self.assert_counts_match('2025-05-02', start_day='2025-05-01', end_day='2025-05-02')
+        self.assertEqual(swipe_rollup.check_rollups(self.conn), [])
+
+    def test_check_detects_drift_and_rebuild_repairs(self):
+        """测试原始记录被删除后检查能发现不一致，重建后恢复一致"""
+        self.swipe("kbk_ic_en_count", [("u1", "A", "2025-05-01 06:00:00"), ("u1", "A", "2025-05-01 06:30:00")])
+        swipe_rollup.refresh_rollups(self.conn)
+        self.conn.execute("DELETE FROM kbk_ic_en_count WHERE id = 1")
+
+        self.assertEqual(swipe_rollup.check_rollups(self.conn),
+                         [('kbk_ic_en_count', '2025-05-01', 'morning', 'A', 'u1', 2, 1)])
+        self.assertEqual(swipe_rollup.rebuild_rollups(self.conn)['kbk_ic_en_count'], 1)
+        self.assertEqual(swipe_rollup.check_rollups(self.conn), [])
+        self.assert_counts_match('2025-05-02')
+
+    def test_closed_range_plan_avoids_raw_range_scan(self):
+        """测试原始表只按高水位之后的id范围和当天的日期范围读取，部门/用户筛选使用汇总表索引"""
+        for table in swipe_rollup.COUNT_TABLES:
+            self.conn.execute(f"CREATE INDEX idx_{table}_date_dept_user ON {table}(transaction_date, department, user)")
+            self.conn.execute(f"CREATE INDEX idx_{table}_dept_user_date ON {table}(department, user, transaction_date)")
+        self.swipe("kbk_ic_cn_count", [("u1", "A", f"2025-05-{day:02d} 06:00:00") for day in range(1, 29)])
+        swipe_rollup.refresh_rollups(self.conn)
+
+        def plan(**filters):
+            sql, params = swipe_rollup.rollup_counts_query(["kbk_ic_cn_count"], open_day='2025-05-28', **filters)
+            return [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)
+                    if row[3].startswith(("SEARCH", "SCAN")) and "rollup_state" not in row[3]]
+
+        self.assertEqual(plan(start_day='2025-05-01', end_day='2025-05-10'), [
+            "SEARCH kbk_ic_count_rollup USING PRIMARY KEY (day>? AND day<?)",
+            "SEARCH s USING INTEGER PRIMARY KEY (rowid>?)",
+            "SCAN (subquery-3)",
+        ])
+        department_plan = plan(department='A')
+        self.assertIn("SEARCH kbk_ic_count_rollup USING COVERING INDEX idx_kbk_ic_count_rollup_dept_user "
+                      "(area=? AND department=?)", department_plan)
+        self.assertIn("SEARCH s USING INTEGER PRIMARY KEY (rowid>?)", department_plan)
+        self.assertIn("SEARCH s USING COVERING INDEX idx_kbk_ic_cn_count_date_dept_user (transaction_date>?)",
+                      department_plan)
+        self.assertIn("SEARCH kbk_ic_count_rollup USING COVERING INDEX idx_kbk_ic_count_rollup_user (area=? AND user=? AND day<?)",
+                      plan(user='u1'))
+        self.assert_counts_match('2025-05-28', department='A')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+内嵌的生产模式WSGI服务器
+基于werkzeug的WSGI服务器，使用固定大小的线程池处理请求，支持请求超时、keep-alive，
+并可以预先fork多个工作进程共享同一个监听端口
+"""
+import os
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 8
+DEFAULT_WORKERS = 1
+DEFAULT_TIMEOUT = 30
+DEFAULT_KEEP_ALIVE = 5
+
+# 长连接（SSE）在整个连接期间占用一个线程，所有长连接共用的名额为线程数的一半，其余线程始终留给普通请求
+stream_slots = threading.BoundedSemaphore(DEFAULT_THREADS // 2)
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """支持keep-alive和请求超时的请求处理器
+
+    连接上的第一个请求使用 request_timeout 作为读超时，之后等待同一连接的下一个请求时
+    使用 keep_alive 超时；keep_alive 为0时每个请求后关闭连接。
+    """
+
+    request_timeout = DEFAULT_TIMEOUT
+    keep_alive = DEFAULT_KEEP_ALIVE
+
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
+        self.connection.settimeout(self.request_timeout)
+
+    def handle_one_request(self):
+        if self.requests_handled:
+            self.connection.settimeout(self.keep_alive)
+        super().handle_one_request()
+        self.requests_handled += 1
+        self.connection.settimeout(self.request_timeout)
+
+    def log_request(self, code="-", size="-"):
+        # 访问日志交给调试级别，避免高并发时刷屏
+        logger.debug(f"{self.address_string()} {self.command} {self.path} {code}")
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """用固定大小线程池处理连接的WSGI服务器"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=DEFAULT_THREADS, handler=PooledRequestHandler, fd=None):
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def limit_streams(threads):
+    """按线程池大小重设长连接名额；已占用旧名额的连接在结束时归还给旧的信号量"""
+    global stream_slots
+    stream_slots = threading.BoundedSemaphore(threads // 2)
+
+
+def make_server(app, host, port, threads=DEFAULT_THREADS, timeout=DEFAULT_TIMEOUT, keep_alive=DEFAULT_KEEP_ALIVE, fd=None):
+    """创建（但不启动）一个线程池WSGI服务器，长连接名额按线程数重设"""
+    handler = type("ConfiguredRequestHandler", (PooledRequestHandler,), {
+        "request_timeout": timeout,
+        "keep_alive": keep_alive,
+        # HTTP/1.1才会保持连接
+        "protocol_version": "HTTP/1.1" if keep_alive else "HTTP/1.0"
+    })
+    limit_streams(threads)
+    return PooledWSGIServer(host, port, app, threads=threads, handler=handler, fd=fd)
+
+
+def serve(app, host='0.0.0.0', port=5000, threads=DEFAULT_THREADS, workers=DEFAULT_WORKERS,
+          timeout=DEFAULT_TIMEOUT, keep_alive=DEFAULT_KEEP_ALIVE, on_start=None):
+    """
+    以生产模式运行WSGI应用，阻塞直到收到中断信号
+    threads: 每个工作进程处理请求的线程数
+    workers: 工作进程数，大于1时在监听后fork子进程共享端口（仅POSIX，且应用不能持有进程内状态）
+    timeout: 请求读超时（秒）
+    keep_alive: 空闲连接保持的秒数，0表示不保持连接
+    on_start: 子进程fork之后在主进程中调用（无参数），用于启动只应运行一份的后台线程；
+              fork只复制调用线程，在fork之前启动的线程持有的锁会被子进程继承为永远不会释放的状态
+    """
+    server = make_server(app, host, port, threads=threads, timeout=timeout, keep_alive=keep_alive)
+    if workers > 1 and not hasattr(os, 'fork'):
+        logger.warning("当前平台不支持fork，工作进程数降为1")
+        workers = 1
+
+    children = []
+    if workers > 1:
+        # 监听套接字已创建，子进程继承后共享同一端口
+        for _ in range(workers - 1):
+            pid = os.fork()
+            if pid == 0:
+                server.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+                _serve_child(server)
+                os._exit(0)
+            children.append(pid)
+
+    if on_start is not None:
+        on_start()
+
+    if threading.current_thread() is threading.main_thread():
+        # SIGTERM时与Ctrl+C一样正常退出，并回收子进程
+        signal.signal(signal.SIGTERM, _raise_interrupt)
+
+    logger.info(f"WSGI服务器已启动 http://{host}:{port}，工作进程: {workers}，线程: {threads}，"
+                f"请求超时: {timeout}秒，keep-alive: {keep_alive}秒")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _serve_child(server):
+    """子进程：收到SIGTERM时停止服务"""
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()